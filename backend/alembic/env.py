@@ -1,4 +1,5 @@
 import os
+import sys
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config, pool
@@ -16,9 +17,11 @@ if database_url:
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
-# ⬇️ Очень важно: импортируем Base из твоего кода
-# Если потом вынесешь модели в app/models.py, тут поправишь импорт
-from main import Base  # noqa: E402
+# ⬇️ Очень важно: импортируем Base и модели из пакета backend.app
+# (alembic запускается из backend/, поэтому добавляем корень репозитория в sys.path)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from backend.app.db import Base  # noqa: E402
+import backend.app.models  # noqa: E402,F401
 
 target_metadata = Base.metadata
 
@@ -0,0 +1,28 @@
+from alembic import op
+import sqlalchemy as sa
+
+# Идентификатор ревизии
+revision = "0002_chat_messages_tokens_used"
+down_revision = "0001_initial_schema"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # chat_messages создаётся приложением (create_all); на базах, где таблица уже есть,
+    # добавляем счётчик токенов сообщения
+    inspector = sa.inspect(op.get_bind())
+    if "chat_messages" not in inspector.get_table_names():
+        return
+    columns = {c["name"] for c in inspector.get_columns("chat_messages")}
+    if "tokens_used" not in columns:
+        op.add_column("chat_messages", sa.Column("tokens_used", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if "chat_messages" not in inspector.get_table_names():
+        return
+    columns = {c["name"] for c in inspector.get_columns("chat_messages")}
+    if "tokens_used" in columns:
+        op.drop_column("chat_messages", "tokens_used")
@@ -0,0 +1,31 @@
+from alembic import op
+import sqlalchemy as sa
+
+# Идентификатор ревизии
+revision = "0003_chat_sessions_summary"
+down_revision = "0002_chat_messages_tokens_used"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # накопительное summary сессии (chat_sessions создаётся приложением через create_all)
+    inspector = sa.inspect(op.get_bind())
+    if "chat_sessions" not in inspector.get_table_names():
+        return
+    columns = {c["name"] for c in inspector.get_columns("chat_sessions")}
+    if "summary" not in columns:
+        op.add_column("chat_sessions", sa.Column("summary", sa.Text(), nullable=True))
+    if "summary_until_id" not in columns:
+        op.add_column("chat_sessions", sa.Column("summary_until_id", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if "chat_sessions" not in inspector.get_table_names():
+        return
+    columns = {c["name"] for c in inspector.get_columns("chat_sessions")}
+    if "summary_until_id" in columns:
+        op.drop_column("chat_sessions", "summary_until_id")
+    if "summary" in columns:
+        op.drop_column("chat_sessions", "summary")
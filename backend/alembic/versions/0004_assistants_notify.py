@@ -0,0 +1,39 @@
+from alembic import op
+
+# Идентификатор ревизии
+revision = "0004_assistants_notify"
+down_revision = "0003_chat_sessions_summary"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # NOTIFY assistants_changed при любом изменении assistants —
+    # воркеры сразу перезагружают реестр (backend/app/assistants.py).
+    # На SQLite триггер не нужен: там работает периодическая проверка версии.
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION notify_assistants_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('assistants_changed', TG_OP);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER assistants_changed
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON assistants
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_assistants_changed();
+        """
+    )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.execute("DROP TRIGGER IF EXISTS assistants_changed ON assistants")
+    op.execute("DROP FUNCTION IF EXISTS notify_assistants_changed()")
@@ -0,0 +1,78 @@
+"""Перевод рабочих таблиц чата под управление миграций + индексы горячих запросов.
+
+chat_sessions/chat_messages до сих пор создавались приложением (create_all), а
+0001 описывает conversations/messages, которые код не использует. Здесь таблицы
+чата создаются, если их ещё нет (чистая база), и на них строятся индексы под
+запросы /chat/session, /chat/send и /chat/history. На Postgres индексы строятся
+CONCURRENTLY, чтобы не блокировать запись в chat_messages на живой базе.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# Идентификатор ревизии
+revision = "0005_chat_schema_indexes"
+down_revision = "0004_assistants_notify"
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    # (имя, таблица, колонки, доп. параметры)
+    # история читается только в порядке id, поэтому (session_id, created_at) не заводим
+    ("ix_chat_messages_session_id_id", "chat_messages", ["session_id", "id"], {}),
+    (
+        "ix_chat_sessions_user_assistant_created",
+        "chat_sessions",
+        ["user_id", "assistant_id", "created_at"],
+        {"postgresql_include": ["id"]},
+    ),
+]
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    tables = set(sa.inspect(bind).get_table_names())
+
+    if "chat_sessions" not in tables:
+        op.create_table(
+            "chat_sessions",
+            sa.Column("id", sa.String(), primary_key=True),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("assistant_id", sa.Integer(), sa.ForeignKey("assistants.id"), nullable=False),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.Column("summary", sa.Text(), nullable=True),
+            sa.Column("summary_until_id", sa.Integer(), nullable=True),
+        )
+
+    if "chat_messages" not in tables:
+        op.create_table(
+            "chat_messages",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("session_id", sa.String(), sa.ForeignKey("chat_sessions.id"), nullable=True),
+            sa.Column("role", sa.String(), nullable=True),
+            sa.Column("content", sa.Text(), nullable=True),
+            sa.Column("tokens_used", sa.Integer(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+        )
+
+    if bind.dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            for name, table, columns, kw in INDEXES:
+                op.create_index(
+                    name, table, columns,
+                    if_not_exists=True, postgresql_concurrently=True, **kw,
+                )
+    else:
+        for name, table, columns, kw in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True, **kw)
+
+    if bind.dialect.name == "postgresql":
+        # свежая статистика, чтобы планировщик сразу начал использовать индексы
+        op.execute("ANALYZE chat_sessions")
+        op.execute("ANALYZE chat_messages")
+
+
+def downgrade() -> None:
+    # таблицы чата не удаляем: до этой ревизии ими владело приложение
+    for name, table, _, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,86 @@
+"""Одна чат-сессия на пару пользователь–ассистент.
+
+/chat/session всегда возвращал последнюю сессию пары, но параллельные первые
+заходы могли создать несколько. Теперь сессия открывается через
+INSERT ... ON CONFLICT по уникальному индексу (user_id, assistant_id).
+
+Перед созданием индекса накопившиеся дубликаты сливаются в последнюю сессию
+пары (её и отдавал /chat/session): реплики старых сессий переносятся в неё,
+их system-сообщения и сами сессии удаляются. Индекс
+ix_chat_sessions_user_assistant_created из 0005 становится лишним.
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+# Идентификатор ревизии
+revision = "0006_chat_sessions_unique"
+down_revision = "0005_chat_schema_indexes"
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+
+def merge_duplicate_sessions(bind) -> int:
+    rows = bind.execute(sa.text(
+        "SELECT id, user_id, assistant_id FROM chat_sessions "
+        "WHERE (user_id, assistant_id) IN ("
+        "  SELECT user_id, assistant_id FROM chat_sessions"
+        "  GROUP BY user_id, assistant_id HAVING COUNT(*) > 1"
+        ") ORDER BY user_id, assistant_id, created_at DESC, id"
+    )).all()
+
+    merged = 0
+    keep = {}
+    for session_id, user_id, assistant_id in rows:
+        target = keep.setdefault((user_id, assistant_id), session_id)
+        if target == session_id:
+            continue
+        params = {"old": session_id, "new": target}
+        bind.execute(sa.text(
+            "DELETE FROM chat_messages WHERE session_id = :old AND role = 'system'"
+        ), params)
+        bind.execute(sa.text(
+            "UPDATE chat_messages SET session_id = :new WHERE session_id = :old"
+        ), params)
+        bind.execute(sa.text("DELETE FROM chat_sessions WHERE id = :old"), params)
+        merged += 1
+    return merged
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    merged = merge_duplicate_sessions(bind)
+    if merged:
+        logger.info("Слито дубликатов чат-сессий: %d", merged)
+
+    if bind.dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            op.create_index(
+                "uq_chat_sessions_user_assistant", "chat_sessions", ["user_id", "assistant_id"],
+                unique=True, if_not_exists=True, postgresql_concurrently=True,
+            )
+            op.drop_index(
+                "ix_chat_sessions_user_assistant_created", table_name="chat_sessions",
+                if_exists=True, postgresql_concurrently=True,
+            )
+    else:
+        op.create_index(
+            "uq_chat_sessions_user_assistant", "chat_sessions", ["user_id", "assistant_id"],
+            unique=True, if_not_exists=True,
+        )
+        op.drop_index(
+            "ix_chat_sessions_user_assistant_created", table_name="chat_sessions", if_exists=True,
+        )
+
+
+def downgrade() -> None:
+    # слитые сессии не восстанавливаются
+    op.create_index(
+        "ix_chat_sessions_user_assistant_created", "chat_sessions",
+        ["user_id", "assistant_id", "created_at"],
+        postgresql_include=["id"], if_not_exists=True,
+    )
+    op.drop_index("uq_chat_sessions_user_assistant", table_name="chat_sessions", if_exists=True)
@@ -0,0 +1,167 @@
+"""Версии системных промтов вместо копии промта в каждой сессии.
+
+Раньше при открытии сессии system_prompt ассистента записывался в
+chat_messages отдельной строкой role='system' — один и тот же длинный текст
+повторялся в каждой сессии, а правка промта до существующих сессий не доходила.
+Теперь промты хранятся в assistant_prompt_versions, сессия ссылается на версию
+(chat_sessions.prompt_version_id), текст берётся из реестра ассистентов в памяти.
+
+Перенос данных: различные тексты system-сообщений каждого ассистента становятся
+его версиями (в порядке появления, текущий system_prompt — последней),
+сессии получают ссылку на версию своего system-сообщения, а сами
+system-сообщения удаляются. В лог выводится, сколько строк и байт освобождено.
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+# Идентификатор ревизии
+revision = "0007_assistant_prompt_versions"
+down_revision = "0006_chat_sessions_unique"
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+
+def _format_bytes(size: int) -> str:
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024 or unit == "ГБ":
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def _system_rows_size(bind):
+    """(строк, байт) system-сообщений; на Postgres — размер строк целиком, с заголовками."""
+    if bind.dialect.name == "postgresql":
+        size = "pg_column_size(m.*)"
+    else:
+        size = "length(CAST(m.content AS BLOB))"
+    rows, total = bind.execute(sa.text(
+        f"SELECT COUNT(*), COALESCE(SUM({size}), 0) FROM chat_messages m WHERE m.role = 'system'"
+    )).one()
+    return rows, int(total)
+
+
+def create_versions(bind) -> int:
+    """Версии из текстов system-сообщений и текущих промтов; возвращает число созданных."""
+    latest = dict(bind.execute(sa.text(
+        "SELECT assistant_id, MAX(version) FROM assistant_prompt_versions GROUP BY assistant_id"
+    )).all())
+    known = {tuple(r) for r in bind.execute(sa.text(
+        "SELECT assistant_id, system_prompt FROM assistant_prompt_versions"
+    ))}
+
+    prompts = {}
+    for assistant_id, content in bind.execute(sa.text(
+        "SELECT s.assistant_id, m.content FROM chat_messages m "
+        "JOIN chat_sessions s ON s.id = m.session_id "
+        "WHERE m.role = 'system' "
+        "GROUP BY s.assistant_id, m.content ORDER BY s.assistant_id, MIN(m.id)"
+    )):
+        prompts.setdefault(assistant_id, []).append(content)
+    for assistant_id, system_prompt in bind.execute(sa.text("SELECT id, system_prompt FROM assistants")):
+        history = prompts.setdefault(assistant_id, [])
+        # текущий промт — последняя версия, на неё реестр и переведёт сессии
+        if system_prompt in history:
+            history.remove(system_prompt)
+        history.append(system_prompt)
+
+    created = 0
+    for assistant_id, history in prompts.items():
+        version = latest.get(assistant_id) or 0
+        for content in history:
+            if content is None or (assistant_id, content) in known:
+                continue
+            version += 1
+            bind.execute(sa.text(
+                "INSERT INTO assistant_prompt_versions (assistant_id, version, system_prompt, created_at) "
+                "VALUES (:assistant_id, :version, :content, CURRENT_TIMESTAMP)"
+            ), {"assistant_id": assistant_id, "version": version, "content": content})
+            created += 1
+    return created
+
+
+def link_sessions(bind) -> None:
+    # версия первого system-сообщения сессии (по индексу (session_id, id))...
+    bind.execute(sa.text(
+        "UPDATE chat_sessions SET prompt_version_id = ("
+        "  SELECT v.id FROM chat_messages m"
+        "  JOIN assistant_prompt_versions v"
+        "    ON v.assistant_id = chat_sessions.assistant_id AND v.system_prompt = m.content"
+        "  WHERE m.session_id = chat_sessions.id AND m.role = 'system'"
+        "  ORDER BY m.id LIMIT 1"
+        ") WHERE prompt_version_id IS NULL"
+    ))
+    # ...а сессии без system-сообщения получают текущую версию ассистента
+    bind.execute(sa.text(
+        "UPDATE chat_sessions SET prompt_version_id = ("
+        "  SELECT v.id FROM assistant_prompt_versions v"
+        "  WHERE v.assistant_id = chat_sessions.assistant_id"
+        "  ORDER BY v.version DESC LIMIT 1"
+        ") WHERE prompt_version_id IS NULL"
+    ))
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    tables = set(sa.inspect(bind).get_table_names())
+    if "assistant_prompt_versions" not in tables:
+        op.create_table(
+            "assistant_prompt_versions",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("assistant_id", sa.Integer(), sa.ForeignKey("assistants.id"), nullable=False),
+            sa.Column("version", sa.Integer(), nullable=False),
+            sa.Column("system_prompt", sa.Text(), nullable=False),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+        )
+        op.create_index(
+            "uq_assistant_prompt_versions_version", "assistant_prompt_versions",
+            ["assistant_id", "version"], unique=True,
+        )
+    if "chat_sessions" not in tables:
+        return
+    columns = {c["name"] for c in sa.inspect(bind).get_columns("chat_sessions")}
+    if "prompt_version_id" not in columns:
+        # batch: на SQLite внешний ключ добавляется пересозданием таблицы
+        with op.batch_alter_table("chat_sessions") as batch:
+            batch.add_column(sa.Column("prompt_version_id", sa.Integer(), nullable=True))
+            batch.create_foreign_key(
+                "fk_chat_sessions_prompt_version_id", "assistant_prompt_versions",
+                ["prompt_version_id"], ["id"],
+            )
+
+    rows, size = _system_rows_size(bind)
+    table_size = None
+    if bind.dialect.name == "postgresql":
+        table_size = bind.execute(sa.text("SELECT pg_total_relation_size('chat_messages')")).scalar()
+
+    created = create_versions(bind)
+    link_sessions(bind)
+    bind.execute(sa.text("DELETE FROM chat_messages WHERE role = 'system'"))
+
+    logger.info("Создано версий промтов: %d", created)
+    logger.info("Удалено system-сообщений: %d, освобождено %s", rows, _format_bytes(size))
+    if table_size:
+        logger.info(
+            "chat_messages с индексами: %s; место строк переиспользуется после VACUUM, "
+            "вернуть его ОС — VACUUM FULL или pg_repack", _format_bytes(table_size),
+        )
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    tables = set(sa.inspect(bind).get_table_names())
+    if "chat_sessions" in tables:
+        # каждой сессии — снова своя копия промта её версии
+        bind.execute(sa.text(
+            "INSERT INTO chat_messages (session_id, role, content, created_at) "
+            "SELECT s.id, 'system', v.system_prompt, s.created_at FROM chat_sessions s "
+            "JOIN assistant_prompt_versions v ON v.id = s.prompt_version_id"
+        ))
+        with op.batch_alter_table("chat_sessions") as batch:
+            batch.drop_column("prompt_version_id")
+    if "assistant_prompt_versions" in tables:
+        op.drop_index("uq_assistant_prompt_versions_version", table_name="assistant_prompt_versions")
+        op.drop_table("assistant_prompt_versions")
@@ -0,0 +1,41 @@
+"""Модель, ответившая на сообщение, и тариф пользователя.
+
+chat_messages.model — какая модель сформировала ответ ассистента (при выборе
+модели правилами и переключении на запасную при деградации основной).
+user_limits.tier — тариф пользователя, по нему правила extra_config.routing
+ассистента выбирают модель.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# Идентификатор ревизии
+revision = "0008_message_model_user_tier"
+down_revision = "0007_assistant_prompt_versions"
+branch_labels = None
+depends_on = None
+
+_COLUMNS = (
+    ("chat_messages", "model"),
+    ("user_limits", "tier"),
+)
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    for table, column in _COLUMNS:
+        if table not in tables:
+            continue
+        if column not in {c["name"] for c in inspector.get_columns(table)}:
+            op.add_column(table, sa.Column(column, sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    for table, column in _COLUMNS:
+        if table not in tables:
+            continue
+        if column in {c["name"] for c in inspector.get_columns(table)}:
+            with op.batch_alter_table(table) as batch:
+                batch.drop_column(column)
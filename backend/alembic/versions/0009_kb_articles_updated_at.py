@@ -0,0 +1,84 @@
+"""Отслеживание изменений kb_articles для индекса поиска в памяти (app/retrieval.py).
+
+kb_articles.updated_at — время последней правки; по нему процесс
+периодически дочитывает изменённые статьи (и это единственный механизм
+на SQLite). На Postgres триггер сам обновляет updated_at при UPDATE
+(правки прямо в базе тоже видны) и шлёт NOTIFY kb_articles_changed с id
+статьи — воркеры переиндексируют её сразу.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# Идентификатор ревизии
+revision = "0009_kb_articles_updated_at"
+down_revision = "0008_message_model_user_tier"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if "kb_articles" not in set(inspector.get_table_names()):
+        return
+    if "updated_at" not in {c["name"] for c in inspector.get_columns("kb_articles")}:
+        op.add_column("kb_articles", sa.Column("updated_at", sa.DateTime(), nullable=True))
+        op.execute("UPDATE kb_articles SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP)")
+    op.create_index("ix_kb_articles_updated_at", "kb_articles", ["updated_at"], if_not_exists=True)
+
+    if bind.dialect.name != "postgresql":
+        return
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION kb_articles_touch() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := now() AT TIME ZONE 'utc';
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER kb_articles_touch
+        BEFORE UPDATE ON kb_articles
+        FOR EACH ROW EXECUTE FUNCTION kb_articles_touch();
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION notify_kb_articles_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('kb_articles_changed', OLD.id::text);
+            ELSE
+                PERFORM pg_notify('kb_articles_changed', NEW.id::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER kb_articles_changed
+        AFTER INSERT OR UPDATE OR DELETE ON kb_articles
+        FOR EACH ROW EXECUTE FUNCTION notify_kb_articles_changed();
+        """
+    )
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if "kb_articles" not in set(inspector.get_table_names()):
+        return
+    if bind.dialect.name == "postgresql":
+        op.execute("DROP TRIGGER IF EXISTS kb_articles_changed ON kb_articles")
+        op.execute("DROP FUNCTION IF EXISTS notify_kb_articles_changed()")
+        op.execute("DROP TRIGGER IF EXISTS kb_articles_touch ON kb_articles")
+        op.execute("DROP FUNCTION IF EXISTS kb_articles_touch()")
+    op.drop_index("ix_kb_articles_updated_at", table_name="kb_articles", if_exists=True)
+    if "updated_at" in {c["name"] for c in inspector.get_columns("kb_articles")}:
+        with op.batch_alter_table("kb_articles") as batch:
+            batch.drop_column("updated_at")
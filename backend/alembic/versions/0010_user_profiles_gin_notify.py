@@ -0,0 +1,66 @@
+"""Анкеты пользователей (user_profiles) в промте и поиск по ним.
+
+GIN-индекс по data (jsonb_path_ops) — для выборок по анкетам вида
+data @> '{"children": [{"sex": "f"}]}' (queries.profiles_containing).
+Триггер шлёт NOTIFY user_profiles_changed с user_id: воркеры сразу
+перечитывают закэшированный фрагмент анкеты (app/profiles.py).
+Уникальность user_id нужна для upsert анкеты (ON CONFLICT (user_id)).
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# Идентификатор ревизии
+revision = "0010_user_profiles_gin_notify"
+down_revision = "0009_kb_articles_updated_at"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if "user_profiles" not in set(inspector.get_table_names()):
+        return
+    unique = {tuple(c["column_names"]) for c in inspector.get_unique_constraints("user_profiles")}
+    unique |= {tuple(i["column_names"]) for i in inspector.get_indexes("user_profiles") if i.get("unique")}
+    if ("user_id",) not in unique:
+        op.create_index("uq_user_profiles_user_id", "user_profiles", ["user_id"], unique=True)
+
+    if bind.dialect.name != "postgresql":
+        return
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_user_profiles_data ON user_profiles USING gin (data jsonb_path_ops)"
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION notify_user_profiles_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('user_profiles_changed', OLD.user_id::text);
+            ELSE
+                PERFORM pg_notify('user_profiles_changed', NEW.user_id::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER user_profiles_changed
+        AFTER INSERT OR UPDATE OR DELETE ON user_profiles
+        FOR EACH ROW EXECUTE FUNCTION notify_user_profiles_changed();
+        """
+    )
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if "user_profiles" not in set(inspector.get_table_names()):
+        return
+    if bind.dialect.name == "postgresql":
+        op.execute("DROP TRIGGER IF EXISTS user_profiles_changed ON user_profiles")
+        op.execute("DROP FUNCTION IF EXISTS notify_user_profiles_changed()")
+        op.execute("DROP INDEX IF EXISTS ix_user_profiles_data")
+    op.drop_index("uq_user_profiles_user_id", table_name="user_profiles", if_exists=True)
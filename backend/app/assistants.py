@@ -0,0 +1,264 @@
+"""Реестр ассистентов в памяти процесса.
+
+Таблица assistants маленькая и меняется редко, поэтому она целиком загружается
+при старте и индексируется по id и code — горячие пути (/chat/session, /chat/send)
+не обращаются к БД за конфигурацией ассистента.
+
+Системные промты версионируются (assistant_prompt_versions): при загрузке для
+каждого ассистента, чей system_prompt отличается от последней версии,
+создаётся новая. Сессия хранит только id версии, а текст и число токенов
+промта берутся отсюда же, из памяти.
+
+Обновление:
+  * Postgres — LISTEN на канал assistants_changed (триггер из миграции 0004),
+    каждый воркер держит своё соединение-слушатель и перезагружает реестр сразу;
+  * любая БД — периодическая проверка версии (хэш содержимого таблицы) раз в
+    ASSISTANTS_REFRESH_SECONDS как страховка (и единственный механизм для SQLite).
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .context import count_tokens
+from .db import ASYNC_DATABASE_URL, AsyncSessionLocal, dialect_insert
+from .models import Assistant, AssistantPromptVersion
+from .routing import DEFAULT_MODEL
+
+logger = logging.getLogger(__name__)
+
+ASSISTANTS_REFRESH_SECONDS = float(os.getenv("ASSISTANTS_REFRESH_SECONDS", "60"))
+ASSISTANTS_NOTIFY_CHANNEL = "assistants_changed"
+# Не чаще одной внеплановой перезагрузки в секунду при промахах по неизвестному code/id
+_MISS_RELOAD_INTERVAL = 1.0
+# Повторы синхронизации версий, если параллельный воркер создал версию одновременно с нами
+_VERSION_SYNC_ATTEMPTS = 3
+
+
+@dataclass(frozen=True)
+class PromptVersion:
+    """Версия системного промта; для build_context выглядит как system-сообщение истории."""
+    id: int
+    assistant_id: int
+    version: int
+    content: str
+    tokens_used: int
+    role: str = "system"
+
+
+@dataclass(frozen=True)
+class AssistantConfig:
+    id: int
+    code: str
+    title: str
+    description: str
+    base_model: str
+    system_prompt: str
+    extra_config: dict = field(default_factory=dict)
+    prompt_version_id: Optional[int] = None  # текущая версия system_prompt
+
+    @classmethod
+    def from_row(cls, row: Assistant, prompt_version_id: Optional[int] = None) -> "AssistantConfig":
+        return cls(
+            id=row.id,
+            code=row.code,
+            title=row.title,
+            description=row.description,
+            base_model=row.base_model,
+            system_prompt=row.system_prompt,
+            extra_config=dict(row.extra_config or {}),
+            prompt_version_id=prompt_version_id,
+        )
+
+
+@lru_cache(maxsize=1024)
+def _prompt_tokens(version_id: int, model: str, text: str) -> int:
+    # текст версии неизменен: при периодических перезагрузках промт заново не кодируется
+    return count_tokens(text, model)
+
+
+async def _sync_prompt_versions(db: AsyncSession,
+                                rows: Sequence[Assistant]) -> List[AssistantPromptVersion]:
+    """Все версии промтов; для изменённых (и новых) ассистентов создаёт очередную версию."""
+    for _ in range(_VERSION_SYNC_ATTEMPTS):
+        versions = (await db.scalars(
+            select(AssistantPromptVersion)
+            .order_by(AssistantPromptVersion.assistant_id, AssistantPromptVersion.version)
+        )).all()
+        latest = {v.assistant_id: v for v in versions}
+        stale = [r for r in rows
+                 if r.id not in latest or latest[r.id].system_prompt != r.system_prompt]
+        if not stale:
+            return versions
+        for row in stale:
+            # параллельный воркер мог занять этот номер — тогда перечитываем и сравниваем снова
+            await db.execute(
+                dialect_insert(db, AssistantPromptVersion)
+                .values(
+                    assistant_id=row.id,
+                    version=latest[row.id].version + 1 if row.id in latest else 1,
+                    system_prompt=row.system_prompt,
+                    created_at=datetime.utcnow(),
+                )
+                .on_conflict_do_nothing(index_elements=["assistant_id", "version"])
+            )
+        await db.commit()
+        logger.info("Новые версии промтов: %s", ", ".join(r.code for r in stale))
+    raise RuntimeError("Не удалось согласовать версии промтов ассистентов")
+
+
+def _fingerprint(configs) -> str:
+    payload = json.dumps(
+        [[c.id, c.code, c.title, c.description, c.base_model, c.system_prompt, c.extra_config,
+          c.prompt_version_id]
+         for c in sorted(configs, key=lambda c: c.id)],
+        ensure_ascii=False, sort_keys=True, default=str,
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class AssistantRegistry:
+    def __init__(self):
+        self._by_id: Dict[int, AssistantConfig] = {}
+        self._by_code: Dict[str, AssistantConfig] = {}
+        self._prompts: Dict[int, PromptVersion] = {}
+        self.version: Optional[str] = None
+        self.reloads = 0
+        self._last_miss_reload = 0.0
+        self._lock = asyncio.Lock()
+        self._refresher: Optional[asyncio.Task] = None
+        self._listener = None
+        self._pending = set()
+
+    # --- загрузка ---
+
+    async def reload(self) -> bool:
+        """Перечитывает таблицу; возвращает True, если содержимое изменилось."""
+        async with self._lock:
+            async with AsyncSessionLocal() as db:
+                rows = (await db.scalars(select(Assistant))).all()
+                versions = await _sync_prompt_versions(db, rows)
+            current = {v.assistant_id: v.id for v in versions}
+            configs = [AssistantConfig.from_row(r, current.get(r.id)) for r in rows]
+            version = _fingerprint(configs)
+            if version == self.version:
+                return False
+            models = {c.id: c.base_model or DEFAULT_MODEL for c in configs}
+            prompts = {
+                v.id: PromptVersion(
+                    v.id, v.assistant_id, v.version, v.system_prompt,
+                    _prompt_tokens(v.id, models.get(v.assistant_id, DEFAULT_MODEL), v.system_prompt),
+                )
+                for v in versions
+            }
+            # подмена словарей целиком: читатели никогда не видят частично обновлённый реестр
+            self._by_id = {c.id: c for c in configs}
+            self._by_code = {c.code: c for c in configs}
+            self._prompts = prompts
+            self.version = version
+            self.reloads += 1
+            logger.info("Реестр ассистентов обновлён: %d шт., версия %s", len(configs), version[:8])
+            return True
+
+    async def _reload_on_miss(self) -> None:
+        now = time.monotonic()
+        if now - self._last_miss_reload < _MISS_RELOAD_INTERVAL:
+            return
+        self._last_miss_reload = now
+        await self.reload()
+
+    # --- чтение ---
+
+    async def by_code(self, code: str) -> Optional[AssistantConfig]:
+        config = self._by_code.get(code)
+        if config is None:
+            await self._reload_on_miss()
+            config = self._by_code.get(code)
+        return config
+
+    async def by_id(self, assistant_id: int) -> Optional[AssistantConfig]:
+        config = self._by_id.get(assistant_id)
+        if config is None:
+            await self._reload_on_miss()
+            config = self._by_id.get(assistant_id)
+        return config
+
+    async def prompt(self, version_id: int) -> Optional[PromptVersion]:
+        """Версия системного промта по id (из памяти, без обращения к БД)."""
+        prompt = self._prompts.get(version_id)
+        if prompt is None:
+            await self._reload_on_miss()
+            prompt = self._prompts.get(version_id)
+        return prompt
+
+    def all(self):
+        return list(self._by_id.values())
+
+    # --- фоновое обновление ---
+
+    async def start(self) -> None:
+        await self.reload()
+        await self._start_listener()
+        self._refresher = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+        if self._listener is not None:
+            try:
+                await self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(ASSISTANTS_REFRESH_SECONDS)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Не удалось обновить реестр ассистентов")
+
+    async def _start_listener(self) -> None:
+        url = make_url(ASYNC_DATABASE_URL)
+        if url.get_backend_name() != "postgresql":
+            return
+        try:
+            import asyncpg
+
+            dsn = url.set(drivername="postgresql").render_as_string(hide_password=False)
+            self._listener = await asyncpg.connect(dsn)
+            await self._listener.add_listener(ASSISTANTS_NOTIFY_CHANNEL, self._on_notify)
+        except Exception:
+            logger.exception("LISTEN %s недоступен, остаётся периодическая проверка",
+                             ASSISTANTS_NOTIFY_CHANNEL)
+            self._listener = None
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        task = asyncio.get_running_loop().create_task(self._safe_reload())
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _safe_reload(self) -> None:
+        try:
+            await self.reload()
+        except Exception:
+            logger.exception("Не удалось обновить реестр ассистентов по NOTIFY")
+
+
+assistant_registry = AssistantRegistry()
@@ -0,0 +1,97 @@
+"""Открытие чат-сессии пользователя с ассистентом (/chat/session).
+
+У пары (пользователь, ассистент) ровно одна сессия — это держит уникальный
+индекс uq_chat_sessions_user_assistant. Поэтому параллельные первые заходы
+одного пользователя сходятся на одной сессии: вставка проигравшего
+упирается в ON CONFLICT DO NOTHING, и он получает сессию победителя.
+
+Системный промт в сессию не копируется: она ссылается на версию промта
+ассистента (prompt_version_id), текст которой берётся из реестра в памяти.
+
+На Postgres всё делает один запрос (queries.OPEN_SESSION_SQL): новый
+посетитель — один round trip и один commit. На остальных БД (SQLite) —
+те же шаги отдельными запросами в одной транзакции.
+"""
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import queries
+from .db import dialect_insert
+from .models import ChatSession, User
+
+# Повторы, если запрос не увидел строку, вставленную параллельной транзакцией
+_OPEN_ATTEMPTS = 3
+
+
+@dataclass
+class OpenedSession:
+    session_id: str
+    user_id: int
+    created: bool = False  # сессия создана этим запросом (её можно сразу положить в кэш)
+
+
+async def open_session(db: AsyncSession, telegram_id: str, assistant_id: int,
+                       prompt_version_id: Optional[int]) -> OpenedSession:
+    params = {
+        "telegram_id": telegram_id,
+        "assistant_id": assistant_id,
+        "session_id": str(uuid.uuid4()),
+        "prompt_version_id": prompt_version_id,
+        "now": datetime.utcnow(),
+    }
+    open_once = _open_postgres if db.bind.dialect.name == "postgresql" else _open_generic
+    for _ in range(_OPEN_ATTEMPTS):
+        opened = await open_once(db, params)
+        await db.commit()
+        if opened is not None:
+            return opened
+    raise RuntimeError(f"Не удалось открыть сессию для telegram_id={telegram_id}")
+
+
+async def _open_postgres(db: AsyncSession, params: dict) -> Optional[OpenedSession]:
+    row = (await db.execute(queries.OPEN_SESSION_SQL, params)).first()
+    if row is None or row.session_id is None:
+        return None
+    return OpenedSession(row.session_id, row.user_id, bool(row.created))
+
+
+async def ensure_user(db: AsyncSession, telegram_id: str, now: Optional[datetime] = None) -> int:
+    """id пользователя по telegram_id; новый создаётся (без commit), гонка — через ON CONFLICT."""
+    user_id = await db.scalar(select(User.id).where(User.telegram_id == telegram_id))
+    if user_id is None:
+        await db.execute(
+            dialect_insert(db, User)
+            .values(telegram_id=telegram_id, created_at=now or datetime.utcnow())
+            .on_conflict_do_nothing(index_elements=["telegram_id"])
+        )
+        user_id = await db.scalar(select(User.id).where(User.telegram_id == telegram_id))
+    return user_id
+
+
+async def _open_generic(db: AsyncSession, params: dict) -> Optional[OpenedSession]:
+    user_id = await ensure_user(db, params["telegram_id"], params["now"])
+
+    session_id = await db.scalar(queries.user_session(user_id, params["assistant_id"]))
+    if session_id is not None:
+        return OpenedSession(session_id, user_id)
+
+    session_id = await db.scalar(
+        dialect_insert(db, ChatSession)
+        .values(
+            id=params["session_id"],
+            user_id=user_id,
+            assistant_id=params["assistant_id"],
+            prompt_version_id=params["prompt_version_id"],
+            created_at=params["now"],
+        )
+        .on_conflict_do_nothing(index_elements=["user_id", "assistant_id"])
+        .returning(ChatSession.id)
+    )
+    if session_id is None:
+        return None
+    return OpenedSession(session_id, user_id, created=True)
@@ -0,0 +1,126 @@
+"""Сборка контекста (messages) для запроса к модели с ограничением по токенам.
+
+Системный промт закреплён всегда, далее в бюджет укладываются самые свежие
+реплики. Количество токенов каждого сообщения хранится в chat_messages.tokens_used,
+поэтому при каждой отправке текст заново не кодируется.
+"""
+import logging
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# Бюджет контекста по умолчанию; переопределяется в Assistant.extra_config["context_max_tokens"]
+DEFAULT_CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "6000"))
+
+# Служебные токены на каждое сообщение и на «затравку» ответа (формат chat completions)
+TOKENS_PER_MESSAGE = 3
+TOKENS_REPLY_PRIMING = 3
+
+# Кодировка для моделей, которых ещё нет в текущей версии tiktoken (gpt-4.1-* и т.п.)
+FALLBACK_ENCODING = "o200k_base"
+
+
+@lru_cache(maxsize=16)
+def get_encoding(model: str):
+    """Кодировка tiktoken для модели; None, если её не удалось загрузить (нет сети и кэша)."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception as e:
+        logger.warning("tiktoken: кодировка для %s недоступна (%s), используем оценку", model, e)
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    enc = get_encoding(model)
+    if enc is None:
+        # грубая оценка для кириллицы/латиницы: ~3 символа на токен
+        return len(text) // 3 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+class TokenCountCache:
+    """LRU-кэш количества токенов по id сообщения (для строк без tokens_used)."""
+
+    def __init__(self, maxsize: int = 50_000):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[int, int]" = OrderedDict()
+
+    def get(self, key: int) -> Optional[int]:
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def set(self, key: int, value: int) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+token_cache = TokenCountCache()
+
+
+def message_tokens(message, model: str) -> int:
+    """Токены сообщения: из tokens_used, из кэша или (один раз) через tiktoken."""
+    if message.tokens_used is not None:
+        return message.tokens_used
+    cached = token_cache.get(message.id) if message.id is not None else None
+    if cached is not None:
+        return cached
+    tokens = count_tokens(message.content or "", model)
+    if message.id is not None:
+        token_cache.set(message.id, tokens)
+    return tokens
+
+
+def context_budget(extra_config: Optional[dict]) -> int:
+    value = (extra_config or {}).get("context_max_tokens")
+    try:
+        return int(value) if value else DEFAULT_CONTEXT_MAX_TOKENS
+    except (TypeError, ValueError):
+        return DEFAULT_CONTEXT_MAX_TOKENS
+
+
+def build_context(history: Sequence, model: str, budget: int,
+                  extra_system: Sequence[Dict[str, str]] = (),
+                  few_shot: Sequence[Dict[str, str]] = ()) -> Tuple[List[Dict[str, str]], List]:
+    """Собирает messages для модели из истории сессии (в хронологическом порядке).
+
+    system-сообщения истории и extra_system (summary и т.п., идут сразу после
+    системного промта) сохраняются всегда, за ними — пары примеров few_shot;
+    затем с конца добавляются реплики, пока они помещаются в budget. Последнее сообщение (текущий вопрос)
+    включается даже если само по себе превышает бюджет.
+
+    Возвращает (messages, evicted) — evicted это реплики, не попавшие в окно.
+    """
+    pinned = [m for m in history if m.role == "system"]
+    turns = [m for m in history if m.role != "system"]
+
+    used = TOKENS_REPLY_PRIMING
+    used += sum(message_tokens(m, model) + TOKENS_PER_MESSAGE for m in pinned)
+    used += sum(count_tokens(m["content"], model) + TOKENS_PER_MESSAGE for m in (*extra_system, *few_shot))
+
+    selected = []
+    for m in reversed(turns):
+        cost = message_tokens(m, model) + TOKENS_PER_MESSAGE
+        if selected and used + cost > budget:
+            break
+        selected.append(m)
+        used += cost
+    selected.reverse()
+    evicted = turns[:len(turns) - len(selected)]
+
+    messages = [{"role": m.role, "content": m.content} for m in pinned]
+    messages.extend(extra_system)
+    messages.extend(few_shot)
+    messages.extend({"role": m.role, "content": m.content} for m in selected)
+    return messages, evicted
@@ -0,0 +1,94 @@
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# ----------------------------
+# Database setup
+# ----------------------------
+
+DATABASE_URL = os.getenv(
+    "DATABASE_URL",
+    "postgresql+psycopg2://motherschat:motherschat_password@db:5432/motherschat",
+)
+
+# Асинхронные драйверы для тех же БД, что и в DATABASE_URL
+_ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def to_async_url(url: str) -> str:
+    """Переводит sync-URL (psycopg2/sqlite) на async-драйвер (asyncpg/aiosqlite)."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if parsed.drivername in _ASYNC_DRIVERS.values() or backend not in _ASYNC_DRIVERS:
+        return url
+    return parsed.set(drivername=_ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", to_async_url(DATABASE_URL))
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+
+
+def _pool_kwargs(url: str) -> dict:
+    kwargs = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW}
+    # sqlite (тесты/бенчмарки): увеличенный timeout сглаживает конкурентные записи в один файл
+    if make_url(url).get_backend_name() == "sqlite":
+        kwargs["connect_args"] = {"timeout": 30}
+        kwargs["poolclass"] = AsyncAdaptedQueuePool
+    else:
+        kwargs["pool_pre_ping"] = True
+    return kwargs
+
+
+# Основной движок приложения — асинхронный: запросы к БД не занимают потоки threadpool
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_pool_kwargs(ASYNC_DATABASE_URL))
+
+if async_engine.dialect.name == "sqlite":
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL: читатели не блокируют писателя при конкурентных запросах
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+# Синхронный движок оставлен для alembic и служебных скриптов
+engine = create_engine(DATABASE_URL)
+SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+Base = declarative_base()
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def create_tables() -> None:
+    """Создаёт недостающие таблицы (users, chat_sessions, chat_messages)."""
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+def dialect_insert(db: AsyncSession, model):
+    """insert() диалекта сессии — с on_conflict_do_nothing/do_update (Postgres и SQLite)."""
+    if db.bind.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert(model)
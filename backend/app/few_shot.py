@@ -0,0 +1,273 @@
+"""Подбор примеров (few-shot) из kb_examples под вопрос пользователя.
+
+Примеры ассистента (kb_examples.assistant_id; NULL — общие для всех) держатся
+в памяти процесса: для каждого ассистента заранее построен маленький
+обратный индекс по вопросам примеров (основа слова -> пример с весом BM25,
+не больше _SEARCH_DEPTH лучших на основу), поэтому время выбора не растёт
+с размером библиотеки примеров.
+
+На /chat/send выбираются до max_examples лучших примеров, пока они
+укладываются в max_tokens (extra_config["few_shot"] ассистента), и
+добавляются в контекст парами user/assistant после системного промта —
+самый близкий пример последним, перед репликами сессии. Пример, у которого
+с вопросом нет ни одной общей основы, не берётся. Ассистент со своими
+примерами получает их (вместе с общими) по умолчанию, ассистент без своих —
+общие, если few_shot задан явно; "few_shot": false — выключено.
+
+Выбор мемоизируется по «форме» вопроса — множеству значимых основ:
+порядок слов, словоформы, регистр, знаки и стоп-слова на выбор не влияют,
+и частые вопросы индекс не трогают. Одинаковая форма даёт одинаковые
+примеры в одинаковом порядке — промт стабилен.
+
+kb_examples небольшая и без updated_at: раз в FEW_SHOT_REFRESH_SECONDS она
+перечитывается целиком; индексы пересобираются и кэш выбора сбрасывается,
+только если содержимое изменилось.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from heapq import nsmallest
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select
+
+from .context import TOKENS_PER_MESSAGE, count_tokens
+from .db import AsyncSessionLocal
+from .models import KbExample
+from .routing import DEFAULT_MODEL
+from .stemmer import analyze
+
+logger = logging.getLogger(__name__)
+
+# 0 — примеры не загружаются и в контекст не попадают
+FEW_SHOT = os.getenv("FEW_SHOT", "1") != "0"
+FEW_SHOT_REFRESH_SECONDS = float(os.getenv("FEW_SHOT_REFRESH_SECONDS", "60"))
+FEW_SHOT_CACHE_SIZE = int(os.getenv("FEW_SHOT_CACHE_SIZE", "10000"))
+FEW_SHOT_DEFAULT_EXAMPLES = 3
+FEW_SHOT_DEFAULT_MAX_TOKENS = 600
+
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+_RANK_OVERSAMPLE = 8
+# сколько лучших примеров хранится на основу: частые слова почти не влияют на порядок,
+# а время выбора не растёт с библиотекой
+_SEARCH_DEPTH = 64
+
+
+@dataclass(frozen=True)
+class FewShotSettings:
+    """extra_config["few_shot"] ассистента: true/false или {"max_examples", "max_tokens"}."""
+    max_examples: int = FEW_SHOT_DEFAULT_EXAMPLES
+    max_tokens: int = FEW_SHOT_DEFAULT_MAX_TOKENS
+
+    @classmethod
+    def from_config(cls, extra_config: Optional[dict]) -> Optional["FewShotSettings"]:
+        value = (extra_config or {}).get("few_shot", True)
+        if not value:
+            return None
+        if not isinstance(value, dict):
+            return cls()
+        try:
+            return cls(
+                max_examples=int(value.get("max_examples") or FEW_SHOT_DEFAULT_EXAMPLES),
+                max_tokens=int(value.get("max_tokens") or FEW_SHOT_DEFAULT_MAX_TOKENS),
+            )
+        except (TypeError, ValueError):
+            logger.warning("Некорректный extra_config.few_shot: %r — используются значения по умолчанию", value)
+            return cls()
+
+
+@dataclass(frozen=True)
+class Example:
+    id: int
+    assistant_id: Optional[int]
+    question: str
+    answer: str
+    # пара сообщений целиком, по кодировке DEFAULT_MODEL
+    tokens: int
+
+
+EMPTY: Tuple[Example, ...] = ()
+
+
+def few_shot_messages(examples: Sequence[Example]) -> List[Dict[str, str]]:
+    messages = []
+    for example in examples:
+        messages.append({"role": "user", "content": example.question})
+        messages.append({"role": "assistant", "content": example.answer})
+    return messages
+
+
+class ExampleIndex:
+    """Примеры одного ассистента (свои и общие) и обратный индекс по их вопросам."""
+
+    def __init__(self, examples: Sequence[Example]):
+        self.examples = list(examples)
+        self.postings: Dict[str, List[Tuple[int, float]]] = {}
+        docs = [analyze(e.question) for e in self.examples]
+        avgdl = sum(len(d) for d in docs) / len(docs) if docs else 1.0
+        frequencies: Dict[str, Dict[int, int]] = {}
+        for number, terms in enumerate(docs):
+            for term in terms:
+                counts = frequencies.setdefault(term, {})
+                counts[number] = counts.get(number, 0) + 1
+        for term, counts in frequencies.items():
+            idf = math.log(1 + (len(docs) - len(counts) + 0.5) / (len(counts) + 0.5))
+            weights = [
+                (number, idf * tf * (_BM25_K1 + 1)
+                 / (tf + _BM25_K1 * (1 - _BM25_B + _BM25_B * len(docs[number]) / (avgdl or 1.0))))
+                for number, tf in counts.items()
+            ]
+            # по убыванию веса: при выборе читается только начало списка
+            weights.sort(key=lambda item: (-item[1], self.examples[item[0]].id))
+            self.postings[term] = weights[:_SEARCH_DEPTH]
+
+    def rank(self, terms: FrozenSet[str], limit: int) -> List[Tuple[float, int]]:
+        """До limit пар (счёт, номер примера) по убыванию счёта, при равенстве — по id примера."""
+        scores: Dict[int, float] = {}
+        for term in terms:
+            for number, weight in self.postings.get(term, ()):
+                scores[number] = scores.get(number, 0.0) + weight
+        return nsmallest(limit, ((s, n) for n, s in scores.items()),
+                         key=lambda item: (-item[0], self.examples[item[1]].id))
+
+
+class FewShotSelector:
+    def __init__(self):
+        self.enabled = FEW_SHOT
+        self.digest: Optional[str] = None
+        self.examples = 0
+        self.reloads = 0
+        self.hits = 0
+        self.misses = 0
+        self.select_seconds = 0.0
+        # assistant_id -> индекс; None — только общие примеры
+        self._indexes: Dict[Optional[int], ExampleIndex] = {}
+        self._memo: "OrderedDict[tuple, Tuple[Example, ...]]" = OrderedDict()
+        self._refresher: Optional[asyncio.Task] = None
+
+    # --- загрузка ---
+
+    async def reload(self) -> bool:
+        """Перечитывает kb_examples; True, если примеры изменились."""
+        async with AsyncSessionLocal() as db:
+            rows = (await db.scalars(select(KbExample).order_by(KbExample.id))).all()
+            rows = [(r.id, r.assistant_id, r.question_example, r.answer_example) for r in rows]
+        digest = hashlib.sha1(repr(rows).encode("utf-8")).hexdigest()
+        if digest == self.digest:
+            return False
+        self.install([
+            Example(id_, assistant_id, question, answer,
+                    count_tokens(question, DEFAULT_MODEL) + count_tokens(answer, DEFAULT_MODEL)
+                    + 2 * TOKENS_PER_MESSAGE)
+            for id_, assistant_id, question, answer in rows
+        ])
+        self.digest = digest
+        return True
+
+    def install(self, examples: Sequence[Example]) -> None:
+        """Строит индексы по ассистентам и сбрасывает кэш выбора."""
+        shared = [e for e in examples if e.assistant_id is None]
+        owned: Dict[Optional[int], List[Example]] = {}
+        for example in examples:
+            if example.assistant_id is not None:
+                owned.setdefault(example.assistant_id, []).append(example)
+        indexes = {assistant_id: ExampleIndex(own + shared) for assistant_id, own in owned.items()}
+        indexes[None] = ExampleIndex(shared)
+        self._indexes = indexes
+        self._memo.clear()
+        self.examples = len(examples)
+        self.reloads += 1
+        logger.info("Примеры few-shot: %d (ассистентов со своими примерами: %d)", len(examples), len(owned))
+
+    # --- выбор ---
+
+    def select(self, assistant, question: str) -> Tuple[Example, ...]:
+        """Примеры для вопроса к ассистенту (AssistantConfig) в порядке для контекста."""
+        if not self.enabled:
+            return EMPTY
+        settings = FewShotSettings.from_config(assistant.extra_config)
+        if settings is None:
+            return EMPTY
+        index = self._indexes.get(assistant.id)
+        if index is None and (assistant.extra_config or {}).get("few_shot"):
+            # ассистенту без своих примеров общие достаются, только если few_shot включён явно
+            index = self._indexes.get(None)
+        if index is None or not index.examples:
+            return EMPTY
+        started = time.perf_counter()
+        shape = frozenset(analyze(question))
+        key = (assistant.id, shape, settings)
+        chosen = self._memo.get(key)
+        if chosen is not None:
+            self._memo.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            chosen = self._choose(index, shape, settings)
+            self._memo[key] = chosen
+            if len(self._memo) > FEW_SHOT_CACHE_SIZE:
+                self._memo.popitem(last=False)
+        self.select_seconds += time.perf_counter() - started
+        return chosen
+
+    @staticmethod
+    def _choose(index: ExampleIndex, shape: FrozenSet[str], settings: FewShotSettings) -> Tuple[Example, ...]:
+        chosen, used = [], 0
+        # с запасом: длинные примеры могут не поместиться в max_tokens
+        for _, number in index.rank(shape, settings.max_examples * _RANK_OVERSAMPLE):
+            example = index.examples[number]
+            if used + example.tokens > settings.max_tokens:
+                continue
+            chosen.append(example)
+            used += example.tokens
+            if len(chosen) >= settings.max_examples:
+                break
+        # самый близкий — последним, ближе к вопросу
+        return tuple(reversed(chosen))
+
+    # --- фоновое обновление ---
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        try:
+            await self.reload()
+        except Exception:
+            logger.exception("Не удалось загрузить примеры few-shot")
+        self._refresher = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(FEW_SHOT_REFRESH_SECONDS)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Не удалось обновить примеры few-shot")
+
+    async def stop(self) -> None:
+        if self._refresher is not None:
+            self._refresher.cancel()
+            await asyncio.gather(self._refresher, return_exceptions=True)
+            self._refresher = None
+
+    def stats(self) -> dict:
+        selections = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "examples": self.examples,
+            "assistants": len(self._indexes) - 1 if self._indexes else 0,
+            "reloads": self.reloads,
+            "cached": len(self._memo),
+            "hits": self.hits,
+            "misses": self.misses,
+            "avg_select_ms": round(self.select_seconds / selections * 1000, 3) if selections else 0.0,
+        }
+
+
+few_shot_selector = FewShotSelector()
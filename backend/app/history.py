@@ -0,0 +1,62 @@
+"""Постраничное чтение истории чата (keyset по chat_messages.id) и ETag.
+
+Курсоры:
+  * before_id — реплики старше before_id (листание вверх), самые новые из них;
+  * after_id  — реплики новее after_id (дельта: то, чего ещё нет у клиента);
+  * без курсора — последние limit реплик (или вся история, если limit не задан).
+
+system-сообщения отфильтровываются в SQL. ETag строится по id последнего
+сообщения сессии, поэтому неизменившаяся история отдаётся как 304 без чтения
+строк сообщений.
+"""
+from bisect import bisect_left, bisect_right
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import queries
+from .models import ChatMessage
+
+HISTORY_MAX_LIMIT = 500
+
+
+async def last_message_id(db: AsyncSession, session_id: str) -> Optional[int]:
+    return await db.scalar(queries.last_message_id(session_id))
+
+
+def cached_last_message_id(entry) -> Optional[int]:
+    return entry.messages[-1].id if entry.messages else None
+
+
+def make_etag(session_id: str, last_id: Optional[int], before_id: Optional[int],
+              after_id: Optional[int], limit: Optional[int]) -> str:
+    return f'W/"{session_id}:{last_id or 0}:{before_id or ""}:{after_id or ""}:{limit or ""}"'
+
+
+async def load_page(db: AsyncSession, session_id: str, before_id: Optional[int] = None,
+                    after_id: Optional[int] = None,
+                    limit: Optional[int] = None) -> Tuple[List[ChatMessage], bool]:
+    """Страница реплик (без system) по возрастанию id и флаг has_more."""
+    query = queries.history_page(session_id, before_id, after_id, limit)
+    forward = after_id is not None and before_id is None
+
+    rows = list(await db.scalars(query))
+    has_more = limit is not None and len(rows) > limit
+    rows = rows[:limit] if limit is not None else rows
+    if not forward:
+        rows.reverse()
+    return rows, has_more
+
+
+def page_from_cache(messages: Sequence, before_id: Optional[int] = None,
+                    after_id: Optional[int] = None,
+                    limit: Optional[int] = None) -> Tuple[list, bool]:
+    """То же, что load_page, но по полному хвосту из кэша сессий (отсортирован по id)."""
+    ids = [m.id for m in messages]
+    lo = bisect_right(ids, after_id) if after_id is not None else 0
+    hi = bisect_left(ids, before_id) if before_id is not None else len(ids)
+    window = list(messages[lo:hi])
+    if limit is None or len(window) <= limit:
+        return window, False
+    forward = after_id is not None and before_id is None
+    return (window[:limit] if forward else window[-limit:]), True
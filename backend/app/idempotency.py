@@ -0,0 +1,218 @@
+"""Идемпотентность /chat/send и последовательная обработка сообщений сессии.
+
+Двойное нажатие «Отправить» и повторы запроса при плохой связи не должны
+порождать вторую реплику пользователя и второй (платный) вызов модели:
+  * SessionLocks — блокировка на сессию: сообщения одной сессии обрабатываются
+    по очереди, история не перемешивается. Дубликат, пришедший во время
+    генерации, ждёт её окончания на этой блокировке;
+  * IdempotencyStore — результат хода по ключу Idempotency-Key (заголовок или
+    поле idempotency_key) на IDEMPOTENCY_TTL секунд: повтор с тем же ключом
+    получает сохранённый ответ, не обращаясь к модели. До ответа под ключом
+    лежит id уже сохранённого сообщения пользователя ({"user_message_id"}):
+    повтор после сбоя модели не пишет его второй раз, а только заново
+    генерирует ответ.
+
+Без Redis всё живёт в памяти процесса; с REDIS_URL блокировка и результаты
+общие для воркеров. Блокировка — аренда на SESSION_LOCK_TTL секунд: если
+держатель завис или упал, она освобождается сама. Перед тем как отдать
+блокировку в Redis другому процессу, вызывается before_release (ожидание
+записи отложенных сообщений сессии, см. message_writer).
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from .redis_client import ping_redis
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_MAX_KEY_LENGTH = 200
+SESSION_LOCK_TTL = float(os.getenv("SESSION_LOCK_TTL", "180"))
+SESSION_LOCK_WAIT = float(os.getenv("SESSION_LOCK_WAIT", "120"))
+_MEMORY_RESULTS_SIZE = 10000
+_REDIS_POLL_INTERVAL = 0.05
+
+
+class SessionBusy(Exception):
+    """Не дождались блокировки сессии за SESSION_LOCK_WAIT секунд."""
+
+
+# ----------------------------
+# Блокировка сессии
+# ----------------------------
+
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+
+class SessionLock:
+    """Удерживаемая блокировка; release() можно вызывать повторно."""
+
+    def __init__(self, locks: "SessionLocks", session_id: str, token: str, remote: bool):
+        self._locks = locks
+        self.session_id = session_id
+        self.token = token
+        self.remote = remote
+        self.released = False
+
+    async def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        await self._locks._release(self)
+
+
+class SessionLocks:
+    def __init__(self, ttl: float = SESSION_LOCK_TTL, wait: float = SESSION_LOCK_WAIT):
+        self.ttl = ttl
+        self.wait = wait
+        self.contended = 0
+        self._held: Dict[str, Tuple[str, float]] = {}
+        self._released: Dict[str, asyncio.Event] = {}
+        self._redis = None
+        self._release_script = None
+        # вызывается с session_id перед снятием блокировки в Redis
+        self.before_release: Optional[Callable[[str], Awaitable[None]]] = None
+
+    @property
+    def distributed(self) -> bool:
+        """True — блокировка общая для процессов (Redis)."""
+        return self._redis is not None
+
+    async def start(self) -> None:
+        client = await ping_redis()
+        if client is not None:
+            self._redis = client
+            self._release_script = client.register_script(_RELEASE_LUA)
+
+    async def acquire(self, session_id: str) -> SessionLock:
+        deadline = time.monotonic() + self.wait
+        token = uuid.uuid4().hex
+        # сначала локальная аренда: в Redis за сессию борется не больше одного запроса процесса
+        await self._acquire_local(session_id, token, deadline)
+        if self._redis is None:
+            return SessionLock(self, session_id, token, remote=False)
+        try:
+            await self._acquire_redis(session_id, token, deadline)
+        except SessionBusy:
+            self._release_local(session_id, token)
+            raise
+        except Exception:
+            logger.exception("Блокировка сессии в Redis недоступна, действует только локальная")
+            return SessionLock(self, session_id, token, remote=False)
+        return SessionLock(self, session_id, token, remote=True)
+
+    async def _acquire_local(self, session_id: str, token: str, deadline: float) -> None:
+        waited = False
+        while True:
+            now = time.monotonic()
+            holder = self._held.get(session_id)
+            if holder is None or holder[1] <= now:
+                self._held[session_id] = (token, now + self.ttl)
+                return
+            if not waited:
+                waited = True
+                self.contended += 1
+            timeout = min(deadline, holder[1]) - now
+            if deadline <= now:
+                raise SessionBusy(session_id)
+            event = self._released.setdefault(session_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire_redis(self, session_id: str, token: str, deadline: float) -> None:
+        key = f"lock:session:{session_id}"
+        while not await self._redis.set(key, token, nx=True, px=int(self.ttl * 1000)):
+            if time.monotonic() >= deadline:
+                raise SessionBusy(session_id)
+            await asyncio.sleep(_REDIS_POLL_INTERVAL)
+
+    def _release_local(self, session_id: str, token: str) -> None:
+        holder = self._held.get(session_id)
+        if holder is not None and holder[0] == token:
+            del self._held[session_id]
+        event = self._released.pop(session_id, None)
+        if event is not None:
+            event.set()
+
+    async def _release(self, lock: SessionLock) -> None:
+        if lock.remote:
+            if self.before_release is not None:
+                try:
+                    await asyncio.wait_for(self.before_release(lock.session_id), self.ttl)
+                except Exception:
+                    logger.exception("Не дождались записи сообщений сессии %s перед снятием блокировки",
+                                     lock.session_id)
+            try:
+                await self._release_script(keys=[f"lock:session:{lock.session_id}"], args=[lock.token])
+            except Exception:
+                logger.exception("Не удалось снять блокировку сессии %s в Redis", lock.session_id)
+        self._release_local(lock.session_id, lock.token)
+
+
+# ----------------------------
+# Результаты по ключу идемпотентности
+# ----------------------------
+
+class IdempotencyStore:
+    def __init__(self, ttl: int = IDEMPOTENCY_TTL):
+        self.ttl = ttl
+        self.replays = 0
+        self._memory: "OrderedDict[str, Tuple[dict, float]]" = OrderedDict()
+        self._redis = None
+
+    async def start(self) -> None:
+        self._redis = await ping_redis()
+
+    @staticmethod
+    def _key(session_id: str, key: str) -> str:
+        return f"idem:{session_id}:{key}"
+
+    async def get(self, session_id: str, key: str) -> Optional[dict]:
+        name = self._key(session_id, key)
+        result = None
+        if self._redis is not None:
+            try:
+                raw = await self._redis.get(name)
+                result = json.loads(raw) if raw else None
+            except Exception:
+                logger.exception("Хранилище ключей идемпотентности в Redis недоступно")
+        if result is None:
+            item = self._memory.get(name)
+            if item is not None and item[1] > time.monotonic():
+                result = item[0]
+        if result is not None and "reply" in result:
+            self.replays += 1
+        return result
+
+    async def put(self, session_id: str, key: str, result: dict) -> None:
+        name = self._key(session_id, key)
+        self._memory[name] = (result, time.monotonic() + self.ttl)
+        self._memory.move_to_end(name)
+        while len(self._memory) > _MEMORY_RESULTS_SIZE:
+            self._memory.popitem(last=False)
+        if self._redis is not None:
+            try:
+                await self._redis.set(name, json.dumps(result, ensure_ascii=False), ex=self.ttl)
+            except Exception:
+                logger.exception("Не удалось сохранить результат по ключу идемпотентности")
+
+
+def idempotency_key(header: Optional[str], field: Optional[str]) -> Optional[str]:
+    """Ключ из заголовка Idempotency-Key или поля запроса (заголовок важнее)."""
+    key = (header or field or "").strip()
+    return key[:IDEMPOTENCY_MAX_KEY_LENGTH] or None
+
+
+session_locks = SessionLocks()
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,505 @@
+"""Очередь фоновой генерации ответов (асинхронный режим /chat/send).
+
+В асинхронном режиме (поле background, заголовок Prefer: respond-async или
+CHAT_SEND_BACKGROUND=1 по умолчанию) /chat/send сохраняет сообщение
+пользователя, ставит задание и сразу отвечает 202 с job_id. Ответ модели
+получает и сохраняет воркер; клиент узнаёт результат опросом
+GET /chat/jobs/{job_id} (wait — долгий опрос) или подпиской на SSE
+GET /chat/jobs/{job_id}/events. Обрыв HTTP-соединения или рестарт API
+ответ больше не теряют.
+
+Хранилища:
+  * Redis (если задан REDIS_URL) — очередь общая для процессов. Воркер
+    переносит задание в список jobs:processing и держит аренду
+    job:lease:{id} на JOB_LEASE_SECONDS, продлевая её, пока идёт генерация.
+    Если процесс упал, аренда истекает, и любой воркер возвращает задание
+    в очередь — не больше JOB_MAX_ATTEMPTS попыток;
+  * иначе — очередь в памяти процесса (один процесс, локальный запуск и
+    проверки); при рестарте незавершённые задания теряются.
+
+Пока задание сессии не завершено, новые сообщения в эту сессию получают 409:
+иначе контекст следующего ответа не содержал бы предыдущего.
+
+Воркеры — JOB_WORKERS задач в каждом процессе приложения. Генерацию можно
+вынести в отдельные процессы и масштабировать независимо от API:
+
+    JOB_WORKERS=16 python -m backend.worker
+
+а у процессов API поставить JOB_WORKERS=0.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from .llm_client import LLMError
+from .metrics import CHAT_JOB_WAIT_SECONDS, CHAT_JOBS
+from .redis_client import ping_redis
+
+logger = logging.getLogger(__name__)
+
+CHAT_SEND_BACKGROUND = os.getenv("CHAT_SEND_BACKGROUND", "0") == "1"
+# memory — очередь процесса даже при заданном REDIS_URL
+JOB_QUEUE = os.getenv("JOB_QUEUE", "")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+JOB_DRAIN_TIMEOUT = float(os.getenv("JOB_DRAIN_TIMEOUT", "30"))
+# долгий опрос GET /chat/jobs/{id}?wait= и keep-alive подписки на SSE (сек)
+JOB_MAX_WAIT = 30.0
+JOB_KEEPALIVE_SECONDS = 15.0
+_MEMORY_JOBS_SIZE = 10000
+# ожидание результата: Redis опрашивается с этим интервалом
+_WAIT_POLL_INTERVAL = 0.2
+_CLAIM_TIMEOUT = 1.0
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+@dataclass
+class Job:
+    id: str
+    session_id: str
+    assistant_id: int
+    assistant_code: str
+    model: str                    # модель, выбранная правилами (routing.Route.model)
+    candidates: List[str]         # порядок моделей для попыток
+    reason: str
+    messages: List[dict]          # контекст для модели, собранный API
+    user_message_id: Optional[int] = None
+    cache_key: Optional[str] = None
+    idempotency_key: Optional[str] = None
+    status: str = QUEUED
+    attempts: int = 0
+    result: Optional[dict] = None  # {"reply", "message_id", "created_at", "model"}
+    error: Optional[dict] = None   # {"detail", "status", "retry_after"}
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    @classmethod
+    def new(cls, **fields) -> "Job":
+        return cls(id=uuid.uuid4().hex, **fields)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, raw: str) -> "Job":
+        return cls(**json.loads(raw))
+
+
+Handler = Callable[[Job], Awaitable[dict]]
+
+
+# ----------------------------
+# Хранилища заданий
+# ----------------------------
+
+class MemoryJobs:
+    """Очередь и задания в памяти процесса."""
+
+    def __init__(self):
+        self._jobs: "OrderedDict[str, Tuple[Job, float]]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._sessions: Dict[str, str] = {}
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        # очередь создаётся в работающем event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    def _store(self, job: Job, ttl: float) -> None:
+        self._jobs[job.id] = (job, time.monotonic() + ttl)
+        self._jobs.move_to_end(job.id)
+        while len(self._jobs) > _MEMORY_JOBS_SIZE:
+            old, _ = next(iter(self._jobs.values()))
+            if not old.finished:
+                break  # незавершённые не вытесняем
+            self._jobs.popitem(last=False)
+
+    async def put(self, job: Job) -> None:
+        self._store(job, JOB_RESULT_TTL)
+        self._sessions[job.session_id] = job.id
+        self.queue.put_nowait(job.id)
+
+    async def claim(self, timeout: float) -> Optional[Job]:
+        try:
+            job_id = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        job = await self.get(job_id)
+        if job is None:
+            return None
+        job.attempts += 1
+        job.status = RUNNING
+        return job
+
+    async def extend(self, job: Job) -> None:
+        pass  # процесс один: аренда не нужна
+
+    async def finish(self, job: Job) -> None:
+        self._store(job, JOB_RESULT_TTL)
+        if self._sessions.get(job.session_id) == job.id:
+            del self._sessions[job.session_id]
+
+    async def release(self, job: Job) -> None:
+        job.status = QUEUED
+        self.queue.put_nowait(job.id)
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        item = self._jobs.get(job_id)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self._jobs[job_id]
+            return None
+        return item[0]
+
+    async def active(self, session_id: str) -> Optional[str]:
+        return self._sessions.get(session_id)
+
+    async def recover(self) -> int:
+        return 0
+
+    async def depth(self) -> int:
+        return self.queue.qsize()
+
+
+# итог задания, снятие аренды и отметки «в сессии идёт генерация» — атомарно
+_FINISH_LUA = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('LREM', KEYS[2], 1, ARGV[3])
+redis.call('DEL', KEYS[3])
+if redis.call('GET', KEYS[4]) == ARGV[3] then redis.call('DEL', KEYS[4]) end
+return 1
+"""
+
+# возврат задания в голову очереди: при остановке воркера (ARGV[2] — новая запись)
+# или после истечения аренды (без ARGV[2]; только если аренда так и не появилась)
+_REQUEUE_LUA = """
+if redis.call('EXISTS', KEYS[3]) == 1 and not ARGV[2] then return 0 end
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then return 0 end
+if ARGV[2] then redis.call('SET', KEYS[4], ARGV[2], 'KEEPTTL') end
+redis.call('DEL', KEYS[3])
+redis.call('RPUSH', KEYS[2], ARGV[1])
+return 1
+"""
+
+
+class RedisJobs:
+    """Очередь в Redis: LPUSH в jobs:queue, забор — BLMOVE в jobs:processing."""
+
+    def __init__(self, client, lease_seconds: float = JOB_LEASE_SECONDS, prefix: str = ""):
+        self.client = client
+        self.lease_ms = int(lease_seconds * 1000)
+        self.prefix = prefix
+        self.queue_key = f"{prefix}jobs:queue"
+        self.processing_key = f"{prefix}jobs:processing"
+        self._finish = client.register_script(_FINISH_LUA)
+        self._requeue = client.register_script(_REQUEUE_LUA)
+        # задания без аренды при прошлом обходе: между BLMOVE и установкой аренды
+        # проходит мгновение, поэтому в очередь возвращаются только при повторной встрече
+        self._suspects: Set[str] = set()
+
+    def _key(self, job_id: str) -> str:
+        return f"{self.prefix}job:{job_id}"
+
+    def _lease_key(self, job_id: str) -> str:
+        return f"{self.prefix}job:lease:{job_id}"
+
+    def _session_key(self, session_id: str) -> str:
+        return f"{self.prefix}job:session:{session_id}"
+
+    async def put(self, job: Job) -> None:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.set(self._key(job.id), job.to_json(), ex=JOB_RESULT_TTL)
+            pipe.set(self._session_key(job.session_id), job.id, ex=JOB_RESULT_TTL)
+            pipe.lpush(self.queue_key, job.id)
+            await pipe.execute()
+
+    async def claim(self, timeout: float) -> Optional[Job]:
+        job_id = await self.client.blmove(self.queue_key, self.processing_key, timeout, "RIGHT", "LEFT")
+        if job_id is None:
+            return None
+        job = await self.get(job_id)
+        if job is None:
+            # запись истекла — задание брошено
+            await self.client.lrem(self.processing_key, 1, job_id)
+            return None
+        job.attempts += 1
+        job.status = RUNNING
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.set(self._lease_key(job.id), 1, px=self.lease_ms)
+            pipe.set(self._key(job.id), job.to_json(), keepttl=True)
+            await pipe.execute()
+        return job
+
+    async def extend(self, job: Job) -> None:
+        await self.client.set(self._lease_key(job.id), 1, px=self.lease_ms)
+
+    async def finish(self, job: Job) -> None:
+        await self._finish(
+            keys=[self._key(job.id), self.processing_key, self._lease_key(job.id),
+                  self._session_key(job.session_id)],
+            args=[job.to_json(), JOB_RESULT_TTL, job.id],
+        )
+
+    async def release(self, job: Job) -> None:
+        job.status = QUEUED
+        await self._requeue(
+            keys=[self.processing_key, self.queue_key, self._lease_key(job.id), self._key(job.id)],
+            args=[job.id, job.to_json()],
+        )
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        raw = await self.client.get(self._key(job_id))
+        return Job.from_json(raw) if raw else None
+
+    async def active(self, session_id: str) -> Optional[str]:
+        return await self.client.get(self._session_key(session_id))
+
+    async def recover(self) -> int:
+        """Возвращает в очередь задания упавших воркеров (аренда истекла)."""
+        processing = await self.client.lrange(self.processing_key, 0, -1)
+        if not processing:
+            self._suspects = set()
+            return 0
+        async with self.client.pipeline(transaction=False) as pipe:
+            for job_id in processing:
+                pipe.exists(self._lease_key(job_id))
+            leased = await pipe.execute()
+        orphans = {job_id for job_id, has_lease in zip(processing, leased) if not has_lease}
+        requeued = 0
+        for job_id in orphans & self._suspects:
+            requeued += await self._requeue(
+                keys=[self.processing_key, self.queue_key, self._lease_key(job_id), self._key(job_id)],
+                args=[job_id],
+            )
+        self._suspects = orphans - self._suspects
+        return requeued
+
+    async def depth(self) -> int:
+        return await self.client.llen(self.queue_key)
+
+
+# ----------------------------
+# Очередь и воркеры
+# ----------------------------
+
+class JobQueue:
+    def __init__(self, workers: int = JOB_WORKERS, max_attempts: int = JOB_MAX_ATTEMPTS,
+                 lease_seconds: float = JOB_LEASE_SECONDS):
+        self.backend = MemoryJobs()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self._handler: Optional[Handler] = None
+        self._tasks: List[asyncio.Task] = []
+        self._reaper: Optional[asyncio.Task] = None
+        self._running: Dict[str, Tuple[Job, asyncio.Task]] = {}
+        self._finished: Dict[str, asyncio.Event] = {}
+        self._stopping = False
+        # метрики
+        self.enqueued = 0
+        self.completed = 0
+        self.failed = 0
+        self.recovered = 0
+
+    @property
+    def backend_name(self) -> str:
+        return "redis" if isinstance(self.backend, RedisJobs) else "memory"
+
+    async def start(self, handler: Optional[Handler] = None, backend=None) -> None:
+        """Выбор хранилища (backend — заданное явно); с handler и JOB_WORKERS > 0 — запуск воркеров."""
+        if backend is not None:
+            self.backend = backend
+        elif JOB_QUEUE != "memory":
+            client = await ping_redis()
+            if client is not None:
+                self.backend = RedisJobs(client, self.lease_seconds)
+        self._stopping = False
+        if handler is not None and self.workers > 0:
+            self._handler = handler
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+            self._reaper = asyncio.create_task(self._reap_loop())
+        logger.info("Очередь генерации: %s, воркеров %d", self.backend_name, len(self._tasks))
+
+    async def stop(self) -> None:
+        """Свободные воркеры останавливаются сразу; идущим генерациям даётся
+        JOB_DRAIN_TIMEOUT, недоделанные задания возвращаются в очередь."""
+        self._stopping = True
+        if self._reaper is not None:
+            self._reaper.cancel()
+        if self._running:
+            running = [task for _, task in self._running.values()]
+            await asyncio.wait(running, timeout=JOB_DRAIN_TIMEOUT)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *([self._reaper] if self._reaper else []),
+                             return_exceptions=True)
+        self._tasks, self._reaper = [], None
+
+    # --- API ---
+
+    async def submit(self, job: Job) -> Job:
+        await self.backend.put(job)
+        self.enqueued += 1
+        CHAT_JOBS.labels(QUEUED).inc()
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await self.backend.get(job_id)
+
+    async def active(self, session_id: str) -> Optional[str]:
+        """id незавершённого задания сессии."""
+        try:
+            return await self.backend.active(session_id)
+        except Exception:
+            logger.exception("Очередь генерации недоступна")
+            return None
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        """Задание, как только оно завершится, или текущее состояние по таймауту."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = await self.backend.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job.finished:
+                self._finished.pop(job_id, None)
+                return job
+            if remaining <= 0:
+                return job
+            # завершение в этом процессе будит сразу; из другого — виден при опросе
+            event = self._finished.setdefault(job_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), min(remaining, _WAIT_POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+
+    # --- воркеры ---
+
+    async def _work(self) -> None:
+        while not self._stopping:
+            try:
+                job = await self.backend.claim(_CLAIM_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Очередь генерации: не удалось получить задание")
+                await asyncio.sleep(_CLAIM_TIMEOUT)
+                continue
+            if job is None:
+                continue
+            task = asyncio.create_task(self._run(job))
+            self._running[job.id] = (job, task)
+            try:
+                # отмена воркера при остановке не прерывает генерацию — её ждёт stop()
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                raise
+            finally:
+                self._running.pop(job.id, None)
+
+    async def _run(self, job: Job) -> None:
+        CHAT_JOB_WAIT_SECONDS.observe(max(0.0, time.time() - job.created_at))
+        if job.attempts > self.max_attempts:
+            logger.error("Задание %s: исчерпаны попытки (%d)", job.id, job.attempts - 1)
+            await self._complete(job, error={"detail": "Не удалось получить ответ", "status": 500})
+            return
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            result = await self._handler(job)
+        except asyncio.CancelledError:
+            # остановка процесса: задание достанется другому воркеру
+            job.attempts -= 1
+            with _suppress_logged("Задание %s не удалось вернуть в очередь", job.id):
+                await asyncio.shield(self.backend.release(job))
+            raise
+        except LLMError as e:
+            await self._complete(job, error={
+                "detail": e.detail, "status": e.status_code, "retry_after": e.retry_after_seconds,
+            })
+        except Exception:
+            logger.exception("Задание %s завершилось ошибкой", job.id)
+            await self._complete(job, error={"detail": "Не удалось получить ответ", "status": 500})
+        else:
+            await self._complete(job, result=result)
+        finally:
+            heartbeat.cancel()
+
+    async def _complete(self, job: Job, result: Optional[dict] = None,
+                        error: Optional[dict] = None) -> None:
+        job.status = DONE if error is None else FAILED
+        job.result, job.error = result, error
+        job.finished_at = time.time()
+        if error is None:
+            self.completed += 1
+        else:
+            self.failed += 1
+        CHAT_JOBS.labels(job.status).inc()
+        with _suppress_logged("Не удалось сохранить итог задания %s", job.id):
+            await self.backend.finish(job)
+        event = self._finished.pop(job.id, None)
+        if event is not None:
+            event.set()
+
+    async def _heartbeat(self, job: Job) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            with _suppress_logged("Не удалось продлить аренду задания %s", job.id):
+                await self.backend.extend(job)
+
+    async def _reap_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 2)
+            with _suppress_logged("Очередь генерации: ошибка возврата брошенных заданий"):
+                requeued = await self.backend.recover()
+                if requeued:
+                    self.recovered += requeued
+                    CHAT_JOBS.labels("recovered").inc(requeued)
+                    logger.warning("Очередь генерации: возвращено заданий упавших воркеров: %d", requeued)
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend_name,
+            "workers": len(self._tasks),
+            "running": len(self._running),
+            "enqueued": self.enqueued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "recovered": self.recovered,
+        }
+
+
+class _suppress_logged:
+    """Ошибка хранилища в фоновой операции — в лог, без падения воркера."""
+
+    def __init__(self, message: str, *args):
+        self.message = message
+        self.args = args
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is not None and issubclass(exc_type, Exception):
+            logger.exception(self.message, *self.args)
+            return True
+        return False
+
+
+job_queue = JobQueue()
@@ -0,0 +1,505 @@
+"""Клиент OpenAI с защитой от сбоев и перегрузки.
+
+Поверх AsyncOpenAI:
+  * пул HTTP-соединений с keep-alive (OPENAI_MAX_CONNECTIONS, OPENAI_KEEPALIVE_SECONDS);
+  * семафор на модель — не больше OPENAI_MAX_IN_FLIGHT одновременных вызовов,
+    остальные ждут слот до OPENAI_QUEUE_TIMEOUT секунд (потом 503);
+  * повторы при 429/408/5xx и сетевых ошибках: экспоненциальная задержка с
+    полным джиттером, Retry-After от сервера соблюдается (если он дольше
+    OPENAI_RETRY_MAX_DELAY — не повторяем, а отдаём его клиенту);
+  * хеджирование (OPENAI_HEDGE_PERCENTILE): если первый ответ (у потока — первый
+    чанк) не пришёл за этот перцентиль недавних задержек модели, параллельно
+    уходит второй такой же запрос, используется тот, что ответит раньше.
+    Только при свободном слоте семафора и исправном upstream;
+  * circuit breaker на модель: после OPENAI_BREAKER_FAILURES ошибок upstream
+    подряд (5xx, сеть, таймаут) вызовы модели сразу получают 503 на
+    OPENAI_BREAKER_RESET секунд, затем один пробный вызов решает, закрыть ли
+    его. Сбой одной модели не блокирует остальные (на них переключается routing).
+
+Ошибки выходят наружу как LLMError с HTTP-статусом, коротким текстом для
+клиента и Retry-After; исходная ошибка OpenAI пишется в лог.
+
+Поток с первым чанком повторяется и хеджируется целиком; ошибка посреди потока
+не повторяется — часть ответа уже отдана клиенту.
+"""
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Sequence
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from .metrics import LLM_CIRCUIT_STATE, LLM_HEDGES, LLM_RETRIES, error_label
+
+logger = logging.getLogger(__name__)
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+OPENAI_KEEPALIVE_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_SECONDS", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "64"))
+OPENAI_QUEUE_TIMEOUT = float(os.getenv("OPENAI_QUEUE_TIMEOUT", "10"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "0.5"))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "8"))
+# 0 — без хеджирования
+OPENAI_HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", "0"))
+OPENAI_BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", "5"))
+OPENAI_BREAKER_RESET = float(os.getenv("OPENAI_BREAKER_RESET", "30"))
+
+# задержки для порога хеджирования: окно и минимум замеров, с которого он считается
+_HEDGE_WINDOW = 200
+_HEDGE_MIN_SAMPLES = 20
+_RETRYABLE_STATUSES = {408, 409, 429}
+
+
+class LLMError(Exception):
+    """Вызов модели не удался; status_code и detail — для ответа клиенту."""
+
+    status_code = 502
+    detail = "Сервис модели вернул ошибку"
+
+    def __init__(self, detail: Optional[str] = None, retry_after: Optional[float] = None):
+        super().__init__(detail or self.detail)
+        if detail:
+            self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_seconds(self) -> Optional[int]:
+        return None if self.retry_after is None else max(1, math.ceil(self.retry_after))
+
+    def headers(self) -> dict:
+        seconds = self.retry_after_seconds
+        return {} if seconds is None else {"Retry-After": str(seconds)}
+
+
+class LLMUnavailable(LLMError):
+    """Upstream недоступен (открыт circuit breaker)."""
+
+    status_code = 503
+    detail = "Сервис модели временно недоступен"
+
+
+class LLMOverloaded(LLMError):
+    """Не дождались слота семафора модели."""
+
+    status_code = 503
+    detail = "Слишком много одновременных запросов к модели"
+
+
+class LLMRateLimited(LLMError):
+    """Upstream отвечает 429 и после повторов."""
+
+    status_code = 503
+    detail = "Сервис модели перегружен, повторите позже"
+
+
+class LLMTimeout(LLMError):
+    status_code = 504
+    detail = "Модель не ответила вовремя"
+
+
+def _is_upstream_failure(exc: BaseException) -> bool:
+    """Ошибка, говорящая о неисправности upstream (считается circuit breaker'ом)."""
+    if isinstance(exc, openai.APIConnectionError):  # включая APITimeoutError
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if _is_upstream_failure(exc):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code in _RETRYABLE_STATUSES
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Retry-After (или retry-after-ms) из ответа upstream, секунд."""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float = OPENAI_RETRY_BASE_DELAY,
+                  cap: float = OPENAI_RETRY_MAX_DELAY) -> float:
+    """Экспоненциальная задержка с полным джиттером: повторы разных запросов не совпадают."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def to_llm_error(exc: BaseException) -> LLMError:
+    if isinstance(exc, LLMError):
+        return exc
+    if isinstance(exc, openai.APITimeoutError):
+        return LLMTimeout()
+    if isinstance(exc, openai.RateLimitError):
+        return LLMRateLimited(retry_after=retry_after(exc))
+    if _is_upstream_failure(exc):
+        return LLMError(retry_after=retry_after(exc))
+    return LLMError()
+
+
+# ----------------------------
+# Circuit breaker
+# ----------------------------
+
+_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class CircuitBreaker:
+    """closed → (N ошибок подряд) → open → (reset секунд) → half_open → один пробный вызов."""
+
+    def __init__(self, failures: int = OPENAI_BREAKER_FAILURES, reset_seconds: float = OPENAI_BREAKER_RESET,
+                 model: str = ""):
+        self.model = model
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_total = 0
+        self._opened_at = 0.0
+        self._probe = False
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        LLM_CIRCUIT_STATE.labels(self.model).set(_STATE_VALUES[state])
+
+    def before_call(self) -> None:
+        """Пропускает вызов или бросает LLMUnavailable."""
+        if self.state == "open":
+            remaining = self._opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0:
+                raise LLMUnavailable(retry_after=remaining)
+            self._set_state("half_open")
+            self._probe = False
+        if self.state == "half_open":
+            if self._probe:
+                raise LLMUnavailable(retry_after=1)
+            self._probe = True
+
+    def record(self, exc: Optional[BaseException]) -> None:
+        """Итог вызова: None — успех, иначе исключение попытки."""
+        if exc is not None and not isinstance(exc, Exception):
+            # отмена (клиент ушёл, проиграл хедж) — о состоянии upstream ничего не говорит
+            self._probe = False
+            return
+        if exc is None or not _is_upstream_failure(exc):
+            # upstream ответил (пусть и 4xx) — он жив
+            self.consecutive_failures = 0
+            self._probe = False
+            if self.state != "closed":
+                self._set_state("closed")
+            return
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failures:
+            if self.state != "open":
+                self.opened_total += 1
+                logger.warning("OpenAI: %d ошибок %s подряд, вызовы приостановлены на %.0f с",
+                               self.consecutive_failures, self.model, self.reset_seconds)
+            self._opened_at = time.monotonic()
+            self._probe = False
+            self._set_state("open")
+
+
+# ----------------------------
+# Клиент
+# ----------------------------
+
+@dataclass
+class _Lease:
+    """Результат попытки и занятый ей слот семафора (у потока — до его закрытия)."""
+
+    value: Any
+    release: Callable[[], None]
+    close: Optional[Callable[[], Awaitable[None]]] = None
+
+    async def discard(self) -> None:
+        try:
+            if self.close is not None:
+                await self.close()
+        finally:
+            self.release()
+
+
+class LLMClient:
+    def __init__(self):
+        self.max_in_flight = OPENAI_MAX_IN_FLIGHT
+        self.queue_timeout = OPENAI_QUEUE_TIMEOUT
+        self.max_retries = OPENAI_MAX_RETRIES
+        self.hedge_percentile = OPENAI_HEDGE_PERCENTILE
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._openai: Optional[AsyncOpenAI] = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._cleanups = set()
+        # метрики
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.overloaded = 0
+
+    @property
+    def openai(self) -> AsyncOpenAI:
+        # создаётся при первом вызове: OPENAI_BASE_URL/OPENAI_API_KEY читаются из окружения
+        if self._openai is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                    keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
+                ),
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            )
+            # повторы делаем сами — с семафором, breaker'ом и Retry-After
+            self._openai = AsyncOpenAI(http_client=http_client, max_retries=0)
+        return self._openai
+
+    async def stop(self) -> None:
+        if self._openai is not None:
+            await self._openai.close()
+            self._openai = None
+
+    # --- вызовы ---
+
+    async def complete(self, *, model: str, hedge: bool = True, **kwargs):
+        """chat.completions.create без потока."""
+        async def attempt():
+            return await self.openai.chat.completions.create(model=model, **kwargs)
+
+        lease = await self._call(model, attempt, hedge)
+        lease.release()
+        return lease.value
+
+    async def embed(self, *, model: str, texts: Sequence[str]):
+        """embeddings.create (app/vectors.py) — с тем же семафором, повторами и breaker'ом модели."""
+        async def attempt():
+            return await self.openai.embeddings.create(model=model, input=list(texts))
+
+        lease = await self._call(model, attempt, hedge=False)
+        lease.release()
+        return lease.value
+
+    @asynccontextmanager
+    async def stream(self, *, model: str, hedge: bool = True, **kwargs):
+        """Потоковый chat.completions.create:
+
+            async with llm_client.stream(model=..., messages=...) as chunks:
+                async for chunk in chunks:
+                    ...
+        """
+        async def attempt():
+            stream = await self.openai.chat.completions.create(model=model, stream=True, **kwargs)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                await stream.close()
+                raise
+            return stream, first
+
+        lease = await self._call(model, attempt, hedge, close=lambda value: value[0].close())
+        stream, first = lease.value
+        try:
+            yield self._chunks(model, stream, first)
+        finally:
+            await lease.discard()
+
+    async def _chunks(self, model: str, stream, first):
+        if first is not None:
+            yield first
+        try:
+            async for chunk in stream:
+                yield chunk
+        except Exception as e:
+            self.breaker(model).record(e)
+            self.errors += 1
+            logger.warning("OpenAI: поток прерван: %r", e)
+            raise to_llm_error(e) from e
+
+    # --- повторы ---
+
+    async def _call(self, model: str, attempt: Callable[[], Awaitable[Any]], hedge: bool,
+                    close: Optional[Callable[[Any], Awaitable[None]]] = None) -> _Lease:
+        self.calls += 1
+        for number in range(self.max_retries + 1):
+            try:
+                if hedge and self.hedge_percentile:
+                    return await self._hedged(model, attempt, close)
+                return await self._attempt(model, attempt, close)
+            except LLMError:
+                self.errors += 1
+                raise
+            except Exception as e:
+                delay = self._retry_delay(e, number)
+                if delay is None:
+                    self.errors += 1
+                    logger.warning("OpenAI: вызов %s не удался: %r", model, e)
+                    raise to_llm_error(e) from e
+                self.retries += 1
+                LLM_RETRIES.labels(model, error_label(e)).inc()
+                await asyncio.sleep(delay)
+
+    def _retry_delay(self, exc: Exception, number: int) -> Optional[float]:
+        """Пауза перед следующей попыткой или None, если повторять не нужно."""
+        if number >= self.max_retries or not _is_retryable(exc):
+            return None
+        server_delay = retry_after(exc)
+        if server_delay is None:
+            return backoff_delay(number)
+        if server_delay > OPENAI_RETRY_MAX_DELAY:
+            return None
+        # небольшой джиттер поверх Retry-After, чтобы ожидавшие не пришли разом
+        return server_delay + backoff_delay(0)
+
+    # --- одна попытка ---
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(model=model)
+        return breaker
+
+    def _semaphore(self, model: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(model)
+        if semaphore is None:
+            semaphore = self._semaphores[model] = asyncio.Semaphore(self.max_in_flight)
+        return semaphore
+
+    async def _attempt(self, model: str, attempt: Callable[[], Awaitable[Any]],
+                       close: Optional[Callable[[Any], Awaitable[None]]] = None) -> _Lease:
+        semaphore = self._semaphore(model)
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.overloaded += 1
+            raise LLMOverloaded(retry_after=1)
+        self._in_flight[model] = self._in_flight.get(model, 0) + 1
+
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self._in_flight[model] -= 1
+                semaphore.release()
+
+        started = time.perf_counter()
+        try:
+            self.breaker(model).before_call()
+            value = await attempt()
+        except BaseException as e:
+            if not isinstance(e, LLMUnavailable):
+                self.breaker(model).record(e)
+            release()
+            raise
+        self.breaker(model).record(None)
+        self._latencies.setdefault(model, deque(maxlen=_HEDGE_WINDOW)).append(time.perf_counter() - started)
+        return _Lease(value, release, (lambda: close(value)) if close is not None else None)
+
+    # --- хеджирование ---
+
+    def hedge_threshold(self, model: str) -> Optional[float]:
+        samples = self._latencies.get(model)
+        if not self.hedge_percentile or not samples or len(samples) < _HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[max(0, math.ceil(self.hedge_percentile / 100 * len(ordered)) - 1)]
+
+    def _can_hedge(self, model: str) -> bool:
+        # при нехватке слотов или сбоях upstream второй запрос только добавит нагрузки
+        return self.breaker(model).state == "closed" and not self._semaphore(model).locked()
+
+    async def _hedged(self, model: str, attempt: Callable[[], Awaitable[Any]],
+                      close: Optional[Callable[[Any], Awaitable[None]]]) -> _Lease:
+        threshold = self.hedge_threshold(model)
+        if threshold is None:
+            return await self._attempt(model, attempt, close)
+
+        first = asyncio.ensure_future(self._attempt(model, attempt, close))
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=threshold)
+            if done or not self._can_hedge(model):
+                pending.clear()
+                return await first
+
+            self.hedges += 1
+            LLM_HEDGES.labels(model, "sent").inc()
+            second = asyncio.ensure_future(self._attempt(model, attempt, close))
+            pending.add(second)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if not winners:
+                    error = error or next(iter(done)).exception()
+                    continue
+                winner = winners[0]
+                for extra in winners[1:]:
+                    await extra.result().discard()
+                if winner is second:
+                    self.hedge_wins += 1
+                    LLM_HEDGES.labels(model, "won").inc()
+                return winner.result()
+            raise error
+        finally:
+            # проигравший не дожидаемся: отмена HTTP-запроса может завершиться не сразу
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(self._discard_late)
+
+    def _discard_late(self, task: asyncio.Task) -> None:
+        """Проигравшая попытка всё же успела завершиться — закрываем её результат."""
+        if task.cancelled() or task.exception() is not None:
+            return
+        cleanup = asyncio.ensure_future(task.result().discard())
+        self._cleanups.add(cleanup)
+        cleanup.add_done_callback(self._cleanups.discard)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "overloaded": self.overloaded,
+            "in_flight": {model: n for model, n in self._in_flight.items() if n},
+            "max_in_flight": self.max_in_flight,
+            "hedge_threshold_ms": {
+                model: round(t * 1000, 1)
+                for model in self._latencies
+                if (t := self.hedge_threshold(model)) is not None
+            },
+            "circuit": {model: b.state for model, b in self.breakers.items()},
+            "circuit_opened_total": sum(b.opened_total for b in self.breakers.values()),
+        }
+
+
+llm_client = LLMClient()
@@ -0,0 +1,261 @@
+"""Запись сообщений чата: сразу (по умолчанию) или отложенно пачками.
+
+Обычный режим — INSERT и commit на каждое сообщение, т.е. два commit'а
+(и два fsync на Postgres) на каждый /chat/send.
+
+Режим write-behind (MESSAGE_WRITE_BEHIND=1, только Postgres): сообщение
+получает id из последовательности chat_messages в момент сохранения и сразу
+попадает в кэш горячих сессий, а в БД уходит через очередь — фоновый флашер
+раз в MESSAGE_FLUSH_INTERVAL_MS пишет накопившееся одним многострочным INSERT
+и одним commit.
+
+id не берутся блоками про запас: nextval вызывается, когда сообщение
+сохраняется (одновременные сохранения делят один запрос), поэтому порядок id
+совпадает с порядком сохранения и при нескольких процессах — воркерах uvicorn,
+backend/worker.py или прямых INSERT'ах. На порядке id держатся страницы
+истории, дельта after_id и ETag.
+
+Чтение своих записей: владелец сессии читает историю из кэша, а прежде чем
+читать сессию из БД (промах кэша, неполный хвост), ждёт записи её сообщений
+(barrier). При остановке приложения очередь дописывается целиком (stop()).
+
+Несколько процессов: порядок id ещё не порядок видимости. Если процесс A
+держит в очереди сообщение N, а процесс B уже записал N+1 той же сессии,
+клиент, читающий дельту after_id из БД, прошёл бы N навсегда. Поэтому
+блокировка сессии в Redis снимается только после записи сообщений хода
+(session_locks.before_release = barrier): следующий ход сессии в любом
+процессе пишет свои сообщения после того, как предыдущие уже видны. Без Redis
+блокировка сессии есть только внутри процесса, и write-behind при нескольких
+процессах этого не гарантирует — при старте пишется предупреждение.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import ASYNC_DATABASE_URL, AsyncSessionLocal
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "0") == "1"
+MESSAGE_FLUSH_INTERVAL_MS = float(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "5"))
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "500"))
+MESSAGE_DRAIN_TIMEOUT = float(os.getenv("MESSAGE_DRAIN_TIMEOUT", "30"))
+_RETRY_DELAY = 0.5
+
+_RESERVE_IDS_SQL = text(
+    "SELECT nextval(pg_get_serial_sequence('chat_messages', 'id')) "
+    "FROM generate_series(1, :n)"
+).execution_options(query_name="reserve_message_ids")
+
+_COLUMNS = ("id", "session_id", "role", "content", "tokens_used", "created_at", "model")
+
+
+class MessageWriter:
+    def __init__(self, enabled: bool = MESSAGE_WRITE_BEHIND,
+                 flush_interval_ms: float = MESSAGE_FLUSH_INTERVAL_MS):
+        self.enabled = enabled
+        self.flush_interval_ms = flush_interval_ms
+        self._queue: Deque[Tuple[int, dict]] = deque()
+        self._id_waiters: List[asyncio.Future] = []
+        self._id_task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._flushed = asyncio.Condition()
+        self._seq = 0            # номер последнего поставленного в очередь сообщения
+        self._flushed_seq = 0    # все сообщения с номером <= этого уже в БД
+        self._last_seq: Dict[str, int] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._drain_deadline = 0.0
+        # метрики
+        self.batches = 0
+        self.rows = 0
+        self.id_queries = 0
+        self.errors = 0
+        self.dropped = 0
+        self.max_batch = 0
+        self.last_batch = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        if not ASYNC_DATABASE_URL.startswith("postgresql"):
+            logger.warning("MESSAGE_WRITE_BEHIND поддерживается только на Postgres, "
+                           "сообщения пишутся сразу")
+            self.enabled = False
+            return
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """Останавливает флашер и дописывает очередь (вызывается из lifespan)."""
+        if self._flusher is None:
+            return
+        # флашер не отменяем: пачка, прерванная посреди INSERT, была бы потеряна
+        self._stopping = True
+        self._drain_deadline = time.monotonic() + MESSAGE_DRAIN_TIMEOUT
+        self._wakeup.set()
+        await self._flusher
+        self._flusher = None
+
+    # --- запись ---
+
+    async def save(self, db: AsyncSession, message: ChatMessage) -> ChatMessage:
+        """Сохраняет сообщение; после возврата у него есть id и created_at."""
+        if not self.enabled:
+            db.add(message)
+            await db.commit()
+            return message
+
+        # транзакция запроса (чтения) закрывается так же, как при обычной записи
+        await db.commit()
+        message.id = await self._next_id()
+        if message.created_at is None:
+            message.created_at = datetime.utcnow()
+        self._seq += 1
+        self._queue.append((self._seq, {c: getattr(message, c) for c in _COLUMNS}))
+        self._last_seq[message.session_id] = self._seq
+        self._wakeup.set()
+        return message
+
+    async def barrier(self, session_id: str) -> None:
+        """Ждёт, пока отложенные сообщения сессии не окажутся в БД."""
+        target = self._last_seq.get(session_id)
+        if target is None or target <= self._flushed_seq:
+            return
+        async with self._flushed:
+            await self._flushed.wait_for(lambda: self._flushed_seq >= target)
+
+    async def _next_id(self) -> int:
+        """id из последовательности в момент сохранения.
+
+        Запросы, пришедшие, пока предыдущий nextval ещё выполняется, получают
+        id одним запросом. Лишних id не остаётся, так что id, выданный позже
+        (в любом процессе), всегда больше.
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._id_waiters.append(waiter)
+        if self._id_task is None or self._id_task.done():
+            self._id_task = asyncio.create_task(self._reserve_ids())
+        return await waiter
+
+    async def _reserve_ids(self) -> None:
+        while self._id_waiters:
+            waiters, self._id_waiters = self._id_waiters, []
+            try:
+                async with AsyncSessionLocal() as db:
+                    ids = sorted((await db.scalars(_RESERVE_IDS_SQL, {"n": len(waiters)})).all())
+            except Exception as e:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                continue
+            self.id_queries += 1
+            for waiter, message_id in zip(waiters, ids):
+                if not waiter.done():
+                    waiter.set_result(message_id)
+
+    # --- флашер ---
+
+    async def _flush_loop(self) -> None:
+        while not (self._stopping and not self._queue):
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._stopping:
+                # небольшая пауза, чтобы в пачку попали сообщения соседних запросов
+                await asyncio.sleep(self.flush_interval_ms / 1000)
+            while self._queue:
+                if await self._flush_batch():
+                    continue
+                if self._stopping and time.monotonic() > self._drain_deadline:
+                    self.dropped += len(self._queue)
+                    logger.error("Не удалось дописать %d сообщений при остановке", len(self._queue))
+                    self._queue.clear()
+                    break
+                await asyncio.sleep(_RETRY_DELAY)
+
+    async def _flush_batch(self) -> bool:
+        batch: List[Tuple[int, dict]] = []
+        while self._queue and len(batch) < MESSAGE_BATCH_SIZE:
+            batch.append(self._queue.popleft())
+        rows = [row for _, row in batch]
+
+        started = time.perf_counter()
+        try:
+            await self._insert(rows)
+        except IntegrityError:
+            # битая строка (например, сессию удалили) не должна блокировать остальные
+            self.errors += 1
+            logger.exception("Пачка сообщений не записалась, пишем по одному")
+            for i, (_, row) in enumerate(batch):
+                try:
+                    await self._insert_one(row)
+                except Exception:
+                    logger.exception("Не удалось записать сообщение %s, повторим", row["id"])
+                    self._queue.extendleft(reversed(batch[i:]))
+                    batch = batch[:i]
+                    break
+        except Exception:
+            self.errors += 1
+            logger.exception("Не удалось записать пачку из %d сообщений, повторим", len(batch))
+            self._queue.extendleft(reversed(batch))
+            return False
+        if not batch:
+            return False
+
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.rows += len(batch)
+        self.last_batch = len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self.flush_seconds_total += elapsed
+        self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+
+        async with self._flushed:
+            self._flushed_seq = batch[-1][0]
+            self._flushed.notify_all()
+        for seq, row in batch:
+            if self._last_seq.get(row["session_id"]) == seq:
+                del self._last_seq[row["session_id"]]
+        return True
+
+    async def _insert(self, rows: List[dict]) -> None:
+        async with AsyncSessionLocal() as db:
+            # executemany по insert() — многострочный INSERT (insertmanyvalues)
+            await db.execute(insert(ChatMessage), rows)
+            await db.commit()
+
+    async def _insert_one(self, row: dict) -> None:
+        try:
+            await self._insert([row])
+        except IntegrityError:
+            self.dropped += 1
+            logger.error("Сообщение %s сессии %s отброшено", row["id"], row["session_id"])
+
+    def stats(self) -> dict:
+        return {
+            "write_behind": self.enabled,
+            "queued": len(self._queue),
+            "batches": self.batches,
+            "rows": self.rows,
+            "id_queries": self.id_queries,
+            "last_batch": self.last_batch,
+            "max_batch": self.max_batch,
+            "avg_batch": round(self.rows / self.batches, 2) if self.batches else 0.0,
+            "flush_ms_avg": round(self.flush_seconds_total / self.batches * 1000, 3) if self.batches else 0.0,
+            "flush_ms_max": round(self.flush_seconds_max * 1000, 3),
+            "errors": self.errors,
+            "dropped": self.dropped,
+        }
+
+
+message_writer = MessageWriter()
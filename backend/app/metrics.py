@@ -0,0 +1,287 @@
+"""Метрики Prometheus для эндпоинта /metrics.
+
+Что меряется:
+  * http_request_seconds{route, method, status} — запрос целиком, включая
+    сериализацию ответа и отдачу потока (MetricsMiddleware);
+  * chat_stage_seconds{endpoint, stage} — этапы /chat/send, /chat/send/stream,
+    /chat/history и /chat/session (сессия, квота, контекст, модель, запись,
+    сборка ответа);
+  * db_query_seconds{query} — каждый SQL-запрос. Имя берётся из
+    execution_options(query_name=...) построителей queries.py, иначе
+    «глагол таблица» (select chat_sessions, insert chat_messages, ...);
+  * llm_request_seconds{model, kind} и llm_time_to_first_token_seconds{model} —
+    вызовы OpenAI, llm_in_flight{model} — вызовы, идущие прямо сейчас;
+  * llm_tokens_total{assistant, call, kind} — prompt/completion токены по usage
+    ответа, assistant — assistants.code, call — chat или summary;
+  * llm_retries_total{model, error}, llm_hedges_total{model, outcome} и
+    llm_circuit_state{model} — повторы, хеджирование и circuit breaker клиента OpenAI;
+  * llm_routes_total{assistant, model, reason} — какая модель ответила и почему
+    (rule, default, slo — обход деградировавшей, failover — после ошибки);
+  * chat_jobs_total{status} — задания фоновой генерации (queued, done, failed,
+    recovered — возвращены в очередь после падения воркера) и
+    chat_job_wait_seconds — сколько задание ждало воркера;
+  * *_errors_total — ошибки по классу исключения (HTTPException — по статусу);
+  * db_pool_checked_out / db_pool_max — соединения, выданные из пула.
+
+Все метки — из фиксированных наборов (этапы, имена запросов, модели и коды
+ассистентов из небольшой таблицы), id сессий и пользователей в метки не попадают.
+
+Несколько воркеров uvicorn: задайте PROMETHEUS_MULTIPROC_DIR (пустой каталог,
+очищается при рестарте) — /metrics соберёт значения всех процессов.
+"""
+import functools
+import os
+import re
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from fastapi import HTTPException
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from sqlalchemy import event
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# от единиц миллисекунд (кэш, индексные запросы) до минуты (длинный ответ модели)
+_FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "Полное время HTTP-запроса", ["route", "method", "status"],
+    buckets=_FAST_BUCKETS + (10.0, 30.0, 60.0),
+)
+CHAT_STAGE_SECONDS = Histogram(
+    "chat_stage_seconds", "Длительность этапа обработки запроса чата",
+    ["endpoint", "stage"], buckets=_FAST_BUCKETS + (10.0, 30.0, 60.0),
+)
+CHAT_ERRORS = Counter(
+    "chat_errors_total", "Запросы чата, завершившиеся ошибкой", ["endpoint", "error"],
+)
+
+DB_QUERY_SECONDS = Histogram(
+    "db_query_seconds", "Длительность SQL-запроса", ["query"], buckets=_FAST_BUCKETS,
+)
+DB_ERRORS = Counter("db_errors_total", "Ошибки SQL-запросов", ["query", "error"])
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Соединения, выданные из пула", multiprocess_mode="livesum",
+)
+DB_POOL_MAX = Gauge(
+    "db_pool_max", "Максимум соединений пула (pool_size + max_overflow)", multiprocess_mode="livesum",
+)
+
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_request_seconds", "Длительность вызова модели до последнего токена",
+    ["model", "kind"], buckets=_SLOW_BUCKETS,
+)
+LLM_TTFT_SECONDS = Histogram(
+    "llm_time_to_first_token_seconds", "Время до первого токена потокового ответа",
+    ["model"], buckets=_SLOW_BUCKETS,
+)
+LLM_IN_FLIGHT = Gauge(
+    "llm_in_flight", "Вызовы модели, идущие сейчас", ["model"], multiprocess_mode="livesum",
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "Токены по usage ответов модели", ["assistant", "call", "kind"],
+)
+LLM_ERRORS = Counter("llm_errors_total", "Ошибки вызовов модели", ["model", "error"])
+LLM_RETRIES = Counter("llm_retries_total", "Повторы вызовов модели", ["model", "error"])
+LLM_HEDGES = Counter(
+    "llm_hedges_total", "Хеджирующие вызовы модели: sent — отправлен, won — ответил раньше",
+    ["model", "outcome"],
+)
+LLM_ROUTES = Counter(
+    "llm_routes_total", "Ответы по моделям и причине выбора модели", ["assistant", "model", "reason"],
+)
+LLM_CIRCUIT_STATE = Gauge(
+    "llm_circuit_state", "Circuit breaker модели: 0 — закрыт, 1 — пробный вызов, 2 — открыт",
+    ["model"], multiprocess_mode="max",
+)
+
+CHAT_JOBS = Counter("chat_jobs_total", "Задания фоновой генерации ответа", ["status"])
+CHAT_JOB_WAIT_SECONDS = Histogram(
+    "chat_job_wait_seconds", "Ожидание задания в очереди до начала генерации", buckets=_SLOW_BUCKETS,
+)
+
+
+def error_label(exc: BaseException) -> str:
+    if isinstance(exc, HTTPException):
+        return f"http_{exc.status_code}"
+    return type(exc).__name__
+
+
+# ----------------------------
+# Этапы запроса
+# ----------------------------
+
+@contextmanager
+def stage(endpoint: str, name: str):
+    """Замер этапа; исключение тоже завершает этап (его время учитывается)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        CHAT_STAGE_SECONDS.labels(endpoint, name).observe(time.perf_counter() - started)
+
+
+def count_error(endpoint: str, exc: BaseException) -> None:
+    CHAT_ERRORS.labels(endpoint, error_label(exc)).inc()
+
+
+def track_errors(endpoint: str):
+    """Декоратор обработчика: считает исключения, вылетевшие из него."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                count_error(endpoint, e)
+                raise
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """Чистый ASGI: время запроса по шаблону маршрута (/chat/history/{session_id})."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # маршрут кладёт в scope роутер; у ненайденных путей его нет — не плодим метки
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.labels(route, scope["method"], str(status)).observe(
+                time.perf_counter() - started
+            )
+
+
+# ----------------------------
+# Вызовы модели
+# ----------------------------
+
+class LLMCall:
+    """Один вызов модели: длительность, время до первого токена, in-flight и ошибки.
+
+        with LLMCall(model, "stream") as call:
+            async for chunk in stream:
+                call.first_token()
+    """
+
+    def __init__(self, model: str, kind: str):
+        self.model = model
+        self.kind = kind
+        self.started = 0.0
+        self.ttft: Optional[float] = None
+
+    def __enter__(self) -> "LLMCall":
+        self.started = time.perf_counter()
+        LLM_IN_FLIGHT.labels(self.model).inc()
+        return self
+
+    def first_token(self) -> None:
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+            LLM_TTFT_SECONDS.labels(self.model).observe(self.ttft)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        LLM_IN_FLIGHT.labels(self.model).dec()
+        LLM_REQUEST_SECONDS.labels(self.model, self.kind).observe(time.perf_counter() - self.started)
+        # отмена (клиент ушёл) — не ошибка модели
+        if exc is not None and isinstance(exc, Exception):
+            LLM_ERRORS.labels(self.model, error_label(exc)).inc()
+
+
+def count_usage(assistant_code: str, usage, call: str = "chat") -> None:
+    """Токены из usage ответа OpenAI (None — модель/прокси usage не вернули)."""
+    if usage is None:
+        return
+    if usage.prompt_tokens:
+        LLM_TOKENS.labels(assistant_code, call, "prompt").inc(usage.prompt_tokens)
+    if usage.completion_tokens:
+        LLM_TOKENS.labels(assistant_code, call, "completion").inc(usage.completion_tokens)
+
+
+# ----------------------------
+# База данных
+# ----------------------------
+
+_TABLE = re.compile(r"\b(?:from|into|update)\s+\"?(\w+)", re.IGNORECASE)
+
+
+def query_name(context, statement: str) -> str:
+    name = context.execution_options.get("query_name") if context is not None else None
+    if name:
+        return name
+    words = statement.lstrip().split(None, 1)
+    verb = words[0].lower() if words else "unknown"
+    table = _TABLE.search(statement)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+def instrument_engine(engine, pool_max: int) -> None:
+    """Подписывает движок (sync_engine для async) на замеры запросов и пула."""
+    DB_POOL_MAX.set(pool_max)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_started", None)
+        if started is not None:
+            DB_QUERY_SECONDS.labels(query_name(context, statement)).observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        statement = exception_context.statement or ""
+        DB_ERRORS.labels(
+            query_name(exception_context.execution_context, statement),
+            type(exception_context.original_exception).__name__,
+        ).inc()
+
+    @event.listens_for(engine.pool, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKED_OUT.inc()
+
+    @event.listens_for(engine.pool, "checkin")
+    def _checkin(dbapi_connection, connection_record):
+        DB_POOL_CHECKED_OUT.dec()
+
+
+# ----------------------------
+# Экспорт
+# ----------------------------
+
+def render_metrics():
+    """(тело, content-type) для ответа /metrics."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,7 @@
+from .assistant import Assistant, AssistantPromptVersion
+from .chat import ChatMessage, ChatSession
+from .kb import KbArticle, KbExample
+from .limits import UserLimit
+from .user import User, UserProfile
+
+__all__ = ["Assistant", "AssistantPromptVersion", "ChatMessage", "ChatSession", "KbArticle", "KbExample", "User", "UserLimit", "UserProfile"]
@@ -0,0 +1,33 @@
+from datetime import datetime
+
+from sqlalchemy import JSON, Column, DateTime, ForeignKey, Index, Integer, String, Text
+
+from ..db import Base
+
+
+class Assistant(Base):
+    __tablename__ = "assistants"
+
+    id = Column(Integer, primary_key=True, index=True)
+    code = Column(String, unique=True, index=True, nullable=False)
+    title = Column(String, nullable=False)
+    description = Column(Text, nullable=False)
+    base_model = Column(String, nullable=False)
+    system_prompt = Column(Text, nullable=False)
+    extra_config = Column(JSON, nullable=False)
+
+
+class AssistantPromptVersion(Base):
+    """Версия системного промта ассистента; сессия ссылается на неё по id."""
+
+    __tablename__ = "assistant_prompt_versions"
+    __table_args__ = (
+        # номер версии задаёт порядок и служит целью ON CONFLICT при создании версии
+        Index("uq_assistant_prompt_versions_version", "assistant_id", "version", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    assistant_id = Column(Integer, ForeignKey("assistants.id"), nullable=False)
+    version = Column(Integer, nullable=False)
+    system_prompt = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,43 @@
+import uuid
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, Text
+
+from ..db import Base
+
+
+class ChatSession(Base):
+    __tablename__ = "chat_sessions"
+    __table_args__ = (
+        # одна сессия на пару пользователь–ассистент: цель ON CONFLICT при открытии
+        # сессии (create_chat_session) и индекс для её поиска
+        Index("uq_chat_sessions_user_assistant", "user_id", "assistant_id", unique=True),
+    )
+
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    assistant_id = Column(Integer, ForeignKey("assistants.id"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # накопительное краткое содержание вытесненных из контекста реплик
+    summary = Column(Text, nullable=True)
+    summary_until_id = Column(Integer, nullable=True)  # id последнего свёрнутого сообщения
+    # версия системного промта, с которой шёл последний ход (промт в сообщения не копируется)
+    prompt_version_id = Column(Integer, ForeignKey("assistant_prompt_versions.id"), nullable=True)
+
+
+class ChatMessage(Base):
+    __tablename__ = "chat_messages"
+    __table_args__ = (
+        # вся выборка истории идёт по (session_id, id): keyset-пагинация, хвост для
+        # кэша сессий, max(id) для ETag; отдельный (session_id, created_at) не нужен —
+        # id монотонен и задаёт тот же порядок
+        Index("ix_chat_messages_session_id_id", "session_id", "id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String, ForeignKey("chat_sessions.id"))
+    role = Column(String)        # user | assistant (system — только до миграции 0007)
+    content = Column(Text)
+    tokens_used = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    model = Column(String, nullable=True)  # модель, ответившая на реплику (у ответов ассистента)
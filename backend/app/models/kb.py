@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from sqlalchemy import JSON, Column, DateTime, ForeignKey, Index, Integer, String, Text
+
+from ..db import Base
+
+
+class KbArticle(Base):
+    """Статья базы знаний (таблица из миграции 0001); по ней ищет app/retrieval.py.
+
+    age_group NULL — статья для любого возраста. updated_at (миграция 0009)
+    меняется при каждой правке — по нему индекс в памяти дочитывает изменения.
+    """
+    __tablename__ = "kb_articles"
+    __table_args__ = (
+        Index("ix_kb_articles_updated_at", "updated_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    title = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+    age_group = Column(String, nullable=True)
+    tags = Column(JSON, nullable=False, default=list)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class KbExample(Base):
+    """Пример вопроса и ответа (таблица из миграции 0001).
+
+    assistant_id NULL — пример общий для всех ассистентов. Вопросы примеров
+    входят в индекс эмбеддингов (app/vectors.py).
+    """
+    __tablename__ = "kb_examples"
+
+    id = Column(Integer, primary_key=True)
+    assistant_id = Column(Integer, ForeignKey("assistants.id"), nullable=True)
+    question_example = Column(Text, nullable=False)
+    answer_example = Column(Text, nullable=False)
+    age_group = Column(String, nullable=True)
+    tags = Column(JSON, nullable=False, default=list)
+    created_at = Column(DateTime, default=datetime.utcnow)
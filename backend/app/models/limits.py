@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+
+from ..db import Base
+
+
+class UserLimit(Base):
+    """Индивидуальные лимиты запросов (таблица из миграции 0001).
+
+    NULL в base — значение по умолчанию из DEFAULT_DAILY_REQUESTS /
+    DEFAULT_MONTHLY_REQUESTS, bonus прибавляется к base. tier — тариф
+    пользователя для правил выбора модели (extra_config.routing ассистента).
+    """
+    __tablename__ = "user_limits"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, unique=True)
+    daily_requests_base = Column(Integer, nullable=True)
+    monthly_requests_base = Column(Integer, nullable=True)
+    daily_requests_bonus = Column(Integer, nullable=True)
+    monthly_requests_bonus = Column(Integer, nullable=True)
+    tier = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
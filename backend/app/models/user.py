@@ -0,0 +1,34 @@
+from datetime import datetime
+
+from sqlalchemy import JSON, Column, DateTime, ForeignKey, Index, Integer, String
+from sqlalchemy.dialects.postgresql import JSONB
+
+from ..db import Base
+
+
+class User(Base):
+    __tablename__ = "users"
+
+    id = Column(Integer, primary_key=True)
+    telegram_id = Column(String, unique=True, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class UserProfile(Base):
+    """Анкета пользователя (таблица из миграции 0001): дети, вскармливание и т.п.
+
+    data — JSONB на Postgres, JSON на остальных БД. Для поиска по анкетам
+    (data @> ...) на Postgres есть GIN-индекс (миграция 0010). В промт
+    анкета попадает готовым фрагментом из app/profiles.py.
+    """
+    __tablename__ = "user_profiles"
+    __table_args__ = (
+        Index("ix_user_profiles_data", "data", postgresql_using="gin",
+              postgresql_ops={"data": "jsonb_path_ops"}).ddl_if(dialect="postgresql"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, unique=True)
+    data = Column(JSON().with_variant(JSONB(), "postgresql"), nullable=False, default=dict)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -0,0 +1,347 @@
+"""Анкета пользователя (user_profiles.data) в контексте модели.
+
+В анкете то, что пользователь иначе повторял бы в каждом чате: имя, дети
+(дата рождения или возраст), вскармливание, аллергии, заметки. На /chat/send
+она идёт в контекст готовым system-сообщением сразу после системного промта.
+
+Фрагмент рендерится заранее и держится в памяти процесса (LRU по user_id,
+PROFILE_CACHE_SIZE записей), поэтому /chat/send на попадании не читает БД.
+Кэш прогревается на /chat/session; отсутствие анкеты тоже кэшируется.
+Возраст детей считается от даты рождения: с наступлением нового дня
+фрагмент перерисовывается из той же записи, тоже без БД.
+
+Обновление:
+  * PUT/PATCH /profile сохраняет анкету и сразу кладёт новый фрагмент в кэш воркера;
+  * Postgres — LISTEN user_profiles_changed (триггер из миграции 0010, user_id):
+    остальные воркеры перечитывают анкеты пользователей, которые есть у них в кэше;
+  * запись живёт не дольше PROFILE_CACHE_TTL секунд — это ограничивает
+    расхождение там, где NOTIFY нет (SQLite).
+"""
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Iterable, Optional, Set
+
+from sqlalchemy import select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .chat_sessions import ensure_user
+from .db import ASYNC_DATABASE_URL, AsyncSessionLocal, dialect_insert
+from .models import User, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# 0 — анкета в контекст не попадает (эндпоинты /profile работают)
+PROFILE_CONTEXT = os.getenv("PROFILE_CONTEXT", "1") != "0"
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "20000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "3600"))
+# длиннее — фрагмент обрезается: анкета не должна вытеснять реплики из контекста
+PROFILE_MAX_CHARS = int(os.getenv("PROFILE_MAX_CHARS", "600"))
+PROFILE_NOTIFY_CHANNEL = "user_profiles_changed"
+PROFILE_MAX_CHILDREN = 6
+PROFILE_FIELD_CHARS = 100
+PROFILE_NOTES_CHARS = 500
+
+_NOTIFY_DEBOUNCE = 0.2
+_SPACES = re.compile(r"\s+")
+_SEX = {"m": "мальчик", "f": "девочка"}
+_HEADER = "Анкета пользователя (учитывай в ответах и не переспрашивай то, что здесь уже есть):"
+
+
+# ----------------------------
+# Рендеринг
+# ----------------------------
+
+def _plural(n: int, one: str, few: str, many: str) -> str:
+    if n % 10 == 1 and n % 100 != 11:
+        return one
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return few
+    return many
+
+
+def _text(value, limit: int = PROFILE_FIELD_CHARS) -> Optional[str]:
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    text = _SPACES.sub(" ", str(value)).strip()
+    return text[:limit] or None
+
+
+def child_age(birth: date, today: date) -> str:
+    """«12 дней», «7 мес.», «3 года 2 мес.», «8 лет»; дата в будущем — ожидаемые роды."""
+    if birth > today:
+        return f"ожидается {birth:%d.%m.%Y}"
+    months = (today.year - birth.year) * 12 + today.month - birth.month - (today.day < birth.day)
+    if months < 1:
+        days = (today - birth).days
+        return f"{days} {_plural(days, 'день', 'дня', 'дней')}"
+    if months < 24:
+        return f"{months} мес."
+    years, rest = divmod(months, 12)
+    age = f"{years} {_plural(years, 'год', 'года', 'лет')}"
+    # месяцы важны, пока ребёнок маленький
+    return f"{age} {rest} мес." if rest and years < 7 else age
+
+
+def _child(child, today: date) -> Optional[str]:
+    if not isinstance(child, dict):
+        return None
+    age = None
+    try:
+        if child.get("birth_date"):
+            age = child_age(date.fromisoformat(str(child["birth_date"])), today)
+    except ValueError:
+        pass
+    parts = [_text(child.get("name")), _SEX.get(child.get("sex")), age or _text(child.get("age"))]
+    parts = [p for p in parts if p]
+    return ", ".join(parts) if parts else None
+
+
+def render_profile(data: Optional[dict], today: date) -> Optional[str]:
+    """Короткий текст анкеты для промта (или None, если рассказывать нечего).
+
+    Берутся только известные поля — произвольные ключи data в промт не попадают.
+    """
+    if not isinstance(data, dict):
+        return None
+    lines = []
+    name = _text(data.get("name"))
+    if name:
+        lines.append(f"- имя: {name}")
+    children = data.get("children")
+    if isinstance(children, list):
+        described = [c for c in (_child(c, today) for c in children[:PROFILE_MAX_CHILDREN]) if c]
+        if described:
+            lines.append(f"- {'ребёнок' if len(described) == 1 else 'дети'}: {'; '.join(described)}")
+    for key, title in (("feeding", "вскармливание"), ("allergies", "аллергии")):
+        value = _text(data.get(key))
+        if value:
+            lines.append(f"- {title}: {value}")
+    notes = _text(data.get("notes"), PROFILE_NOTES_CHARS)
+    if notes:
+        lines.append(f"- заметки: {notes}")
+    if not lines:
+        return None
+    text = "\n".join([_HEADER, *lines])
+    if len(text) > PROFILE_MAX_CHARS:
+        text = text[:PROFILE_MAX_CHARS - 1].rstrip() + "…"
+    return text
+
+
+# ----------------------------
+# Кэш фрагментов
+# ----------------------------
+
+@dataclass
+class ProfileEntry:
+    data: dict
+    day: date                   # на какой день посчитан возраст детей
+    message: Optional[dict]     # system-сообщение для контекста; None — анкеты нет
+    loaded_at: float = field(default_factory=time.monotonic)
+
+
+class ProfileCache:
+    def __init__(self, maxsize: int = PROFILE_CACHE_SIZE, ttl: float = PROFILE_CACHE_TTL):
+        self.enabled = PROFILE_CONTEXT
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.renders = 0
+        self.updates = 0
+        self.evictions = 0
+        self._data: "OrderedDict[int, ProfileEntry]" = OrderedDict()
+        self._listener = None
+        self._notified: Set[int] = set()
+        self._notify_task: Optional[asyncio.Task] = None
+
+    def _render(self, data: dict, today: date) -> ProfileEntry:
+        self.renders += 1
+        content = render_profile(data, today)
+        return ProfileEntry(data, today, {"role": "system", "content": content} if content else None)
+
+    def get(self, user_id: int) -> Optional[ProfileEntry]:
+        entry = self._data.get(user_id)
+        if entry is not None and time.monotonic() - entry.loaded_at > self.ttl:
+            del self._data[user_id]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        today = date.today()
+        if entry.day != today and entry.message is not None:
+            # новый день — возраст детей пересчитывается из той же записи
+            fresh = self._render(entry.data, today)
+            fresh.loaded_at = entry.loaded_at
+            self._data[user_id] = entry = fresh
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return entry
+
+    def put(self, user_id: int, data: Optional[dict]) -> ProfileEntry:
+        entry = self._render(data or {}, date.today())
+        self._data[user_id] = entry
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def invalidate(self, user_id: int) -> None:
+        self._data.pop(user_id, None)
+
+    async def load(self, db: AsyncSession, user_id: int) -> ProfileEntry:
+        data = await db.scalar(
+            select(UserProfile.data).where(UserProfile.user_id == user_id).execution_options(query_name="user_profile")
+        )
+        self.loads += 1
+        return self.put(user_id, data)
+
+    async def fetch(self, db: AsyncSession, telegram_id: str) -> Optional[ProfileEntry]:
+        """Анкета по telegram_id из БД (заодно обновляет кэш); None — такого пользователя нет."""
+        row = (await db.execute(
+            select(User.id, UserProfile.data)
+            .outerjoin(UserProfile, UserProfile.user_id == User.id)
+            .where(User.telegram_id == telegram_id)
+        )).first()
+        if row is None:
+            return None
+        self.loads += 1
+        return self.put(row.id, row.data)
+
+    async def message(self, db: AsyncSession, user_id: int) -> Optional[dict]:
+        """system-сообщение с анкетой; БД читается только при промахе кэша."""
+        if not self.enabled:
+            return None
+        entry = self.get(user_id)
+        if entry is None:
+            entry = await self.load(db, user_id)
+        return entry.message
+
+    async def warm(self, db: AsyncSession, user_id: int) -> None:
+        """Загружает анкету в кэш заранее (на /chat/session), если её там нет."""
+        if self.enabled and self.get(user_id) is None:
+            await self.load(db, user_id)
+
+    # --- запись ---
+
+    async def save(self, db: AsyncSession, telegram_id: str, data: dict, merge: bool = False) -> ProfileEntry:
+        """Сохраняет анкету (при merge — поверх текущей, None удаляет поле) и обновляет кэш."""
+        user_id = await ensure_user(db, telegram_id)
+        now = datetime.utcnow()
+        if merge:
+            # FOR UPDATE блокирует только существующую строку: без неё два первых PATCH
+            # прочитали бы пустую анкету, и второй затёр бы поля первого
+            await db.execute(
+                dialect_insert(db, UserProfile)
+                .values(user_id=user_id, data={}, created_at=now, updated_at=now)
+                .on_conflict_do_nothing(index_elements=["user_id"])
+            )
+            current = await db.scalar(
+                select(UserProfile.data).where(UserProfile.user_id == user_id).with_for_update()
+            )
+            merged = {k: v for k, v in {**(current or {}), **data}.items() if v is not None}
+            # в кэш — то, что записано в строку
+            data = await db.scalar(
+                update(UserProfile).where(UserProfile.user_id == user_id)
+                .values(data=merged, updated_at=now).returning(UserProfile.data)
+            )
+        else:
+            insert = dialect_insert(db, UserProfile).values(user_id=user_id, data=data, created_at=now, updated_at=now)
+            await db.execute(insert.on_conflict_do_update(
+                index_elements=["user_id"],
+                set_={"data": insert.excluded.data, "updated_at": insert.excluded.updated_at},
+            ))
+        await db.commit()
+        self.updates += 1
+        return self.put(user_id, data)
+
+    async def refresh_ids(self, user_ids: Iterable[int]) -> int:
+        """Перечитывает анкеты закэшированных пользователей (NOTIFY) одним запросом."""
+        ids = [user_id for user_id in set(user_ids) if user_id in self._data]
+        if not ids:
+            return 0
+        async with AsyncSessionLocal() as db:
+            rows = dict((await db.execute(
+                select(UserProfile.user_id, UserProfile.data).where(UserProfile.user_id.in_(ids))
+            )).all())
+        for user_id in ids:
+            # анкета удалена — кэшируется её отсутствие
+            self.put(user_id, rows.get(user_id))
+        return len(ids)
+
+    # --- LISTEN ---
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        url = make_url(ASYNC_DATABASE_URL)
+        if url.get_backend_name() != "postgresql":
+            return
+        try:
+            import asyncpg
+
+            dsn = url.set(drivername="postgresql").render_as_string(hide_password=False)
+            self._listener = await asyncpg.connect(dsn)
+            await self._listener.add_listener(PROFILE_NOTIFY_CHANNEL, self._on_notify)
+        except Exception:
+            logger.exception("LISTEN %s недоступен, анкеты обновляются по TTL", PROFILE_NOTIFY_CHANNEL)
+            self._listener = None
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        try:
+            self._notified.add(int(payload))
+        except ValueError:
+            return
+        if self._notify_task is None or self._notify_task.done():
+            self._notify_task = asyncio.get_running_loop().create_task(self._apply_notified())
+
+    async def _apply_notified(self) -> None:
+        # массовые правки (импорт анкет) — одним запросом
+        await asyncio.sleep(_NOTIFY_DEBOUNCE)
+        while self._notified:
+            ids, self._notified = self._notified, set()
+            try:
+                await self.refresh_ids(ids)
+            except Exception:
+                logger.exception("Не удалось обновить анкеты по NOTIFY")
+                for user_id in ids:
+                    self.invalidate(user_id)
+
+    async def stop(self) -> None:
+        if self._notify_task is not None:
+            self._notify_task.cancel()
+            await asyncio.gather(self._notify_task, return_exceptions=True)
+            self._notify_task = None
+        if self._listener is not None:
+            try:
+                await self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "renders": self.renders,
+            "updates": self.updates,
+            "evictions": self.evictions,
+            "listening": self._listener is not None,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+profile_cache = ProfileCache()
@@ -0,0 +1,454 @@
+"""Рассылка событий чата по WebSocket (/chat/ws/{session_id}).
+
+Одну сессию открывают с телефона и с компьютера; вместо повторного
+/chat/history каждый подключённый клиент получает:
+  * {"type": "message", "message": {"id", "role", "content", "created_at"}, "key"} —
+    каждое сохранённое сообщение (пользователя и ассистента);
+  * {"type": "token", "delta", "key"} — токены ответа, пока идёт потоковая генерация;
+  * {"type": "resync"} — пропущено больше, чем отдаётся при подключении: нужен /chat/history.
+key — ключ идемпотентности хода, если он был: вкладка, отправившая сообщение,
+узнаёт по нему свои события и не показывает их второй раз.
+
+По умолчанию события расходятся только внутри процесса. При нескольких
+воркерах uvicorn канал между процессами включается явно: WS_PUSH=redis
+(pub/sub, REDIS_URL) или WS_PUSH=postgres (LISTEN/NOTIFY). Через Postgres идут
+только сообщения: NOTIFY на каждый токен сериализуется на commit'е, так что
+токены видят лишь клиенты процесса, который генерирует ответ.
+Процесс подписан на канал сессии, только пока к нему подключён хотя бы один
+её клиент. Источник доставляет событие своим клиентам сразу, своё эхо из
+канала пропускает. Публикация не блокирует обработчик запроса: события
+уходят в канал фоновой задачей, токены копятся WS_TOKEN_WINDOW_MS и
+публикуются одним событием на ход.
+
+У каждого соединения своя очередь на WS_SEND_QUEUE событий. Клиент, который
+не успевает читать (очередь полна или отправка дольше WS_SEND_TIMEOUT),
+отключается с кодом 1013 и при переподключении догоняет пропущенное по after_id.
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.engine import make_url
+
+from .db import ASYNC_DATABASE_URL, AsyncSessionLocal
+from .models import ChatMessage
+from .redis_client import ping_redis
+
+logger = logging.getLogger(__name__)
+
+# канал между процессами: redis | postgres; memory (по умолчанию) — только внутри процесса; off — выключено
+WS_PUSH = os.getenv("WS_PUSH", "memory")
+# окно, за которое токены хода копятся перед публикацией в канал, мс
+WS_TOKEN_WINDOW_MS = float(os.getenv("WS_TOKEN_WINDOW_MS", "50"))
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "256"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+WS_PING_SECONDS = float(os.getenv("WS_PING_SECONDS", "30"))
+# сколько пропущенных сообщений отдаётся при подключении с after_id
+WS_REPLAY_LIMIT = 200
+_PUBLISH_QUEUE = 10000
+_PUBLISH_BATCH = 200
+# NOTIFY ограничен 8000 байтами: длинное сообщение уходит ссылкой на строку chat_messages
+_NOTIFY_MAX_BYTES = 7500
+_MAX_MERGED_DELTA = 2000
+# код закрытия для медленного клиента: «попробуйте позже»
+CLOSE_TOO_SLOW = 1013
+
+
+def message_event(message, key: Optional[str] = None) -> dict:
+    """Событие о сохранённом сообщении (ChatMessage или CachedMessage)."""
+    return {
+        "type": "message",
+        "message": {
+            "id": message.id,
+            "role": message.role,
+            "content": message.content,
+            "created_at": message.created_at.isoformat() if message.created_at else None,
+        },
+        "key": key,
+    }
+
+
+def token_event(delta: str, key: Optional[str] = None) -> dict:
+    return {"type": "token", "delta": delta, "key": key}
+
+
+# ----------------------------
+# Соединение
+# ----------------------------
+
+class Subscriber:
+    """Клиент WebSocket: ограниченная очередь и задача, которая из неё отправляет."""
+
+    def __init__(self, session_id: str, websocket, maxsize: int = WS_SEND_QUEUE):
+        self.session_id = session_id
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.closed = False
+        self.sender: Optional[asyncio.Task] = None
+
+    def offer(self, text: str) -> bool:
+        """False — очередь полна, клиент не успевает читать."""
+        if self.closed:
+            return True
+        try:
+            self.queue.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+
+# ----------------------------
+# Каналы между процессами
+# ----------------------------
+
+def _channel(session_id: str) -> str:
+    # имя канала NOTIFY — идентификатор: без дефисов, не длиннее 63 символов
+    return "chat_" + session_id.replace("-", "")
+
+
+class RedisBus:
+    """Redis pub/sub: канал на сессию, одна подписка процесса."""
+
+    name = "redis"
+    tokens = True
+
+    def __init__(self, client, on_message: Callable[[str, str], None]):
+        self.client = client
+        self.on_message = on_message
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+
+    async def start(self, origin: str) -> None:
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        # собственный канал процесса держит соединение подписки открытым
+        await self._pubsub.subscribe(f"chat_process_{origin}")
+        self._reader = asyncio.create_task(self._read_loop())
+
+    async def stop(self) -> None:
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+            self._pubsub = None
+
+    async def subscribe(self, session_id: str) -> None:
+        await self._pubsub.subscribe(_channel(session_id))
+
+    async def unsubscribe(self, session_id: str) -> None:
+        await self._pubsub.unsubscribe(_channel(session_id))
+
+    async def publish(self, session_id: str, payload: str) -> None:
+        await self.client.publish(_channel(session_id), payload)
+
+    async def _read_loop(self) -> None:
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Подписка Redis на события чата прервалась")
+                await asyncio.sleep(1.0)
+                continue
+            if message is not None and message["type"] == "message":
+                self.on_message(message["channel"], message["data"])
+
+
+class PostgresBus:
+    """LISTEN/NOTIFY: канал на сессию; отдельные соединения для подписки и публикации."""
+
+    name = "postgres"
+    # pg_notify на каждый токен — очередь уведомлений под общей блокировкой commit'а
+    tokens = False
+
+    def __init__(self, dsn: str, on_message: Callable[[str, str], None]):
+        self.dsn = dsn
+        self.on_message = on_message
+        self._listener = None
+        self._publisher = None
+        self._lock = asyncio.Lock()
+
+    async def start(self, origin: str) -> None:
+        import asyncpg
+
+        self._listener = await asyncpg.connect(self.dsn)
+        self._publisher = await asyncpg.connect(self.dsn)
+
+    async def stop(self) -> None:
+        for connection in (self._listener, self._publisher):
+            if connection is not None:
+                try:
+                    await connection.close()
+                except Exception:
+                    pass
+        self._listener = self._publisher = None
+
+    async def subscribe(self, session_id: str) -> None:
+        await self._listener.add_listener(_channel(session_id), self._notify)
+
+    async def unsubscribe(self, session_id: str) -> None:
+        await self._listener.remove_listener(_channel(session_id), self._notify)
+
+    async def publish(self, session_id: str, payload: str) -> None:
+        async with self._lock:
+            await self._publisher.execute("SELECT pg_notify($1, $2)", _channel(session_id), payload)
+
+    def _notify(self, connection, pid, channel, payload) -> None:
+        self.on_message(channel, payload)
+
+
+# ----------------------------
+# Рассылка
+# ----------------------------
+
+class ChatPush:
+    def __init__(self):
+        self.enabled = WS_PUSH != "off"
+        self.origin = uuid.uuid4().hex[:12]
+        self.bus = None
+        self._subscribers: Dict[str, Set[Subscriber]] = {}
+        self._channels: Dict[str, str] = {}   # канал -> session_id для входящих событий
+        self._outbox: Optional[asyncio.Queue] = None
+        self._publisher: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+        # метрики
+        self.delivered = 0
+        self.dropped_clients = 0
+        self.dropped_events = 0
+
+    @property
+    def backend_name(self) -> str:
+        return self.bus.name if self.bus is not None else "memory"
+
+    async def start(self) -> None:
+        if not self.enabled or WS_PUSH not in ("redis", "postgres"):
+            return
+        bus = None
+        if WS_PUSH == "redis":
+            client = await ping_redis()
+            if client is not None:
+                bus = RedisBus(client, self._on_remote)
+            else:
+                logger.warning("WS_PUSH=redis, но Redis недоступен: рассылка только внутри процесса")
+        else:
+            url = make_url(ASYNC_DATABASE_URL)
+            if url.get_backend_name() == "postgresql":
+                dsn = url.set(drivername="postgresql").render_as_string(hide_password=False)
+                bus = PostgresBus(dsn, self._on_remote)
+            else:
+                logger.warning("WS_PUSH=postgres, но база не Postgres: рассылка только внутри процесса")
+        if bus is not None:
+            try:
+                await bus.start(self.origin)
+            except Exception:
+                logger.exception("Канал событий чата (%s) недоступен, рассылка только внутри процесса",
+                                 bus.name)
+                bus = None
+        self.bus = bus
+        if bus is not None:
+            self._outbox = asyncio.Queue(_PUBLISH_QUEUE)
+            self._publisher = asyncio.create_task(self._publish_loop())
+        logger.info("События чата по WebSocket: %s", self.backend_name)
+
+    async def stop(self) -> None:
+        for subscribers in list(self._subscribers.values()):
+            for sub in list(subscribers):
+                await self._close(sub, 1001)
+        if self._publisher is not None:
+            self._publisher.cancel()
+            await asyncio.gather(self._publisher, return_exceptions=True)
+            self._publisher = None
+        if self.bus is not None:
+            await self.bus.stop()
+            self.bus = None
+
+    # --- соединения ---
+
+    async def connect(self, session_id: str, websocket) -> Subscriber:
+        sub = Subscriber(session_id, websocket)
+        subscribers = self._subscribers.setdefault(session_id, set())
+        first = not subscribers
+        subscribers.add(sub)
+        sub.sender = asyncio.create_task(self._send_loop(sub))
+        if first and self.bus is not None:
+            self._channels[_channel(session_id)] = session_id
+            try:
+                await self.bus.subscribe(session_id)
+            except Exception:
+                logger.exception("Не удалось подписаться на события сессии %s", session_id)
+        return sub
+
+    async def disconnect(self, sub: Subscriber) -> None:
+        sub.closed = True
+        if sub.sender is not None and sub.sender is not asyncio.current_task():
+            sub.sender.cancel()
+        subscribers = self._subscribers.get(sub.session_id)
+        if subscribers is None or sub not in subscribers:
+            return
+        subscribers.discard(sub)
+        if not subscribers:
+            del self._subscribers[sub.session_id]
+            if self.bus is not None:
+                self._channels.pop(_channel(sub.session_id), None)
+                try:
+                    await self.bus.unsubscribe(sub.session_id)
+                except Exception:
+                    logger.exception("Не удалось отписаться от событий сессии %s", sub.session_id)
+
+    def send(self, sub: Subscriber, event: dict) -> None:
+        """Событие одному клиенту (догоняющие сообщения при подключении)."""
+        self._offer(sub, json.dumps(event, ensure_ascii=False))
+
+    # --- публикация ---
+
+    def publish(self, session_id: str, event: dict) -> None:
+        """Событие клиентам сессии во всех процессах; не ждёт ни клиентов, ни канала."""
+        if not self.enabled:
+            return
+        if session_id in self._subscribers:
+            self._deliver(session_id, json.dumps(event, ensure_ascii=False))
+        if self._outbox is not None and (self.bus.tokens or event.get("type") != "token"):
+            try:
+                self._outbox.put_nowait((session_id, event))
+            except asyncio.QueueFull:
+                self.dropped_events += 1
+
+    def _deliver(self, session_id: str, text: str) -> None:
+        for sub in list(self._subscribers.get(session_id, ())):
+            self._offer(sub, text)
+
+    def _offer(self, sub: Subscriber, text: str) -> None:
+        if sub.offer(text):
+            return
+        # не успевает читать — отключаем, а не копим события и не ждём его
+        sub.closed = True
+        self.dropped_clients += 1
+        logger.warning("WebSocket сессии %s не успевает читать, соединение закрыто", sub.session_id)
+        self._spawn(self._close(sub, CLOSE_TOO_SLOW))
+
+    async def _send_loop(self, sub: Subscriber) -> None:
+        while True:
+            if not sub.queue.empty():
+                # события идут потоком (токены) — без лишней задачи wait_for на каждое
+                text = sub.queue.get_nowait()
+            else:
+                try:
+                    text = await asyncio.wait_for(sub.queue.get(), WS_PING_SECONDS)
+                except asyncio.TimeoutError:
+                    text = '{"type": "ping"}'
+            try:
+                async with asyncio.timeout(WS_SEND_TIMEOUT):
+                    await sub.websocket.send_text(text)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                self.dropped_clients += 1
+                await self._close(sub, CLOSE_TOO_SLOW)
+                return
+            except Exception:
+                # клиент отключился — соединение закроет обработчик
+                await self.disconnect(sub)
+                return
+            self.delivered += 1
+
+    async def _close(self, sub: Subscriber, code: int) -> None:
+        await self.disconnect(sub)
+        try:
+            await sub.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.get_running_loop().create_task(coro)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    # --- канал между процессами ---
+
+    async def _publish_loop(self) -> None:
+        while True:
+            batch = [await self._outbox.get()]
+            if batch[0][1].get("type") == "token" and WS_TOKEN_WINDOW_MS > 0:
+                # токены хода копятся за окно и уходят одной публикацией
+                await asyncio.sleep(WS_TOKEN_WINDOW_MS / 1000)
+            while len(batch) < _PUBLISH_BATCH and not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+            for session_id, event in _merge_tokens(batch):
+                try:
+                    await self.bus.publish(session_id, self._envelope(event))
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.dropped_events += 1
+                    logger.exception("Не удалось опубликовать событие сессии %s", session_id)
+
+    def _envelope(self, event: dict) -> str:
+        """origin|kind|json: kind event — событие как есть, ref — ссылка на строку chat_messages."""
+        payload = f"{self.origin}|event|{json.dumps(event, ensure_ascii=False)}"
+        if isinstance(self.bus, PostgresBus) and len(payload.encode()) > _NOTIFY_MAX_BYTES \
+                and event.get("type") == "message":
+            ref = {"id": event["message"]["id"], "key": event.get("key")}
+            payload = f"{self.origin}|ref|{json.dumps(ref)}"
+        return payload
+
+    def _on_remote(self, channel: str, payload: str) -> None:
+        session_id = self._channels.get(channel)
+        if session_id is None:
+            return
+        origin, kind, text = payload.split("|", 2)
+        if origin == self.origin:
+            return  # своим клиентам уже доставлено
+        if kind == "ref":
+            self._spawn(self._deliver_ref(session_id, json.loads(text)))
+        elif kind == "event":
+            self._deliver(session_id, text)
+
+    async def _deliver_ref(self, session_id: str, ref: dict) -> None:
+        async with AsyncSessionLocal() as db:
+            message = await db.get(ChatMessage, ref["id"])
+        if message is not None:
+            self._deliver(session_id, json.dumps(message_event(message, ref.get("key")), ensure_ascii=False))
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend_name if self.enabled else "off",
+            "sessions": len(self._subscribers),
+            "connections": sum(len(s) for s in self._subscribers.values()),
+            "delivered": self.delivered,
+            "dropped_clients": self.dropped_clients,
+            "dropped_events": self.dropped_events,
+        }
+
+
+def _merge_tokens(batch: List[Tuple[str, dict]]) -> List[Tuple[str, dict]]:
+    """Токены одного хода — одним событием (меньше публикаций в канал).
+
+    Токен дописывается к предыдущему токену своей сессии, если между ними в
+    этой сессии не было других событий: порядок событий сессии сохраняется,
+    события других сессий склейке не мешают.
+    """
+    merged: List[Tuple[str, dict]] = []
+    open_tokens: Dict[str, int] = {}   # сессия -> индекс её последнего токена в merged
+    for session_id, event in batch:
+        index = open_tokens.pop(session_id, None)
+        if event.get("type") == "token":
+            if index is not None:
+                last = merged[index][1]
+                if last.get("key") == event.get("key") and len(last["delta"]) < _MAX_MERGED_DELTA:
+                    merged[index] = (session_id, {**last, "delta": last["delta"] + event["delta"]})
+                    open_tokens[session_id] = index
+                    continue
+            open_tokens[session_id] = len(merged)
+        merged.append((session_id, event))
+    return merged
+
+
+chat_push = ChatPush()
@@ -0,0 +1,161 @@
+"""Построители SQL-запросов горячих путей чата.
+
+Вынесены отдельно, чтобы приложение и проверка планов запросов
+(backend/bench/query_plans.py) использовали одни и те же выражения.
+query_name в execution_options — метка запроса в db_query_seconds (metrics.py).
+"""
+import json
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Select, String, cast, func, literal, select, text, type_coerce
+from sqlalchemy.dialects.postgresql import JSONB
+
+from .models import ChatMessage, ChatSession, UserProfile
+
+
+def user_session(user_id: int, assistant_id: int) -> Select:
+    """Сессия пользователя с ассистентом (она одна — уникальный индекс)."""
+    return select(ChatSession.id).where(
+        ChatSession.user_id == user_id, ChatSession.assistant_id == assistant_id
+    ).execution_options(query_name="user_session")
+
+
+# Открытие сессии на Postgres одним запросом: upsert пользователя, поиск его
+# сессии с ассистентом и, если её нет, создание сессии со ссылкой на текущую
+# версию промта ассистента. Пустой session_id в ответе — проиграли гонку
+# параллельной вставке, которая не видна в снимке этого запроса; повторный
+# запрос её увидит.
+OPEN_SESSION_SQL = text("""
+WITH new_user AS (
+    INSERT INTO users (telegram_id, created_at)
+    SELECT CAST(:telegram_id AS VARCHAR), CAST(:now AS TIMESTAMP)
+    WHERE NOT EXISTS (SELECT 1 FROM users WHERE telegram_id = :telegram_id)
+    ON CONFLICT (telegram_id) DO NOTHING
+    RETURNING id
+), u AS (
+    SELECT id FROM new_user
+    UNION ALL
+    SELECT id FROM users WHERE telegram_id = :telegram_id
+), old_session AS (
+    SELECT s.id FROM chat_sessions s JOIN u ON s.user_id = u.id
+    WHERE s.assistant_id = :assistant_id
+), new_session AS (
+    INSERT INTO chat_sessions (id, user_id, assistant_id, prompt_version_id, created_at)
+    SELECT CAST(:session_id AS VARCHAR), u.id, CAST(:assistant_id AS INTEGER),
+           CAST(:prompt_version_id AS INTEGER), CAST(:now AS TIMESTAMP)
+    FROM u
+    WHERE NOT EXISTS (SELECT 1 FROM old_session)
+    ON CONFLICT (user_id, assistant_id) DO NOTHING
+    RETURNING id
+)
+SELECT u.id AS user_id,
+       COALESCE(new_session.id, old_session.id) AS session_id,
+       new_session.id IS NOT NULL AS created
+FROM u
+LEFT JOIN old_session ON true
+LEFT JOIN new_session ON true
+""").execution_options(query_name="open_session")
+
+
+def session_tail(session_id: str, limit: int) -> Select:
+    """Последние limit реплик сессии (без system), от новых к старым."""
+    return (
+        select(ChatMessage)
+        .where(ChatMessage.session_id == session_id, ChatMessage.role != "system")
+        .order_by(ChatMessage.id.desc())
+        .limit(limit)
+        .execution_options(query_name="session_tail")
+    )
+
+
+def last_message_id(session_id: str) -> Select:
+    # max(id) по индексу (session_id, id) — строки сообщений не читаются
+    return (
+        select(func.max(ChatMessage.id))
+        .where(ChatMessage.session_id == session_id)
+        .execution_options(query_name="last_message_id")
+    )
+
+
+def reply_after(session_id: str, message_id: int) -> Select:
+    """Первый ответ ассистента после сообщения message_id (повтор задания очереди)."""
+    return (
+        select(ChatMessage)
+        .where(
+            ChatMessage.session_id == session_id,
+            ChatMessage.id > message_id,
+            ChatMessage.role == "assistant",
+        )
+        .order_by(ChatMessage.id)
+        .limit(1)
+        .execution_options(query_name="reply_after")
+    )
+
+
+def summary_gap(session_id: str, after_id: Optional[int], before_id: int, limit: int) -> Select:
+    """Реплики между summary_until_id и началом хвоста в кэше, от старых к новым
+    (не свёрнутые в summary и не попавшие в кэш — их дочитывает update_summary)."""
+    query = select(ChatMessage).where(
+        ChatMessage.session_id == session_id,
+        ChatMessage.role != "system",
+        ChatMessage.id < before_id,
+    )
+    if after_id is not None:
+        query = query.where(ChatMessage.id > after_id)
+    return query.order_by(ChatMessage.id).limit(limit).execution_options(query_name="summary_gap")
+
+
+def history_page(session_id: str, before_id: Optional[int] = None,
+                 after_id: Optional[int] = None, limit: Optional[int] = None) -> Select:
+    """Страница истории (keyset по id). Дельта (только after_id) читается от курсора
+    вперёд, остальные режимы — с конца; limit + 1 строка для флага has_more."""
+    query = select(ChatMessage).where(
+        ChatMessage.session_id == session_id,
+        ChatMessage.role != "system",
+    )
+    if before_id is not None:
+        query = query.where(ChatMessage.id < before_id)
+    if after_id is not None:
+        query = query.where(ChatMessage.id > after_id)
+
+    forward = after_id is not None and before_id is None
+    query = query.order_by(ChatMessage.id if forward else ChatMessage.id.desc())
+    if limit is not None:
+        query = query.limit(limit + 1)
+    return query.execution_options(query_name="history_page")
+
+
+def user_request_counts(user_id: int, day_start: datetime, month_start: datetime) -> Select:
+    """(за сутки, за месяц) — число сообщений пользователя во всех его сессиях.
+
+    Источник истины для счётчиков квот; читается только при их инициализации
+    и периодической сверке, не на каждый запрос.
+    """
+    return (
+        select(
+            func.count(ChatMessage.id).filter(ChatMessage.created_at >= day_start),
+            func.count(ChatMessage.id),
+        )
+        .select_from(ChatMessage)
+        .join(ChatSession, ChatSession.id == ChatMessage.session_id)
+        .where(
+            ChatSession.user_id == user_id,
+            ChatMessage.role == "user",
+            ChatMessage.created_at >= month_start,
+        )
+        .execution_options(query_name="user_request_counts")
+    )
+
+
+def profiles_containing(fragment: dict) -> Select:
+    """user_id пользователей, в анкете которых есть fragment (data @> fragment).
+
+    Например {"children": [{"sex": "f"}]} или {"feeding": "смешанное"}.
+    Только Postgres (JSONB): запрос идёт по GIN-индексу ix_user_profiles_data.
+    """
+    return (
+        select(UserProfile.user_id)
+        .where(type_coerce(UserProfile.data, JSONB).contains(cast(literal(json.dumps(fragment, ensure_ascii=False), String), JSONB)))
+        .execution_options(query_name="profiles_containing")
+    )
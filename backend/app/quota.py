@@ -0,0 +1,344 @@
+"""Квоты запросов к ассистентам (суточная и месячная) по таблице user_limits.
+
+Проверка и списание идут по заранее агрегированным счётчикам, а не по подсчёту
+chat_messages на каждый запрос:
+  * Redis (если задан REDIS_URL) — проверка обоих лимитов и инкремент одним
+    Lua-скриптом, счётчики общие для всех воркеров;
+  * иначе — счётчики в памяти процесса (один узел, локальный запуск).
+
+Счётчик — это число сообщений пользователя (role=user) за период, поэтому он
+инициализируется из БД при первом обращении в периоде и раз в
+QUOTA_RECONCILE_SECONDS сверяется с БД: значение только подтягивается вверх
+(например, после рестарта Redis или если пользователь писал через другой воркер).
+Периоды считаются в UTC. Лимиты пользователя кэшируются на QUOTA_LIMITS_TTL секунд.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import queries
+from .db import AsyncSessionLocal
+from .models import UserLimit
+from .redis_client import ping_redis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DAILY_REQUESTS = int(os.getenv("DEFAULT_DAILY_REQUESTS", "30"))
+DEFAULT_MONTHLY_REQUESTS = int(os.getenv("DEFAULT_MONTHLY_REQUESTS", "200"))
+QUOTA_LIMITS_TTL = float(os.getenv("QUOTA_LIMITS_TTL", "60"))
+QUOTA_RECONCILE_SECONDS = float(os.getenv("QUOTA_RECONCILE_SECONDS", "300"))
+_LIMITS_CACHE_SIZE = 10000
+# ключ счётчика живёт чуть дольше своего периода
+_KEY_GRACE_SECONDS = 3600
+
+QUOTA_HEADERS = [
+    "X-Quota-Daily-Limit",
+    "X-Quota-Daily-Remaining",
+    "X-Quota-Monthly-Limit",
+    "X-Quota-Monthly-Remaining",
+]
+
+
+@dataclass(frozen=True)
+class QuotaLimits:
+    daily: int
+    monthly: int
+    tier: Optional[str] = None  # тариф пользователя (для выбора модели, см. routing.py)
+
+    @classmethod
+    def from_row(cls, row: Optional[UserLimit]) -> "QuotaLimits":
+        if row is None:
+            return cls(DEFAULT_DAILY_REQUESTS, DEFAULT_MONTHLY_REQUESTS)
+        daily = row.daily_requests_base
+        monthly = row.monthly_requests_base
+        return cls(
+            daily=(DEFAULT_DAILY_REQUESTS if daily is None else daily) + (row.daily_requests_bonus or 0),
+            monthly=(DEFAULT_MONTHLY_REQUESTS if monthly is None else monthly) + (row.monthly_requests_bonus or 0),
+            tier=row.tier,
+        )
+
+
+@dataclass(frozen=True)
+class QuotaStatus:
+    allowed: bool
+    limits: QuotaLimits
+    daily_used: int
+    monthly_used: int
+    retry_after: int = 0  # секунд до сброса исчерпанного лимита
+
+    @property
+    def daily_remaining(self) -> int:
+        return max(0, self.limits.daily - self.daily_used)
+
+    @property
+    def monthly_remaining(self) -> int:
+        return max(0, self.limits.monthly - self.monthly_used)
+
+    def headers(self) -> Dict[str, str]:
+        headers = dict(zip(QUOTA_HEADERS, map(str, (
+            self.limits.daily, self.daily_remaining,
+            self.limits.monthly, self.monthly_remaining,
+        ))))
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+@dataclass(frozen=True)
+class _Periods:
+    day_start: datetime
+    month_start: datetime
+    day_ttl: int    # секунд до конца суток
+    month_ttl: int  # секунд до конца месяца
+
+    @classmethod
+    def current(cls, now: Optional[datetime] = None) -> "_Periods":
+        now = now or datetime.utcnow()
+        day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        month_start = day_start.replace(day=1)
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        return cls(
+            day_start=day_start,
+            month_start=month_start,
+            day_ttl=max(1, int((day_start + timedelta(days=1) - now).total_seconds())),
+            month_ttl=max(1, int((next_month - now).total_seconds())),
+        )
+
+    def keys(self, user_id: int) -> Tuple[str, str]:
+        return (
+            f"quota:{user_id}:d:{self.day_start:%Y%m%d}",
+            f"quota:{user_id}:m:{self.month_start:%Y%m}",
+        )
+
+    def ttls(self) -> Tuple[int, int]:
+        return self.day_ttl + _KEY_GRACE_SECONDS, self.month_ttl + _KEY_GRACE_SECONDS
+
+
+# ----------------------------
+# Хранилища счётчиков
+# ----------------------------
+
+class MemoryCounters:
+    """Счётчики в памяти процесса. Методы не уступают управление внутри
+    проверки и инкремента, поэтому в рамках event loop операции атомарны."""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[int, float]] = {}
+
+    def _get(self, key: str) -> Optional[int]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return item[0]
+
+    def _set(self, key: str, value: int, ttl: int) -> None:
+        self._data[key] = (value, time.monotonic() + ttl)
+
+    async def consume(self, keys: Sequence[str], limits: Sequence[int],
+                      ttls: Sequence[int]) -> Optional[Tuple[bool, int, int]]:
+        """(allowed, used_day, used_month) или None, если счётчики не инициализированы."""
+        values = [self._get(k) for k in keys]
+        if None in values:
+            return None
+        daily, monthly = values
+        if daily >= limits[0] or monthly >= limits[1]:
+            return False, daily, monthly
+        for key, value, ttl in zip(keys, (daily + 1, monthly + 1), ttls):
+            self._data[key] = (value, self._data[key][1])
+        return True, daily + 1, monthly + 1
+
+    async def seed(self, key: str, value: int, ttl: int) -> None:
+        if self._get(key) is None:
+            self._set(key, value, ttl)
+
+    async def raise_to(self, key: str, value: int, ttl: int) -> None:
+        current = self._get(key)
+        if current is not None and current < value:
+            self._data[key] = (value, self._data[key][1])
+        elif current is None:
+            self._set(key, value, ttl)
+
+    def prune(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, (_, exp) in self._data.items() if exp <= now]:
+            del self._data[key]
+
+
+_CONSUME_LUA = """
+local d = redis.call('GET', KEYS[1])
+local m = redis.call('GET', KEYS[2])
+if not d or not m then return {-1, 0, 0} end
+d = tonumber(d)
+m = tonumber(m)
+if d >= tonumber(ARGV[1]) or m >= tonumber(ARGV[2]) then return {0, d, m} end
+return {1, redis.call('INCR', KEYS[1]), redis.call('INCR', KEYS[2])}
+"""
+
+_RAISE_TO_LUA = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '-1')
+if current < tonumber(ARGV[1]) then
+  if current < 0 then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+  else
+    redis.call('SET', KEYS[1], ARGV[1], 'KEEPTTL')
+  end
+end
+return 1
+"""
+
+
+class RedisCounters:
+    """Счётчики в Redis, общие для всех воркеров."""
+
+    def __init__(self, client):
+        self.client = client
+        self._consume = client.register_script(_CONSUME_LUA)
+        self._raise_to = client.register_script(_RAISE_TO_LUA)
+
+    async def consume(self, keys: Sequence[str], limits: Sequence[int],
+                      ttls: Sequence[int]) -> Optional[Tuple[bool, int, int]]:
+        status, daily, monthly = await self._consume(keys=list(keys), args=list(limits))
+        if int(status) < 0:
+            return None
+        return bool(int(status)), int(daily), int(monthly)
+
+    async def seed(self, key: str, value: int, ttl: int) -> None:
+        await self.client.set(key, value, ex=ttl, nx=True)
+
+    async def raise_to(self, key: str, value: int, ttl: int) -> None:
+        await self._raise_to(keys=[key], args=[value, ttl])
+
+    def prune(self) -> None:
+        pass  # истечение ключей делает сам Redis
+
+
+# ----------------------------
+# Движок квот
+# ----------------------------
+
+class QuotaEngine:
+    def __init__(self):
+        self.backend = MemoryCounters()
+        self.rejected = 0
+        self._limits: "OrderedDict[int, Tuple[QuotaLimits, float]]" = OrderedDict()
+        self._active = set()  # пользователи, чьи счётчики менялись с последней сверки
+        self._reconciler: Optional[asyncio.Task] = None
+
+    @property
+    def backend_name(self) -> str:
+        return "redis" if isinstance(self.backend, RedisCounters) else "memory"
+
+    async def start(self) -> None:
+        client = await ping_redis()
+        if client is not None:
+            self.backend = RedisCounters(client)
+        logger.info("Квоты: счётчики в %s", self.backend_name)
+        self._reconciler = asyncio.create_task(self._reconcile_loop())
+
+    async def stop(self) -> None:
+        if self._reconciler is not None:
+            self._reconciler.cancel()
+            try:
+                await self._reconciler
+            except asyncio.CancelledError:
+                pass
+            self._reconciler = None
+
+    # --- лимиты пользователя ---
+
+    async def limits_for(self, db: AsyncSession, user_id: int) -> QuotaLimits:
+        cached = self._limits.get(user_id)
+        if cached is not None and time.monotonic() - cached[1] < QUOTA_LIMITS_TTL:
+            return cached[0]
+        row = await db.scalar(select(UserLimit).where(UserLimit.user_id == user_id))
+        limits = QuotaLimits.from_row(row)
+        self._limits[user_id] = (limits, time.monotonic())
+        self._limits.move_to_end(user_id)
+        while len(self._limits) > _LIMITS_CACHE_SIZE:
+            self._limits.popitem(last=False)
+        return limits
+
+    def invalidate_limits(self, user_id: int) -> None:
+        """Сбросить кэш лимитов (после изменения user_limits, например начисления бонуса)."""
+        self._limits.pop(user_id, None)
+
+    # --- списание ---
+
+    async def consume(self, db: AsyncSession, user_id: int) -> Optional[QuotaStatus]:
+        """Проверяет оба лимита и, если они не исчерпаны, списывает один запрос.
+
+        None — счётчики недоступны (например, упал Redis): запрос пропускается
+        без проверки, чтобы сбой хранилища квот не останавливал чат.
+        """
+        limits = await self.limits_for(db, user_id)
+        periods = _Periods.current()
+        keys, ttls = periods.keys(user_id), periods.ttls()
+        bounds = (limits.daily, limits.monthly)
+        try:
+            result = await self.backend.consume(keys, bounds, ttls)
+            if result is None:
+                # первый запрос пользователя в периоде — берём точку отсчёта из БД
+                daily, monthly = (await db.execute(
+                    queries.user_request_counts(user_id, periods.day_start, periods.month_start)
+                )).one()
+                await self.backend.seed(keys[0], daily, ttls[0])
+                await self.backend.seed(keys[1], monthly, ttls[1])
+                result = await self.backend.consume(keys, bounds, ttls)
+        except Exception:
+            logger.exception("Счётчики квот недоступны, запрос пропущен без проверки")
+            return None
+        if result is None:
+            return None
+
+        allowed, daily_used, monthly_used = result
+        self._active.add(user_id)
+        retry_after = 0
+        if not allowed:
+            self.rejected += 1
+            retry_after = periods.day_ttl if daily_used >= limits.daily else periods.month_ttl
+        return QuotaStatus(allowed, limits, daily_used, monthly_used, retry_after)
+
+    # --- сверка с БД ---
+
+    async def reconcile(self) -> int:
+        """Подтягивает счётчики недавно активных пользователей к числу сообщений в БД."""
+        users, self._active = self._active, set()
+        if not users:
+            return 0
+        periods = _Periods.current()
+        ttls = periods.ttls()
+        async with AsyncSessionLocal() as db:
+            for user_id in users:
+                daily, monthly = (await db.execute(
+                    queries.user_request_counts(user_id, periods.day_start, periods.month_start)
+                )).one()
+                keys = periods.keys(user_id)
+                await self.backend.raise_to(keys[0], daily, ttls[0])
+                await self.backend.raise_to(keys[1], monthly, ttls[1])
+        self.backend.prune()
+        return len(users)
+
+    async def _reconcile_loop(self) -> None:
+        while True:
+            await asyncio.sleep(QUOTA_RECONCILE_SECONDS)
+            try:
+                await self.reconcile()
+            except Exception:
+                logger.exception("Не удалось сверить счётчики квот с БД")
+
+    def stats(self) -> dict:
+        return {"backend": self.backend_name, "rejected": self.rejected}
+
+
+quota_engine = QuotaEngine()
@@ -0,0 +1,281 @@
+"""Ограничение частоты запросов (GCRA) по IP и по telegram_id.
+
+ASGI-middleware срабатывает до маршрутизации, поэтому отклонённый запрос
+получает 429 с Retry-After, не открывая сессию БД и не занимая слот OpenAI.
+
+GCRA хранит на ключ одно число — теоретическое время следующего запроса (TAT):
+запрос пропускается, если now >= TAT - tau, после чего TAT += interval.
+interval = 60 / лимит в минуту, tau = interval * (burst - 1); при burst, равном
+минутному лимиту, это эквивалент скользящего окна в одну минуту.
+
+Хранилища:
+  * в памяти процесса — словарь без блокировок (проверка и запись выполняются
+    без await, event loop не переключается между ними);
+  * Redis (если задан REDIS_URL) — Lua-скрипт, проверяющий и обновляющий все
+    ключи запроса атомарно; лимит общий для всех воркеров.
+
+IP берётся из scope["client"]: за прокси uvicorn нужно запускать с
+--proxy-headers, тогда там будет адрес из X-Forwarded-For. telegram_id —
+заголовок X-Telegram-Id или поле telegram_id JSON-тела (/chat/session).
+"""
+import json
+import logging
+import math
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .redis_client import ping_redis
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", "120"))
+RATE_LIMIT_USER_PER_MINUTE = int(os.getenv("RATE_LIMIT_USER_PER_MINUTE", str(RATE_LIMIT_PER_MINUTE)))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "0"))  # 0 — равен минутному лимиту
+RATE_LIMIT_EXEMPT_PATHS = {"/health", "/metrics"}
+# тело читается только у небольших JSON-запросов без заголовка X-Telegram-Id
+_MAX_PEEK_BODY = 16 * 1024
+_MAX_MEMORY_KEYS = 100_000
+_REDIS_ERROR_LOG_INTERVAL = 60.0
+
+
+class Rate:
+    """Параметры GCRA для лимита per_minute запросов в минуту."""
+
+    __slots__ = ("per_minute", "interval", "tau")
+
+    def __init__(self, per_minute: int, burst: int = 0):
+        self.per_minute = per_minute
+        self.interval = 60.0 / per_minute
+        self.tau = self.interval * ((burst or per_minute) - 1)
+
+
+# ----------------------------
+# Хранилища
+# ----------------------------
+
+class MemoryRateLimiter:
+    def __init__(self, max_keys: int = _MAX_MEMORY_KEYS):
+        self.max_keys = max_keys
+        self._tat: Dict[str, float] = {}
+
+    async def hit(self, items: Sequence[Tuple[str, Rate]]) -> float:
+        return self.hit_nowait(items)
+
+    def hit_nowait(self, items: Sequence[Tuple[str, Rate]]) -> float:
+        """0.0, если запрос пропущен (TAT всех ключей сдвинут), иначе секунды до допуска."""
+        now = time.monotonic()
+        tats = self._tat
+        retry_after = 0.0
+        for key, rate in items:
+            tat = tats.get(key, now)
+            wait = tat - rate.tau - now
+            if wait > retry_after:
+                retry_after = wait
+        if retry_after > 0:
+            return retry_after
+        for key, rate in items:
+            tat = tats.get(key, now)
+            tats[key] = (tat if tat > now else now) + rate.interval
+        if len(tats) > self.max_keys:
+            self._prune(now)
+        return 0.0
+
+    def _prune(self, now: float) -> None:
+        # ключ с TAT в прошлом ничем не отличается от отсутствующего
+        stale = [k for k, tat in self._tat.items() if tat <= now]
+        for key in stale:
+            del self._tat[key]
+        if len(self._tat) > self.max_keys:
+            self._tat.clear()
+
+
+_GCRA_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local wait = 0
+local tats = {}
+for i, key in ipairs(KEYS) do
+  local tau = tonumber(ARGV[i * 2])
+  local tat = tonumber(redis.call('GET', key) or now)
+  if tat < now then tat = now end
+  tats[i] = tat
+  if tat - tau - now > wait then wait = tat - tau - now end
+end
+if wait > 0 then return tostring(wait) end
+for i, key in ipairs(KEYS) do
+  local tat = tats[i] + tonumber(ARGV[i * 2 - 1])
+  redis.call('SET', key, tostring(tat), 'PX', math.ceil((tat - now) * 1000) + 1)
+end
+return '0'
+"""
+
+
+class RedisRateLimiter:
+    def __init__(self, client, prefix: str = "rl:"):
+        self.prefix = prefix
+        self._script = client.register_script(_GCRA_LUA)
+
+    async def hit(self, items: Sequence[Tuple[str, Rate]]) -> float:
+        keys, args = [], []
+        for key, rate in items:
+            keys.append(self.prefix + key)
+            args += [repr(rate.interval), repr(rate.tau)]
+        return float(await self._script(keys=keys, args=args))
+
+
+class RateLimiter:
+    def __init__(self, ip_rate: Optional[Rate], user_rate: Optional[Rate]):
+        self.ip_rate = ip_rate
+        self.user_rate = user_rate
+        self.memory = MemoryRateLimiter()
+        self.backend = self.memory
+        self.rejected = 0
+        self._last_error_log = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ip_rate is not None or self.user_rate is not None
+
+    @property
+    def backend_name(self) -> str:
+        return "redis" if isinstance(self.backend, RedisRateLimiter) else "memory"
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        client = await ping_redis()
+        if client is not None:
+            self.backend = RedisRateLimiter(client)
+
+    def items(self, ip: Optional[str], telegram_id: Optional[str]) -> List[Tuple[str, Rate]]:
+        items = []
+        if ip and self.ip_rate is not None:
+            items.append(("ip:" + ip, self.ip_rate))
+        if telegram_id and self.user_rate is not None:
+            items.append(("tg:" + telegram_id, self.user_rate))
+        return items
+
+    async def check(self, ip: Optional[str], telegram_id: Optional[str]) -> float:
+        items = self.items(ip, telegram_id)
+        if not items:
+            return 0.0
+        if self.backend is self.memory:
+            retry_after = self.memory.hit_nowait(items)
+        else:
+            try:
+                retry_after = await self.backend.hit(items)
+            except Exception:
+                # Redis недоступен — ограничиваем хотя бы в пределах процесса
+                now = time.monotonic()
+                if now - self._last_error_log > _REDIS_ERROR_LOG_INTERVAL:
+                    self._last_error_log = now
+                    logger.exception("Rate limit: Redis недоступен, лимит считается в памяти процесса")
+                retry_after = self.memory.hit_nowait(items)
+        if retry_after > 0:
+            self.rejected += 1
+        return retry_after
+
+    def stats(self) -> dict:
+        return {"backend": self.backend_name, "rejected": self.rejected}
+
+
+def _rate(per_minute: int) -> Optional[Rate]:
+    return Rate(per_minute, min(RATE_LIMIT_BURST, per_minute)) if per_minute > 0 else None
+
+
+rate_limiter = RateLimiter(_rate(RATE_LIMIT_PER_MINUTE), _rate(RATE_LIMIT_USER_PER_MINUTE))
+
+
+# ----------------------------
+# ASGI middleware
+# ----------------------------
+
+_TOO_MANY = json.dumps({"detail": "Слишком много запросов, попробуйте позже"}, ensure_ascii=False).encode()
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, limiter: RateLimiter = rate_limiter,
+                 exempt_paths=frozenset(RATE_LIMIT_EXEMPT_PATHS)):
+        self.app = app
+        self.limiter = limiter
+        self.exempt_paths = exempt_paths
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or not self.limiter.enabled
+                or scope["method"] == "OPTIONS" or scope["path"] in self.exempt_paths):
+            return await self.app(scope, receive, send)
+
+        client = scope.get("client")
+        ip = client[0] if client else None
+        telegram_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-telegram-id":
+                telegram_id = value.decode("latin-1")
+                break
+        if telegram_id is None and self.limiter.user_rate is not None and scope["method"] == "POST":
+            telegram_id, receive = await _peek_telegram_id(scope, receive)
+
+        retry_after = await self.limiter.check(ip, telegram_id)
+        if retry_after > 0:
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(_TOO_MANY)).encode()),
+                    (b"retry-after", str(math.ceil(retry_after)).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": _TOO_MANY})
+            return
+        await self.app(scope, receive, send)
+
+
+async def _peek_telegram_id(scope, receive):
+    """Читает небольшое JSON-тело, достаёт telegram_id и возвращает receive,
+    отдающий приложению то же тело заново.
+
+    Тело без Content-Length (chunked) не читается: его длина заранее неизвестна.
+    Больше _MAX_PEEK_BODY байт в память не читается, даже если Content-Length
+    занижен: прочитанное отдаётся приложению, остальное — из исходного receive.
+    """
+    headers = dict(scope["headers"])
+    if not headers.get(b"content-type", b"").startswith(b"application/json"):
+        return None, receive
+    try:
+        if int(headers[b"content-length"]) > _MAX_PEEK_BODY:
+            return None, receive
+    except (KeyError, ValueError):
+        return None, receive
+
+    chunks = []
+    messages = []
+    size = 0
+    complete = False
+    while size <= _MAX_PEEK_BODY:
+        message = await receive()
+        messages.append(message)
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        size += len(chunks[-1])
+        if not message.get("more_body"):
+            complete = True
+            break
+
+    telegram_id = None
+    if complete and size <= _MAX_PEEK_BODY:
+        try:
+            data = json.loads(b"".join(chunks))
+            if isinstance(data, dict) and data.get("telegram_id") is not None:
+                telegram_id = str(data["telegram_id"])
+        except ValueError:
+            pass
+
+    async def replay():
+        if messages:
+            return messages.pop(0)
+        return await receive()
+
+    return telegram_id, replay
@@ -0,0 +1,47 @@
+"""Общее подключение к Redis.
+
+Redis необязателен: без REDIS_URL get_redis() возвращает None и подсистемы
+(квоты и т.п.) работают на счётчиках в памяти процесса — этого достаточно
+для одного воркера и для локального запуска.
+"""
+import logging
+import os
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "")
+
+_client = None
+
+
+def get_redis():
+    """Клиент redis.asyncio (один на процесс) или None, если Redis не настроен."""
+    global _client
+    if not REDIS_URL:
+        return None
+    if _client is None:
+        import redis.asyncio as redis
+
+        _client = redis.from_url(REDIS_URL, decode_responses=True)
+    return _client
+
+
+async def ping_redis() -> Optional[object]:
+    """Клиент, если Redis настроен и отвечает, иначе None (с записью в лог)."""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        await client.ping()
+        return client
+    except Exception:
+        logger.exception("Redis %s недоступен", REDIS_URL)
+        return None
+
+
+async def close_redis() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
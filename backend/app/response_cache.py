@@ -0,0 +1,205 @@
+"""Кэш ответов на первые вопросы сессии.
+
+Многие сессии начинаются с одного и того же вопроса к одному ассистенту
+(«ребёнок плохо спит», «сколько должен есть трёхмесячный»). Для ассистентов,
+у которых в extra_config задан response_cache_ttl (секунды), ответ на первое
+сообщение сессии кэшируется и повторный такой же вопрос не идёт в OpenAI.
+
+Ключ — id ассистента, id текущей версии промта, модель и нормализованный
+текст вопроса (и найденные фрагменты базы знаний, если они попали в контекст):
+после правки промта или статьи старые ответы не отдаются. Кэш применяется, только если в сессии ещё нет
+реплик пользователя (дальше ответ зависит от истории) и у пользователя нет анкеты
+(app/profiles.py): ответ с её учётом личный.
+
+Хранилище — LRU в памяти процесса или Redis (если задан REDIS_URL), в обоих
+случаях с TTL и ограничением RESPONSE_CACHE_SIZE записей.
+"""
+import hashlib
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Tuple
+
+from .redis_client import ping_redis
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+# длиннее — это уже не типовой вопрос, а рассказ о своей ситуации
+RESPONSE_CACHE_MAX_QUESTION_CHARS = 300
+
+_SPACES = re.compile(r"\s+")
+_EDGE_PUNCT = re.compile(r"^[\s.,!?…:;\-—\"'«»()]+|[\s.,!?…:;\-—\"'«»()]+$")
+
+
+def normalize_question(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    text = _SPACES.sub(" ", text)
+    return _EDGE_PUNCT.sub("", text)
+
+
+def cache_ttl(extra_config: dict) -> int:
+    try:
+        return max(0, int((extra_config or {}).get("response_cache_ttl") or 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def cache_key(assistant, model: str, question: str, grounding: Optional[dict] = None,
+              few_shot: Sequence[dict] = ()) -> Optional[str]:
+    """Ключ кэша или None, если для ассистента/вопроса кэш не применяется.
+
+    grounding — фрагменты базы знаний, few_shot — примеры в контексте: ответ зависит и от них.
+    """
+    if not cache_ttl(assistant.extra_config):
+        return None
+    normalized = normalize_question(question)
+    if not normalized or len(normalized) > RESPONSE_CACHE_MAX_QUESTION_CHARS:
+        return None
+    if grounding is not None:
+        normalized = f"{normalized}\0{grounding['content']}"
+    for message in few_shot:
+        normalized = f"{normalized}\0{message['content']}"
+    digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+    return f"{assistant.id}:{assistant.prompt_version_id}:{model}:{digest}"
+
+
+# ----------------------------
+# Хранилища
+# ----------------------------
+
+class MemoryResponseStore:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._data: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return item[0]
+
+    async def set(self, key: str, reply: str, ttl: int) -> None:
+        self._data[key] = (reply, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def size(self) -> Optional[int]:
+        return len(self._data)
+
+
+_REDIS_SET_LUA = """
+local t = redis.call('TIME')
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], t[1], KEYS[1])
+local extra = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[3])
+if extra > 0 then
+  local old = redis.call('ZRANGE', KEYS[2], 0, extra - 1)
+  redis.call('ZREMRANGEBYRANK', KEYS[2], 0, extra - 1)
+  for _, key in ipairs(old) do redis.call('DEL', key) end
+  return extra
+end
+return 0
+"""
+
+
+class RedisResponseStore:
+    """Записи с TTL в Redis; sorted set по времени записи ограничивает их число."""
+
+    def __init__(self, client, maxsize: int, prefix: str = "rc:"):
+        self.client = client
+        self.maxsize = maxsize
+        self.prefix = prefix
+        self.index_key = prefix + "index"
+        self.evictions = 0
+        self._set = client.register_script(_REDIS_SET_LUA)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, reply: str, ttl: int) -> None:
+        evicted = await self._set(
+            keys=[self.prefix + key, self.index_key], args=[reply, ttl, self.maxsize]
+        )
+        self.evictions += int(evicted or 0)
+
+    def size(self) -> Optional[int]:
+        return None  # общий для воркеров, локально не известен
+
+
+class ResponseCache:
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE):
+        self.store = MemoryResponseStore(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+        self.by_assistant: Dict[int, Dict[str, int]] = {}
+
+    @property
+    def backend_name(self) -> str:
+        return "redis" if isinstance(self.store, RedisResponseStore) else "memory"
+
+    async def start(self) -> None:
+        client = await ping_redis()
+        if client is not None:
+            self.store = RedisResponseStore(client, self.store.maxsize)
+
+    def _count(self, assistant_id: int, name: str) -> None:
+        counters = self.by_assistant.setdefault(assistant_id, {"hits": 0, "misses": 0})
+        counters[name] += 1
+
+    async def get(self, assistant_id: int, key: str) -> Optional[str]:
+        try:
+            reply = await self.store.get(key)
+        except Exception:
+            self.errors += 1
+            logger.exception("Кэш ответов недоступен")
+            return None
+        if reply is None:
+            self.misses += 1
+            self._count(assistant_id, "misses")
+        else:
+            self.hits += 1
+            self._count(assistant_id, "hits")
+        return reply
+
+    async def set(self, key: str, reply: str, ttl: int) -> None:
+        if not reply or ttl <= 0:
+            return
+        try:
+            await self.store.set(key, reply, ttl)
+            self.stores += 1
+        except Exception:
+            self.errors += 1
+            logger.exception("Не удалось сохранить ответ в кэш")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "backend": self.backend_name,
+            "size": self.store.size(),
+            "maxsize": self.store.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.store.evictions,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "by_assistant": {
+                str(aid): dict(c, hit_rate=round(c["hits"] / ((c["hits"] + c["misses"]) or 1), 4))
+                for aid, c in self.by_assistant.items()
+            },
+        }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,626 @@
+"""Поиск по базе знаний (kb_articles) для ответов с опорой на статьи.
+
+Статьи режутся на фрагменты (абзацы до KB_PASSAGE_CHARS символов), по
+фрагментам строится обратный индекс в памяти процесса: основа слова
+(app/stemmer.py) -> фрагменты с весом BM25. Заголовок статьи входит в
+каждый её фрагмент с весом _TITLE_WEIGHT.
+
+Поиск на /chat/send не обращается к БД: веса в списке фрагментов термина
+отсортированы по убыванию, и для каждого термина просматриваются только
+KB_SEARCH_DEPTH лучших (частые слова почти не влияют на порядок, а их
+списки — самые длинные). Если после фильтров по age_group/tags набралось
+меньше top_k фрагментов, списки просматриваются целиком.
+
+Найденные фрагменты добавляются в контекст отдельным system-сообщением
+в пределах max_tokens (extra_config["kb"] ассистента).
+
+Обновление — как у реестра ассистентов:
+  * при старте индекс строится целиком в фоне (в потоке, цикл событий не
+    блокируется); до конца сборки ответы идут без базы знаний;
+  * Postgres — LISTEN kb_articles_changed (триггер из миграции 0009, id статьи):
+    статья переиндексируется сразу;
+  * любая БД — раз в KB_REFRESH_SECONDS дочитываются статьи с новым updated_at,
+    удалённые находятся по числу строк.
+Удалённые фрагменты помечаются и пропускаются; когда их больше _COMPACT_RATIO
+(или добавлено больше фрагментов, чем было при сборке), индекс перестраивается
+целиком.
+"""
+import asyncio
+import logging
+import math
+import os
+import re
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from heapq import nlargest
+from operator import itemgetter
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple
+
+import anyio
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+
+from .context import count_tokens
+from .db import ASYNC_DATABASE_URL, AsyncSessionLocal
+from .models import KbArticle
+from .stemmer import analyze
+
+logger = logging.getLogger(__name__)
+
+# 0 — база знаний не загружается и в контекст не попадает
+KB_RETRIEVAL = os.getenv("KB_RETRIEVAL", "1") != "0"
+KB_REFRESH_SECONDS = float(os.getenv("KB_REFRESH_SECONDS", "30"))
+KB_SEARCH_DEPTH = int(os.getenv("KB_SEARCH_DEPTH", "1000"))
+KB_PASSAGE_CHARS = int(os.getenv("KB_PASSAGE_CHARS", "700"))
+KB_NOTIFY_CHANNEL = "kb_articles_changed"
+KB_DEFAULT_TOP_K = 3
+# bm25 — этот индекс, dense — близость эмбеддингов (app/vectors.py)
+KB_MODES = ("bm25", "dense")
+KB_DEFAULT_MAX_TOKENS = 800
+
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+_TITLE_WEIGHT = 2
+_COMPACT_RATIO = 0.25
+# после сборки добавлено больше фрагментов, чем было (но не меньше этого числа), — пересборка
+_MIN_REBUILD_ADDED = 100
+# запас по updated_at: транзакция, начатая раньше, могла закоммититься позже прошлой проверки
+_REFRESH_OVERLAP = timedelta(seconds=5)
+_NOTIFY_DEBOUNCE = 0.2
+# кандидатов с запасом на фильтры до полной сортировки
+_TOP_OVERSAMPLE = 8
+_MAX_FILTERS = 32
+
+_PARAGRAPH_RE = re.compile(r"\n\s*\n|\n")
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+KB_HEADER = "Справочные материалы из базы знаний. Опирайся на них, если они относятся к вопросу:"
+
+
+@dataclass(frozen=True, slots=True)
+class Passage:
+    article_id: int
+    title: str
+    text: str
+    age_group: Optional[str]
+    tags: FrozenSet[str]
+
+
+@dataclass(frozen=True)
+class Hit:
+    passage: Passage
+    score: float
+
+
+@dataclass(frozen=True)
+class KbSettings:
+    """extra_config["kb"] ассистента: true или {"top_k", "max_tokens", "age_group", "tags", "mode"}."""
+    top_k: int = KB_DEFAULT_TOP_K
+    max_tokens: int = KB_DEFAULT_MAX_TOKENS
+    age_group: Optional[str] = None
+    tags: FrozenSet[str] = frozenset()
+    mode: str = KB_MODES[0]
+
+    @classmethod
+    def from_config(cls, extra_config: Optional[dict]) -> Optional["KbSettings"]:
+        value = (extra_config or {}).get("kb")
+        if not value:
+            return None
+        if not isinstance(value, dict):
+            return cls()
+        try:
+            return cls(
+                top_k=int(value.get("top_k") or KB_DEFAULT_TOP_K),
+                max_tokens=int(value.get("max_tokens") or KB_DEFAULT_MAX_TOKENS),
+                age_group=value.get("age_group") or None,
+                tags=_normalize_tags(value.get("tags")),
+                mode=value["mode"] if value.get("mode") in KB_MODES else KB_MODES[0],
+            )
+        except (TypeError, ValueError):
+            logger.warning("Некорректный extra_config.kb: %r — используются значения по умолчанию", value)
+            return cls()
+
+
+def _normalize_tags(tags) -> FrozenSet[str]:
+    if not tags:
+        return frozenset()
+    if isinstance(tags, str):
+        tags = [tags]
+    return frozenset(str(t).strip().lower() for t in tags if str(t).strip())
+
+
+def split_passages(body: str, size: int = KB_PASSAGE_CHARS) -> List[str]:
+    """Абзацы статьи, склеенные до size символов; длинный абзац режется по предложениям."""
+    pieces: List[str] = []
+    for paragraph in _PARAGRAPH_RE.split(body or ""):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= size:
+            pieces.append(paragraph)
+            continue
+        current = ""
+        for sentence in _SENTENCE_RE.split(paragraph):
+            if current and len(current) + len(sentence) + 1 > size:
+                pieces.append(current)
+                current = sentence
+            else:
+                current = f"{current} {sentence}" if current else sentence
+        if current:
+            pieces.append(current)
+
+    passages: List[str] = []
+    for piece in pieces:
+        if passages and len(passages[-1]) + len(piece) + 1 <= size:
+            passages[-1] = f"{passages[-1]}\n{piece}"
+        else:
+            passages.append(piece)
+    return passages
+
+
+# строка статьи: (id, title, body, age_group, tags)
+ArticleRow = Tuple[int, str, str, Optional[str], Sequence[str]]
+
+
+def _article_passages(row: ArticleRow, size: int) -> List[Tuple[Passage, Counter]]:
+    article_id, title, body, age_group, tags = row
+    tags = _normalize_tags(tags)
+    title_terms = analyze(title or "")
+    result = []
+    for text in split_passages(body, size) or [title or ""]:
+        tf = Counter(analyze(text))
+        for term in title_terms:
+            tf[term] += _TITLE_WEIGHT
+        result.append((Passage(article_id, title or "", text, age_group or None, tags), tf))
+    return result
+
+
+class Posting:
+    """Фрагменты с термином: по убыванию веса (для обхода лучших) и по номеру (для поиска веса)."""
+
+    __slots__ = ("weights", "ords", "by_ord", "ord_weights")
+
+    def __init__(self, ord_weights: array, by_ord: array):
+        # веса (со знаком минус) в порядке номеров фрагментов
+        self.by_ord = by_ord
+        self.ord_weights = ord_weights
+        order = sorted(range(len(by_ord)), key=ord_weights.__getitem__)
+        self.weights = array("f", [ord_weights[i] for i in order])
+        self.ords = array("i", [by_ord[i] for i in order])
+
+    def add(self, weight: float, ord_: int) -> None:
+        # новый фрагмент получает наибольший номер — в список по номерам он дописывается в конец
+        self.by_ord.append(ord_)
+        self.ord_weights.append(weight)
+        i = bisect_right(self.weights, weight)
+        self.weights.insert(i, weight)
+        self.ords.insert(i, ord_)
+
+    def weight(self, ord_: int) -> float:
+        i = bisect_left(self.by_ord, ord_)
+        if i < len(self.by_ord) and self.by_ord[i] == ord_:
+            return self.ord_weights[i]
+        return 0.0
+
+
+class SearchIndex:
+    """Обратный индекс BM25 по фрагментам статей.
+
+    Вес записи — нормированная частота термина во фрагменте (со знаком минус,
+    чтобы сортировка по возрастанию давала лучшие первыми); idf домножается
+    при поиске по текущему df, поэтому добавление фрагмента не пересчитывает
+    остальные. Средняя длина фрагмента фиксируется при полной сборке.
+
+    Поиск — вариант MaxScore: термины обходятся по убыванию наибольшего
+    возможного вклада, список термина — от лучших записей, пока запись ещё
+    может вывести новый фрагмент в top-k (её вклад плюс наибольший вклад
+    оставшихся терминов больше k-го лучшего счёта). Непросмотренную часть
+    списков лучшим кандидатам досчитывает поиск веса по номеру фрагмента.
+    """
+
+    def __init__(self, passage_chars: int = KB_PASSAGE_CHARS):
+        self.passage_chars = passage_chars
+        self.docs: List[Optional[Passage]] = []
+        self.postings: Dict[str, Posting] = {}
+        self.df: Dict[str, int] = {}
+        self.articles: Dict[int, Tuple[tuple, List[int]]] = {}   # id -> (содержимое, фрагменты)
+        self.avgdl = 1.0
+        self.live = 0
+        self.deleted = 0
+        self.built = 0   # фрагментов при полной сборке
+        # (age_group, tags) -> номера подходящих фрагментов; у ассистентов фильтры постоянные,
+        # поэтому комбинаций немного и множества обновляются вместе с индексом
+        self._filters: "OrderedDict[Tuple[Optional[str], FrozenSet[str]], Set[int]]" = OrderedDict()
+
+    @classmethod
+    def build(cls, rows: Iterable[ArticleRow], passage_chars: int = KB_PASSAGE_CHARS) -> "SearchIndex":
+        """Полная сборка (блокирующая — вызывается в потоке)."""
+        index = cls(passage_chars)
+        # сначала частоты (средняя длина фрагмента ещё неизвестна), потом веса — без Counter на фрагмент
+        counts: Dict[str, Tuple[array, array]] = {}
+        lengths = array("f")
+        for row in rows:
+            ords = []
+            for passage, tf in _article_passages(row, passage_chars):
+                ord_ = len(index.docs)
+                ords.append(ord_)
+                index.docs.append(passage)
+                lengths.append(sum(tf.values()))
+                for term, count in tf.items():
+                    bucket = counts.get(term)
+                    if bucket is None:
+                        counts[term] = (array("f", [count]), array("i", [ord_]))
+                    else:
+                        bucket[0].append(count)
+                        bucket[1].append(ord_)
+            index.articles[row[0]] = (_content(row), ords)
+        index.live = index.built = len(index.docs)
+        index.avgdl = sum(lengths) / index.live if index.live else 1.0
+
+        norms = [_BM25_K1 * (1 - _BM25_B + _BM25_B * length / index.avgdl) for length in lengths]
+        k1 = _BM25_K1 + 1
+        while counts:
+            term, (tfs, ords) = counts.popitem()
+            weights = array("f", [-tf * k1 / (tf + norms[o]) for tf, o in zip(tfs, ords)])
+            index.postings[term] = Posting(weights, ords)
+            index.df[term] = len(ords)
+        return index
+
+    def _norm(self, tf: Counter) -> float:
+        return _BM25_K1 * (1 - _BM25_B + _BM25_B * sum(tf.values()) / self.avgdl)
+
+    # --- изменения ---
+
+    def upsert(self, row: ArticleRow) -> bool:
+        """Добавляет или заменяет статью; False — содержимое не изменилось."""
+        content = _content(row)
+        current = self.articles.get(row[0])
+        if current is not None and current[0] == content:
+            return False
+        self.remove(row[0])
+        ords = []
+        for passage, tf in _article_passages(row, self.passage_chars):
+            ord_ = len(self.docs)
+            self.docs.append(passage)
+            ords.append(ord_)
+            for (age_group, tags), allowed in self._filters.items():
+                if accepts(passage, age_group, tags):
+                    allowed.add(ord_)
+            norm = self._norm(tf)
+            for term, count in tf.items():
+                weight = -count * (_BM25_K1 + 1) / (count + norm)
+                posting = self.postings.get(term)
+                if posting is None:
+                    self.postings[term] = Posting(array("f", [weight]), array("i", [ord_]))
+                else:
+                    posting.add(weight, ord_)
+                self.df[term] = self.df.get(term, 0) + 1
+        self.articles[row[0]] = (content, ords)
+        self.live += len(ords)
+        return True
+
+    def remove(self, article_id: int) -> bool:
+        current = self.articles.pop(article_id, None)
+        if current is None:
+            return False
+        for ord_ in current[1]:
+            passage = self.docs[ord_]
+            self.docs[ord_] = None
+            for allowed in self._filters.values():
+                allowed.discard(ord_)
+            # df — по живым фрагментам; сами записи в списках пропускаются при поиске
+            for term in set(analyze(passage.text)) | set(analyze(passage.title)):
+                self.df[term] -= 1
+        self.live -= len(current[1])
+        self.deleted += len(current[1])
+        return True
+
+    def needs_rebuild(self) -> bool:
+        """Много удалённых записей или средняя длина фрагмента со сборки могла заметно уйти."""
+        added = len(self.docs) - self.built
+        return self.deleted > _COMPACT_RATIO * max(len(self.docs), 1) or added > max(self.built, _MIN_REBUILD_ADDED)
+
+    # --- поиск ---
+
+    def search(self, terms: Sequence[str], k: int, age_group: Optional[str] = None,
+               tags: FrozenSet[str] = frozenset(), depth: Optional[int] = KB_SEARCH_DEPTH) -> List[Hit]:
+        hits, truncated = self._search(terms, k, age_group, tags, depth)
+        if len(hits) < k and truncated:
+            # отфильтровано слишком много — добираем по полным спискам
+            hits, _ = self._search(terms, k, age_group, tags, None)
+        return hits
+
+    def _allowed(self, age_group: Optional[str], tags: FrozenSet[str]) -> Set[int]:
+        key = (age_group, tags)
+        allowed = self._filters.get(key)
+        if allowed is None:
+            allowed = {o for o, p in enumerate(self.docs) if p is not None and accepts(p, age_group, tags)}
+            self._filters[key] = allowed
+            if len(self._filters) > _MAX_FILTERS:
+                self._filters.popitem(last=False)
+        else:
+            self._filters.move_to_end(key)
+        return allowed
+
+    def _search(self, terms, k, age_group, tags, depth) -> Tuple[List[Hit], bool]:
+        n = self.live
+        query = []
+        for term in set(terms):
+            posting = self.postings.get(term)
+            df = self.df.get(term, 0)
+            if posting is None or df <= 0:
+                continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            query.append((-posting.weights[0] * idf, idf, posting))
+        if not query:
+            return [], False
+        query.sort(key=itemgetter(0), reverse=True)
+        remaining = [0.0] * (len(query) + 1)
+        for i in range(len(query) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + query[i][0]
+
+        allowed = self._allowed(age_group, tags) if age_group is not None or tags else None
+        scores: Dict[int, float] = {}
+        get = scores.get
+        truncated = False
+        # (idf, список, вес последней просмотренной записи) — термины, просмотренные не целиком
+        partial = []
+        for i, (_, idf, posting) in enumerate(query):
+            weights, ords = posting.weights, posting.ords
+            end = len(ords)
+            if i and len(scores) >= k:
+                # фрагмент, которого ещё нет среди кандидатов, обгонит k-й лучший, только если
+                # вклад этого термина больше theta минус максимум вклада оставшихся
+                need = (nlargest(k, scores.values())[-1] - remaining[i + 1]) / idf
+                end = bisect_right(weights, -need) if need > 0 else end
+            if depth is not None and end > depth:
+                end = bisect_right(weights, weights[depth - 1])
+                truncated = True
+            if end < len(ords):
+                partial.append((idf, posting, weights[end - 1] if end else -math.inf))
+                weights, ords = weights[:end], ords[:end]
+            if allowed is not None:
+                for weight, ord_ in zip(weights, ords):
+                    if ord_ in allowed:
+                        scores[ord_] = get(ord_, 0.0) - weight * idf
+            else:
+                for weight, ord_ in zip(weights, ords):
+                    scores[ord_] = get(ord_, 0.0) - weight * idf
+        if not scores:
+            return [], truncated
+
+        ranked = nlargest(k * _TOP_OVERSAMPLE, scores.items(), key=itemgetter(1))
+        if partial:
+            # лучшим кандидатам — вклад непросмотренной части списков (вес ищется по номеру)
+            refined = []
+            for ord_, score in ranked:
+                for idf, posting, last in partial:
+                    weight = posting.weight(ord_)
+                    if weight > last:
+                        score -= weight * idf
+                refined.append((ord_, score))
+            ranked = sorted(refined, key=itemgetter(1), reverse=True)
+        hits: List[Hit] = []
+        docs = self.docs
+        for ord_, score in ranked:
+            if docs[ord_] is not None:
+                hits.append(Hit(docs[ord_], score))
+                if len(hits) == k:
+                    break
+        return hits, truncated
+
+    def stats(self) -> dict:
+        return {
+            "articles": len(self.articles),
+            "passages": self.live,
+            "deleted": self.deleted,
+            "terms": len(self.postings),
+            "postings": sum(len(p.ords) for p in self.postings.values()),
+        }
+
+
+def accepts(passage: Passage, age_group: Optional[str], tags: FrozenSet[str]) -> bool:
+    """Фильтр выдачи по age_group и tags (общий для BM25 и поиска по векторам)."""
+    # статья без age_group подходит для любого возраста
+    if age_group is not None and passage.age_group is not None and passage.age_group != age_group:
+        return False
+    return not tags or bool(passage.tags & tags)
+
+
+def _content(row: ArticleRow) -> tuple:
+    return tuple(row[1:4]) + (tuple(row[4] or ()),)
+
+
+def _row(article: KbArticle) -> ArticleRow:
+    return (article.id, article.title, article.body, article.age_group, list(article.tags or ()))
+
+
+class KnowledgeBase:
+    def __init__(self):
+        self.enabled = KB_RETRIEVAL
+        self.index = SearchIndex()
+        self.watermark: Optional[datetime] = None
+        self.rebuilds = 0
+        self.updates = 0
+        self.searches = 0
+        self.search_seconds = 0.0
+        self._lock = asyncio.Lock()
+        self._refresher: Optional[asyncio.Task] = None
+        self._listener = None
+        self._notified: Set[int] = set()
+        self._notify_task: Optional[asyncio.Task] = None
+
+    # --- загрузка ---
+
+    async def reload(self) -> None:
+        """Полная пересборка индекса из kb_articles."""
+        async with self._lock:
+            started = time.perf_counter()
+            async with AsyncSessionLocal() as db:
+                watermark = await db.scalar(select(func.max(KbArticle.updated_at)))
+                articles = (await db.scalars(select(KbArticle))).all()
+                rows = [_row(a) for a in articles]
+            self.index = await anyio.to_thread.run_sync(SearchIndex.build, rows, KB_PASSAGE_CHARS)
+            self.watermark = watermark
+            self.rebuilds += 1
+            logger.info("Индекс базы знаний собран: %d статей, %d фрагментов за %.1f с",
+                        len(self.index.articles), self.index.live, time.perf_counter() - started)
+
+    async def refresh(self) -> int:
+        """Дочитывает статьи, изменённые после прошлой проверки, и убирает удалённые."""
+        async with self._lock:
+            async with AsyncSessionLocal() as db:
+                query = select(KbArticle)
+                if self.watermark is not None:
+                    query = query.where(KbArticle.updated_at >= self.watermark - _REFRESH_OVERLAP)
+                articles = (await db.scalars(query)).all()
+                changed = sum(self.index.upsert(_row(a)) for a in articles)
+                stamps = [a.updated_at for a in articles if a.updated_at is not None]
+                if stamps:
+                    self.watermark = max([self.watermark, *stamps] if self.watermark else stamps)
+                if await db.scalar(select(func.count()).select_from(KbArticle)) != len(self.index.articles):
+                    ids = set(await db.scalars(select(KbArticle.id)))
+                    for article_id in set(self.index.articles) - ids:
+                        changed += self.index.remove(article_id)
+            self.updates += changed
+            rebuild = self.index.needs_rebuild()
+        if rebuild:
+            await self.reload()
+        return changed
+
+    async def refresh_ids(self, ids: Iterable[int]) -> int:
+        """Переиндексирует статьи по id (NOTIFY): изменённые — заново, удалённые — убирает."""
+        ids = set(ids)
+        async with self._lock:
+            async with AsyncSessionLocal() as db:
+                articles = (await db.scalars(select(KbArticle).where(KbArticle.id.in_(ids)))).all()
+            changed = sum(self.index.upsert(_row(a)) for a in articles)
+            for article_id in ids - {a.id for a in articles}:
+                changed += self.index.remove(article_id)
+            self.updates += changed
+            rebuild = self.index.needs_rebuild()
+        if rebuild:
+            await self.reload()
+        return changed
+
+    # --- поиск ---
+
+    def search(self, query: str, settings: KbSettings) -> List[Hit]:
+        if not self.enabled or not self.index.live:
+            return []
+        started = time.perf_counter()
+        hits = self.index.search(analyze(query), settings.top_k, settings.age_group, settings.tags)
+        self.searches += 1
+        self.search_seconds += time.perf_counter() - started
+        return hits
+
+    def grounding(self, query: str, settings: Optional[KbSettings], model: str) -> Optional[dict]:
+        """system-сообщение с найденными фрагментами в пределах settings.max_tokens (или None)."""
+        if settings is None:
+            return None
+        hits = self.search(query, settings)
+        return grounding_message(hits, settings.max_tokens, model) if hits else None
+
+    # --- фоновое обновление ---
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        # изменения, пришедшие во время сборки, дочитает первая проверка по updated_at
+        await self._start_listener()
+        self._refresher = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self) -> None:
+        # большая база собирается десятки секунд — сервер в это время уже отвечает без неё
+        while True:
+            try:
+                await self.reload()
+                break
+            except Exception:
+                logger.exception("Не удалось собрать индекс базы знаний")
+                await asyncio.sleep(KB_REFRESH_SECONDS)
+        while True:
+            await asyncio.sleep(KB_REFRESH_SECONDS)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Не удалось обновить индекс базы знаний")
+
+    async def stop(self) -> None:
+        for task in (self._refresher, self._notify_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._refresher = self._notify_task = None
+        if self._listener is not None:
+            try:
+                await self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
+
+    async def _start_listener(self) -> None:
+        url = make_url(ASYNC_DATABASE_URL)
+        if url.get_backend_name() != "postgresql":
+            return
+        try:
+            import asyncpg
+
+            dsn = url.set(drivername="postgresql").render_as_string(hide_password=False)
+            self._listener = await asyncpg.connect(dsn)
+            await self._listener.add_listener(KB_NOTIFY_CHANNEL, self._on_notify)
+        except Exception:
+            logger.exception("LISTEN %s недоступен, остаётся периодическая проверка", KB_NOTIFY_CHANNEL)
+            self._listener = None
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        try:
+            self._notified.add(int(payload))
+        except ValueError:
+            return
+        if self._notify_task is None or self._notify_task.done():
+            self._notify_task = asyncio.get_running_loop().create_task(self._apply_notified())
+
+    async def _apply_notified(self) -> None:
+        # правки пачкой (импорт статей) — одним запросом
+        await asyncio.sleep(_NOTIFY_DEBOUNCE)
+        while self._notified:
+            ids, self._notified = self._notified, set()
+            try:
+                await self.refresh_ids(ids)
+            except Exception:
+                logger.exception("Не удалось переиндексировать статьи базы знаний по NOTIFY")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "ready": self.rebuilds > 0,
+            **self.index.stats(),
+            "rebuilds": self.rebuilds,
+            "updates": self.updates,
+            "searches": self.searches,
+            "avg_search_ms": round(self.search_seconds / self.searches * 1000, 3) if self.searches else 0.0,
+        }
+
+
+def grounding_message(hits: Sequence[Hit], max_tokens: int, model: str) -> Optional[dict]:
+    """Фрагменты в порядке релевантности, пока помещаются в max_tokens."""
+    parts = [KB_HEADER]
+    used = count_tokens(KB_HEADER, model)
+    for hit in hits:
+        part = f"[{len(parts)}] {hit.passage.title}\n{hit.passage.text}"
+        cost = count_tokens(part, model) + 1
+        if used + cost > max_tokens:
+            continue
+        parts.append(part)
+        used += cost
+    if len(parts) == 1:
+        return None
+    return {"role": "system", "content": "\n\n".join(parts)}
+
+
+knowledge_base = KnowledgeBase()
@@ -0,0 +1,328 @@
+"""Выбор модели для запроса и переключение на запасную при деградации.
+
+Правила — в assistants.extra_config.routing:
+
+    "routing": {
+        "rules": [
+            {"model": "gpt-4.1", "tiers": ["premium"]},
+            {"model": "gpt-4.1", "min_chars": 600},
+            {"model": "gpt-4.1-mini", "min_turns": 30}
+        ],
+        "fallback": ["gpt-4o-mini"],
+        "slo": {"p95_ms": 20000, "ttft_p95_ms": 4000, "error_rate": 0.25}
+    }
+
+Условия правила (все заданные должны выполниться): min_chars/max_chars — длина
+сообщения, min_turns/max_turns — сколько вопросов уже было в сессии, tiers —
+тариф пользователя (user_limits.tier). Срабатывает первое подходящее правило;
+если ни одно не подошло — base_model ассистента или DEFAULT_MODEL.
+
+Кандидаты запроса: выбранная модель, затем fallback и модель по умолчанию.
+По каждой модели ведётся скользящее окно (ROUTING_WINDOW_SECONDS): задержка
+ответа (у потока — до первого токена) и ошибки. Модели, нарушающие SLO
+(p95 или доля ошибок при не менее ROUTING_MIN_SAMPLES замерах), уходят в конец
+списка — запрос сразу идёт в исправную. Когда деградировавшая модель не
+получает трафик, её окно пустеет и она снова пробуется первой.
+
+При ошибке вызова (после повторов llm_client) запрос переходит к следующему
+кандидату; поток — только пока клиенту не ушёл первый токен. Модель, которая
+ответила, записывается в chat_messages.model.
+"""
+import logging
+import math
+import os
+import time
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional, Sequence, Tuple
+
+from .llm_client import LLMError, LLMOverloaded, LLMUnavailable, llm_client
+from .metrics import LLM_ERRORS, LLM_ROUTES, LLMCall, error_label
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "gpt-4o-mini")
+ROUTING_WINDOW_SECONDS = float(os.getenv("ROUTING_WINDOW_SECONDS", "60"))
+ROUTING_MIN_SAMPLES = int(os.getenv("ROUTING_MIN_SAMPLES", "20"))
+ROUTING_SLO_P95_MS = float(os.getenv("ROUTING_SLO_P95_MS", "30000"))
+ROUTING_SLO_TTFT_P95_MS = float(os.getenv("ROUTING_SLO_TTFT_P95_MS", "5000"))
+ROUTING_SLO_ERROR_RATE = float(os.getenv("ROUTING_SLO_ERROR_RATE", "0.25"))
+# перцентиль окна пересчитывается не чаще раза в секунду; замеров в окне — не больше
+_SNAPSHOT_TTL = 1.0
+_WINDOW_MAX_SAMPLES = 10000
+
+
+# ----------------------------
+# Правила
+# ----------------------------
+
+@dataclass(frozen=True)
+class Slo:
+    p95_ms: float = ROUTING_SLO_P95_MS
+    ttft_p95_ms: float = ROUTING_SLO_TTFT_P95_MS
+    error_rate: float = ROUTING_SLO_ERROR_RATE
+
+
+@dataclass(frozen=True)
+class Rule:
+    model: str
+    min_chars: Optional[int] = None
+    max_chars: Optional[int] = None
+    min_turns: Optional[int] = None
+    max_turns: Optional[int] = None
+    tiers: Optional[frozenset] = None
+
+    def matches(self, chars: int, turns: int, tier: Optional[str]) -> bool:
+        if self.min_chars is not None and chars < self.min_chars:
+            return False
+        if self.max_chars is not None and chars > self.max_chars:
+            return False
+        if self.min_turns is not None and turns < self.min_turns:
+            return False
+        if self.max_turns is not None and turns > self.max_turns:
+            return False
+        return self.tiers is None or tier in self.tiers
+
+
+@dataclass(frozen=True)
+class RoutingConfig:
+    rules: Tuple[Rule, ...] = ()
+    fallback: Tuple[str, ...] = ()
+    slo: Slo = field(default_factory=Slo)
+
+    @classmethod
+    def parse(cls, extra_config: Optional[dict], assistant_code: str = "") -> "RoutingConfig":
+        """Разбор extra_config.routing; некорректные правила пропускаются с предупреждением."""
+        raw = (extra_config or {}).get("routing") or {}
+        if not isinstance(raw, dict):
+            logger.warning("Ассистент %s: extra_config.routing должен быть объектом", assistant_code)
+            return cls()
+        rules = []
+        for item in raw.get("rules") or ():
+            try:
+                tiers = item.get("tiers")
+                rules.append(Rule(
+                    model=str(item["model"]),
+                    min_chars=_optional_int(item.get("min_chars")),
+                    max_chars=_optional_int(item.get("max_chars")),
+                    min_turns=_optional_int(item.get("min_turns")),
+                    max_turns=_optional_int(item.get("max_turns")),
+                    tiers=frozenset(map(str, tiers)) if tiers is not None else None,
+                ))
+            except (AttributeError, KeyError, TypeError, ValueError):
+                logger.warning("Ассистент %s: пропущено правило маршрутизации %r", assistant_code, item)
+        fallback = raw.get("fallback") or ()
+        if isinstance(fallback, str):
+            fallback = (fallback,)
+        slo = raw.get("slo") or {}
+        try:
+            parsed_slo = Slo(
+                p95_ms=float(slo.get("p95_ms", ROUTING_SLO_P95_MS)),
+                ttft_p95_ms=float(slo.get("ttft_p95_ms", ROUTING_SLO_TTFT_P95_MS)),
+                error_rate=float(slo.get("error_rate", ROUTING_SLO_ERROR_RATE)),
+            )
+        except (AttributeError, TypeError, ValueError):
+            logger.warning("Ассистент %s: некорректный extra_config.routing.slo", assistant_code)
+            parsed_slo = Slo()
+        return cls(tuple(rules), tuple(str(m) for m in fallback), parsed_slo)
+
+
+def _optional_int(value) -> Optional[int]:
+    return None if value is None else int(value)
+
+
+@dataclass(frozen=True)
+class Route:
+    model: str                # выбранная правилами (по ней считаются токены и ключ кэша ответов)
+    candidates: Tuple[str, ...]  # порядок попыток с учётом SLO
+    reason: str               # rule | default | slo — почему первым идёт candidates[0]
+
+
+# ----------------------------
+# Окно задержек и ошибок
+# ----------------------------
+
+class ModelWindow:
+    """Замеры модели за последние ROUTING_WINDOW_SECONDS: (время, задержка или None при ошибке)."""
+
+    def __init__(self, window_seconds: float = ROUTING_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._samples: Deque[Tuple[float, Optional[float]]] = deque(maxlen=_WINDOW_MAX_SAMPLES)
+        self._snapshot: Optional[Tuple[float, int, Optional[float], float]] = None
+
+    def add(self, latency: Optional[float]) -> None:
+        self._samples.append((time.monotonic(), latency))
+
+    def snapshot(self) -> Tuple[int, Optional[float], float]:
+        """(замеров, p95 задержки в секундах, доля ошибок)."""
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._snapshot[0] < _SNAPSHOT_TTL:
+            return self._snapshot[1:]
+        while self._samples and self._samples[0][0] < now - self.window_seconds:
+            self._samples.popleft()
+        latencies = sorted(latency for _, latency in self._samples if latency is not None)
+        count = len(self._samples)
+        p95 = latencies[max(0, math.ceil(0.95 * len(latencies)) - 1)] if latencies else None
+        error_rate = (count - len(latencies)) / count if count else 0.0
+        self._snapshot = (now, count, p95, error_rate)
+        return count, p95, error_rate
+
+
+class ModelRouter:
+    def __init__(self):
+        self.min_samples = ROUTING_MIN_SAMPLES
+        self._windows: Dict[Tuple[str, str], ModelWindow] = {}
+        self._configs: Dict[int, Tuple[dict, RoutingConfig]] = {}
+        # метрики
+        self.routed: Dict[str, int] = {}
+        self.failovers = 0
+
+    def config(self, assistant) -> RoutingConfig:
+        # конфигурация ассистента из реестра неизменна, пока реестр не перезагрузится
+        cached = self._configs.get(assistant.id)
+        if cached is not None and cached[0] is assistant.extra_config:
+            return cached[1]
+        config = RoutingConfig.parse(assistant.extra_config, assistant.code)
+        self._configs[assistant.id] = (assistant.extra_config, config)
+        return config
+
+    def window(self, model: str, kind: str) -> ModelWindow:
+        window = self._windows.get((model, kind))
+        if window is None:
+            window = self._windows[(model, kind)] = ModelWindow()
+        return window
+
+    def breaches(self, model: str, slo: Slo) -> bool:
+        for kind, limit_ms in (("chat", slo.p95_ms), ("stream", slo.ttft_p95_ms)):
+            window = self._windows.get((model, kind))
+            if window is None:
+                continue
+            count, p95, error_rate = window.snapshot()
+            if count < self.min_samples:
+                continue
+            if error_rate > slo.error_rate or (p95 is not None and p95 * 1000 > limit_ms):
+                return True
+        return False
+
+    # --- выбор ---
+
+    def route(self, assistant, message: str, turns: int, tier: Optional[str]) -> Route:
+        """Модели-кандидаты для запроса; turns — сколько вопросов уже было в сессии."""
+        config = self.config(assistant)
+        default = assistant.base_model or DEFAULT_MODEL
+        model, reason = default, "default"
+        for rule in config.rules:
+            if rule.matches(len(message), turns, tier):
+                model, reason = rule.model, "rule"
+                break
+
+        candidates = list(dict.fromkeys([model, *config.fallback, default]))
+        healthy = [m for m in candidates if not self.breaches(m, config.slo)]
+        if healthy and healthy[0] != model:
+            reason = "slo"
+        # деградировавшие — в конце: если запасные тоже не ответят, пробуем и их
+        ordered = healthy + [m for m in candidates if m not in healthy]
+        return Route(model, tuple(ordered), reason)
+
+    # --- вызовы с переключением ---
+
+    async def complete(self, route: Route, assistant_code: str, **kwargs):
+        """(модель, ответ) первого кандидата, который ответил."""
+        error: Optional[LLMError] = None
+        for position, model in enumerate(route.candidates):
+            started = time.perf_counter()
+            try:
+                with LLMCall(model, "chat"):
+                    completion = await llm_client.complete(model=model, **kwargs)
+            except LLMError as e:
+                self._failed(model, "chat", e)
+                error = e
+                continue
+            self.window(model, "chat").add(time.perf_counter() - started)
+            self._served(route, assistant_code, model, position)
+            return model, completion
+        raise error
+
+    @asynccontextmanager
+    async def stream(self, route: Route, assistant_code: str, **kwargs):
+        """Поток первого кандидата, который начал отвечать:
+
+            async with model_router.stream(route, code, messages=...) as (model, chunks):
+                async for chunk in chunks:
+                    ...
+        """
+        error: Optional[LLMError] = None
+        for position, model in enumerate(route.candidates):
+            async with AsyncExitStack() as stack:
+                call = stack.enter_context(LLMCall(model, "stream"))
+                try:
+                    chunks = await stack.enter_async_context(llm_client.stream(model=model, **kwargs))
+                except LLMError as e:
+                    LLM_ERRORS.labels(model, error_label(e)).inc()
+                    self._failed(model, "stream", e)
+                    error = e
+                    continue
+                self._served(route, assistant_code, model, position)
+                yield model, self._observe(model, call, chunks)
+                return
+        raise error
+
+    async def _observe(self, model: str, call: LLMCall, chunks):
+        """Чанки потока; время до первого токена — в окно модели."""
+        recorded = False
+        try:
+            async for chunk in chunks:
+                if not recorded and chunk.choices and chunk.choices[0].delta.content:
+                    call.first_token()
+                    self.window(model, "stream").add(call.ttft)
+                    recorded = True
+                yield chunk
+        except LLMError:
+            if not recorded:
+                self.window(model, "stream").add(None)
+            raise
+        if not recorded:
+            # пустой ответ — задержкой считаем весь поток
+            self.window(model, "stream").add(time.perf_counter() - call.started)
+
+    def _failed(self, model: str, kind: str, exc: LLMError) -> None:
+        # отказ без обращения к upstream (открыт breaker, нет слота) — не замер модели
+        if not isinstance(exc, (LLMUnavailable, LLMOverloaded)):
+            self.window(model, kind).add(None)
+        logger.warning("Модель %s не ответила (%s)", model, type(exc).__name__)
+
+    def _served(self, route: Route, assistant_code: str, model: str, position: int) -> None:
+        if position:
+            reason = "failover"
+            self.failovers += 1
+        elif model != route.model:
+            reason = "slo"
+        else:
+            reason = route.reason
+        LLM_ROUTES.labels(assistant_code, model, reason).inc()
+        self.routed[model] = self.routed.get(model, 0) + 1
+
+    def stats(self) -> dict:
+        windows = {}
+        for (model, kind), window in self._windows.items():
+            count, p95, error_rate = window.snapshot()
+            windows[f"{model}:{kind}"] = {
+                "samples": count,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+                "error_rate": round(error_rate, 3),
+            }
+        return {
+            "default_model": DEFAULT_MODEL,
+            "routed": dict(self.routed),
+            "failovers": self.failovers,
+            "windows": windows,
+        }
+
+
+model_router = ModelRouter()
+
+
+def user_turns(messages: Sequence) -> int:
+    """Вопросов в сессии по кэшу (у неполного кэша — не меньше, чем в хвосте)."""
+    return sum(1 for m in messages if m.role == "user")
@@ -0,0 +1,149 @@
+"""Кэш «горячих» сессий в памяти процесса.
+
+Для недавно активных сессий хранит строку сессии, id ассистента и хвост
+сообщений, упорядоченный по id. Кэш обновляется при каждой записи (сообщение,
+summary), поэтому /chat/send на попадании не читает историю из БД вообще.
+
+Кэш локален для воркера: записи живут не дольше SESSION_CACHE_TTL секунд,
+что ограничивает расхождение, если ту же сессию пишет другой воркер.
+"""
+import os
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "2000"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "600"))
+# Сколько последних реплик держать на сессию; длиннее — хвост обрезается
+SESSION_CACHE_MAX_MESSAGES = int(os.getenv("SESSION_CACHE_MAX_MESSAGES", "200"))
+
+
+@dataclass(order=True)
+class CachedMessage:
+    id: int
+    role: str = field(compare=False)
+    content: str = field(compare=False)
+    tokens_used: Optional[int] = field(compare=False, default=None)
+    created_at: Optional[datetime] = field(compare=False, default=None)
+    model: Optional[str] = field(compare=False, default=None)
+
+    @classmethod
+    def from_row(cls, m) -> "CachedMessage":
+        return cls(m.id, m.role, m.content, m.tokens_used, m.created_at, m.model)
+
+
+@dataclass
+class CachedSession:
+    id: str
+    user_id: int
+    assistant_id: int
+    summary: Optional[str]
+    summary_until_id: Optional[int]
+    prompt_version_id: Optional[int]  # версия системного промта (текст — в реестре ассистентов)
+    messages: List[CachedMessage]  # реплики user/assistant по возрастанию id
+    complete: bool                 # True, если messages — вся история сессии
+    loaded_at: float = field(default_factory=time.monotonic)
+
+    def add_message(self, message: CachedMessage) -> None:
+        i = bisect_left(self.messages, message)
+        if i < len(self.messages) and self.messages[i].id == message.id:
+            return  # уже есть (запись пришла и из БД, и из кода отправки)
+        self.messages.insert(i, message)
+        if len(self.messages) > SESSION_CACHE_MAX_MESSAGES:
+            del self.messages[: len(self.messages) - SESSION_CACHE_MAX_MESSAGES]
+            self.complete = False
+
+    def prompt_history(self) -> List[CachedMessage]:
+        """Реплики, ещё не свёрнутые в summary."""
+        if self.summary_until_id is None:
+            return list(self.messages)
+        return [m for m in self.messages if m.id > self.summary_until_id]
+
+
+class SessionCache:
+    def __init__(self, maxsize: int = SESSION_CACHE_SIZE, ttl: float = SESSION_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[str, CachedSession]" = OrderedDict()
+
+    def get(self, session_id: str) -> Optional[CachedSession]:
+        entry = self._data.get(session_id)
+        if entry is not None and time.monotonic() - entry.loaded_at > self.ttl:
+            del self._data[session_id]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(session_id)
+        self.hits += 1
+        return entry
+
+    def put(self, entry: CachedSession) -> CachedSession:
+        self._data[entry.id] = entry
+        self._data.move_to_end(entry.id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def peek(self, session_id: str) -> Optional[CachedSession]:
+        """Запись без учёта в статистике и без продления LRU (для обновлений при записи)."""
+        return self._data.get(session_id)
+
+    def add_message(self, session_id: str, message, entry: Optional[CachedSession] = None) -> None:
+        """Дописывает сохранённое сообщение в хвост сессии.
+
+        entry — запись, с которой работает текущий запрос: она обновляется,
+        даже если за время запроса была вытеснена из кэша.
+        """
+        cached = CachedMessage.from_row(message)
+        if entry is not None:
+            entry.add_message(cached)
+        current = self.peek(session_id)
+        if current is not None and current is not entry:
+            current.add_message(cached)
+
+    def set_summary(self, session_id: str, summary: str, until_id: int) -> None:
+        entry = self.peek(session_id)
+        if entry is not None:
+            entry.summary = summary
+            entry.summary_until_id = until_id
+
+    def invalidate(self, session_id: str) -> None:
+        self._data.pop(session_id, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+def make_entry(session, messages: Iterable, complete: bool) -> CachedSession:
+    return CachedSession(
+        id=session.id,
+        user_id=session.user_id,
+        assistant_id=session.assistant_id,
+        summary=session.summary,
+        summary_until_id=session.summary_until_id,
+        prompt_version_id=session.prompt_version_id,
+        messages=[CachedMessage.from_row(m) for m in messages],
+        complete=complete,
+    )
+
+
+session_cache = SessionCache()
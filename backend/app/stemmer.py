@@ -0,0 +1,125 @@
+"""Разбор текста для полнотекстового поиска: слова, стоп-слова, стемминг.
+
+Стеммер — алгоритм Snowball для русского языка (Портер): «кормление»,
+«кормления», «кормлением» сводятся к одной основе «кормлен». Латиница
+и цифры только приводятся к нижнему регистру. Основы кэшируются: словарь
+базы знаний ограничен, поэтому после прогрева разбор — поиск в словаре.
+"""
+import re
+from functools import lru_cache
+from typing import List
+
+_WORD_RE = re.compile(r"[0-9a-zа-яё]+")
+
+_VOWELS = frozenset("аеиоуыэюя")
+
+STOP_WORDS = frozenset("""
+а без более бы был была были было быть в вам вас весь во вот все всего всех вы где да даже
+для до его ее если есть еще же за здесь и из или им их к как ко когда кто ли либо мне может
+мы на над надо наш не него нее нет ни них но ну о об однако он она они оно от очень по под
+при с со так также такой там те тем то того тоже той только том ты у уже хотя чего чей чем
+что чтобы чье чья эта эти это я
+""".split())
+
+
+def _endings(*groups: str):
+    """Окончания, сгруппированные по длине: (длина, множество), длинные первыми."""
+    endings = {e for g in groups for e in g.split()}
+    lengths = sorted({len(e) for e in endings}, reverse=True)
+    return tuple((n, frozenset(e for e in endings if len(e) == n)) for n in lengths)
+
+
+_PERFECTIVE_GERUND_1 = _endings("в вши вшись")            # после а/я
+_PERFECTIVE_GERUND_2 = _endings("ив ивши ившись ыв ывши ывшись")
+_ADJECTIVE = _endings("ее ие ые ое ими ыми ей ий ый ой ем им ым ом его ого ему ому их ых ую юю ая яя ою ею")
+_PARTICIPLE_1 = _endings("ем нн вш ющ щ")                 # после а/я
+_PARTICIPLE_2 = _endings("ивш ывш ующ")
+_REFLEXIVE = _endings("ся сь")
+_VERB_1 = _endings("ла на ете йте ли й л ем н ло но ет ют ны ть ешь нно")   # после а/я
+_VERB_2 = _endings("ила ыла ена ейте уйте ите или ыли ей уй ил ыл им ым ен ило ыло ено ят ует уют ит ыт "
+                   "ены ить ыть ишь ую ю")
+_NOUN = _endings("а ев ов ие ье е иями ями ами еи ии и ией ей ой ий й иям ям ием ем ам ом о у ах иях ях ы ь "
+                 "ию ью ю ия ья я")
+_SUPERLATIVE = _endings("ейш ейше")
+_DERIVATIONAL = _endings("ост ость")
+
+
+def _regions(word: str):
+    """Начала областей RV и R2 (индексы в слове)."""
+    rv = r1 = r2 = len(word)
+    for i, ch in enumerate(word):
+        if ch in _VOWELS:
+            rv = i + 1
+            break
+    for i in range(1, len(word)):
+        if word[i - 1] in _VOWELS and word[i] not in _VOWELS:
+            r1 = i + 1
+            break
+    for i in range(r1 + 1, len(word)):
+        if word[i - 1] in _VOWELS and word[i] not in _VOWELS:
+            r2 = i + 1
+            break
+    return rv, r2
+
+
+def _strip(word: str, rv: int, endings, after_a: bool = False) -> str:
+    """Снимает самое длинное окончание из endings, целиком лежащее в RV; иначе слово как есть."""
+    for length, group in endings:
+        cut = len(word) - length
+        if cut < rv or word[cut:] not in group:
+            continue
+        if after_a and (cut - 1 < rv or word[cut - 1] not in "ая"):
+            # окончание группы 1 снимается, только если перед ним а или я (сами а/я остаются)
+            continue
+        return word[:cut]
+    return word
+
+
+def _strip_group(word: str, rv: int, first, second) -> str:
+    stripped = _strip(word, rv, first, after_a=True)
+    candidate = _strip(word, rv, second)
+    # из двух групп берётся более длинное окончание
+    return candidate if len(candidate) < len(stripped) else stripped
+
+
+@lru_cache(maxsize=200_000)
+def stem(word: str) -> str:
+    """Основа русского слова (Snowball); прочие слова — без изменений."""
+    word = word.replace("ё", "е")
+    if len(word) < 3 or not any("а" <= ch <= "я" for ch in word):
+        return word
+    rv, r2 = _regions(word)
+
+    # шаг 1: деепричастие, иначе возвратная частица и прилагательное/глагол/существительное
+    stripped = _strip_group(word, rv, _PERFECTIVE_GERUND_1, _PERFECTIVE_GERUND_2)
+    if stripped != word:
+        word = stripped
+    else:
+        word = _strip(word, rv, _REFLEXIVE)
+        stripped = _strip(word, rv, _ADJECTIVE)
+        if stripped != word:
+            # причастие перед окончанием прилагательного снимается вместе с ним
+            word = _strip_group(stripped, rv, _PARTICIPLE_1, _PARTICIPLE_2)
+        else:
+            stripped = _strip_group(word, rv, _VERB_1, _VERB_2)
+            word = stripped if stripped != word else _strip(word, rv, _NOUN)
+
+    # шаг 2
+    if word.endswith("и") and len(word) - 1 >= rv:
+        word = word[:-1]
+
+    # шаг 3: словообразовательное окончание в R2
+    word = _strip(word, max(r2, rv), _DERIVATIONAL)
+
+    # шаг 4: превосходная степень, двойная н, мягкий знак
+    word = _strip(word, rv, _SUPERLATIVE)
+    if word.endswith("нн") and len(word) - 1 >= rv:
+        word = word[:-1]
+    elif word.endswith("ь") and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+
+def analyze(text: str) -> List[str]:
+    """Основы значимых слов текста в порядке следования (с повторами)."""
+    return [stem(w) for w in _WORD_RE.findall(text.lower()) if w not in STOP_WORDS]
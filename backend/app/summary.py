@@ -0,0 +1,135 @@
+"""Накопительное краткое содержание старых реплик сессии.
+
+Реплики, вытесненные из окна контекста (см. context.build_context), сворачиваются
+в chat_sessions.summary. Обновление инкрементальное: в модель уходит только прежнее
+summary и новые вытесненные реплики, а не вся история. Выполняется в фоне после
+ответа пользователю.
+
+Кэш горячих сессий держит только хвост истории. Если старше хвоста есть реплики,
+которые ещё не свёрнуты (длинный чат, начатый до summary, или summary долго не
+обновлялось), они дочитываются из БД пачками по SUMMARY_GAP_CHUNK и сворачиваются
+раньше вытесненных — иначе summary_until_id перескочил бы через них.
+"""
+import logging
+import os
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import update
+
+from . import queries
+from .db import AsyncSessionLocal
+from .metrics import LLMCall, count_usage
+from .models import ChatSession
+from .session_cache import session_cache
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "400"))
+# Сворачиваем пачками, чтобы не звать модель на каждую вытесненную реплику
+SUMMARY_MIN_TURNS = int(os.getenv("SUMMARY_MIN_TURNS", "4"))
+# Сколько старых реплик из БД сворачивать за один вызов модели
+SUMMARY_GAP_CHUNK = int(os.getenv("SUMMARY_GAP_CHUNK", "100"))
+
+SUMMARY_INSTRUCTIONS = (
+    "Ты ведёшь краткую память о разговоре мамы с ассистентом. "
+    "Обнови краткое содержание, добавив к нему новые реплики. Сохраняй факты о маме и "
+    "ребёнке (возраст, особенности, что уже пробовали, договорённости), убирай повторы. "
+    "Пиши сжато, в третьем лице, не более {max_tokens} токенов."
+)
+
+# Сессии, для которых обновление уже идёт в этом процессе
+_in_progress = set()
+
+
+def summary_message(summary: Optional[str]) -> Optional[dict]:
+    """system-сообщение с summary, вставляется сразу после системного промта."""
+    if not summary:
+        return None
+    return {"role": "system", "content": f"Краткое содержание предыдущего разговора:\n{summary}"}
+
+
+def should_summarize(evicted: Sequence) -> bool:
+    return len(evicted) >= SUMMARY_MIN_TURNS
+
+
+def _render_turns(turns: Sequence) -> str:
+    names = {"user": "Мама", "assistant": "Ассистент"}
+    return "\n".join(f"{names.get(m.role, m.role)}: {m.content}" for m in turns)
+
+
+async def update_summary(client, session_id: str, previous: Optional[str],
+                         previous_until_id: Optional[int], evicted: List,
+                         assistant_code: str = "", gap_before_id: Optional[int] = None) -> None:
+    """Сворачивает evicted в summary сессии (фоновая задача); client — llm_client.
+
+    gap_before_id — id первой реплики хвоста в кэше, если хвост неполный: реплики
+    между previous_until_id и ним сначала дочитываются из БД и сворачиваются.
+
+    Запись условная: если summary сессии за это время обновил другой процесс
+    (summary_until_id изменился), результат отбрасывается.
+    """
+    if not evicted or session_id in _in_progress:
+        return
+    _in_progress.add(session_id)
+    try:
+        if gap_before_id is not None:
+            while True:
+                async with AsyncSessionLocal() as db:
+                    gap = list(await db.scalars(
+                        queries.summary_gap(session_id, previous_until_id, gap_before_id, SUMMARY_GAP_CHUNK)
+                    ))
+                if not gap:
+                    break
+                folded = await _fold(client, session_id, previous, previous_until_id, gap, assistant_code)
+                if folded is None:
+                    return
+                previous, previous_until_id = folded
+        if previous_until_id is not None:
+            evicted = [m for m in evicted if m.id > previous_until_id]
+        if evicted:
+            await _fold(client, session_id, previous, previous_until_id, evicted, assistant_code)
+    except Exception:
+        logger.exception("Не удалось обновить summary сессии %s", session_id)
+    finally:
+        _in_progress.discard(session_id)
+
+
+async def _fold(client, session_id: str, previous: Optional[str], previous_until_id: Optional[int],
+                turns: List, assistant_code: str) -> Optional[Tuple[str, int]]:
+    """Один шаг: turns добавляются к summary; (summary, until_id) или None, если не записано."""
+    prompt = (
+        f"Текущее краткое содержание:\n{previous or '(пока пусто)'}\n\n"
+        f"Новые реплики:\n{_render_turns(turns)}"
+    )
+    with LLMCall(SUMMARY_MODEL, "summary"):
+        # summary не срочное — без хеджирования
+        completion = await client.complete(
+            model=SUMMARY_MODEL,
+            hedge=False,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(max_tokens=SUMMARY_MAX_TOKENS)},
+                {"role": "user", "content": prompt},
+            ],
+            max_tokens=SUMMARY_MAX_TOKENS,
+        )
+    count_usage(assistant_code, completion.usage, call="summary")
+    summary = (completion.choices[0].message.content or "").strip()
+    if not summary:
+        return None
+
+    async with AsyncSessionLocal() as db:
+        if previous_until_id is None:
+            expected = ChatSession.summary_until_id.is_(None)
+        else:
+            expected = ChatSession.summary_until_id == previous_until_id
+        result = await db.execute(
+            update(ChatSession)
+            .where(ChatSession.id == session_id, expected)
+            .values(summary=summary, summary_until_id=turns[-1].id)
+        )
+        await db.commit()
+    if not result.rowcount:
+        return None
+    session_cache.set_summary(session_id, summary, turns[-1].id)
+    return summary, turns[-1].id
@@ -0,0 +1,57 @@
+"""Кто вызывает API: пользователь Telegram из initData мини-аппа.
+
+Мини-апп передаёт строку Telegram.WebApp.initData в заголовке
+X-Telegram-Init-Data. Строка подписана ботом: hash — HMAC-SHA256 от
+отсортированных пар «ключ=значение» на ключе HMAC-SHA256("WebAppData",
+TELEGRAM_BOT_TOKEN), так что подделать пользователя без токена бота нельзя.
+Подпись старше TELEGRAM_INIT_DATA_TTL секунд не принимается.
+
+Без TELEGRAM_BOT_TOKEN (локальная разработка без Telegram) проверять нечем:
+пользователем считается заголовок X-Telegram-Id, который фронтенд шлёт всегда.
+"""
+import hashlib
+import hmac
+import json
+import os
+import time
+from typing import Optional
+from urllib.parse import parse_qsl
+
+from fastapi import HTTPException, Request
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+TELEGRAM_INIT_DATA_TTL = int(os.getenv("TELEGRAM_INIT_DATA_TTL", "86400"))
+
+
+def init_data_user_id(init_data: str, bot_token: str, max_age: int = TELEGRAM_INIT_DATA_TTL,
+                      now: Optional[float] = None) -> Optional[str]:
+    """telegram_id из подписанной initData; None — подпись неверна или устарела."""
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received = fields.pop("hash", "")
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not received or not hmac.compare_digest(expected, received):
+        return None
+    try:
+        auth_date = int(fields.get("auth_date", "0"))
+        user_id = json.loads(fields.get("user", "{}")).get("id")
+    except (ValueError, AttributeError):
+        return None
+    if max_age and (now or time.time()) - auth_date > max_age:
+        return None
+    return str(user_id) if user_id is not None else None
+
+
+def caller_telegram_id(request: Request) -> str:
+    """Зависимость FastAPI: telegram_id вызывающего; 401, если он не подтверждён."""
+    if TELEGRAM_BOT_TOKEN:
+        init_data = request.headers.get("x-telegram-init-data")
+        user_id = init_data_user_id(init_data, TELEGRAM_BOT_TOKEN) if init_data else None
+        if user_id is None:
+            raise HTTPException(401, "Нужна подписанная initData Telegram (X-Telegram-Init-Data)")
+        return user_id
+    user_id = request.headers.get("x-telegram-id")
+    if not user_id:
+        raise HTTPException(401, "Не указан пользователь (X-Telegram-Id)")
+    return user_id
@@ -0,0 +1,725 @@
+"""Семантический поиск по базе знаний: эмбеддинги kb_articles и kb_examples.
+
+Ключевой поиск (app/retrieval.py) не находит перефразированные вопросы, поэтому
+есть второй режим — по близости эмбеддингов (extra_config["kb"]["mode"] = "dense").
+
+Хранение — каталог KB_VECTOR_DIR:
+  * vectors-<поколение>.f32 — одна непрерывная матрица float32 (строки нормированы):
+    фрагменты статей (split_passages) и вопросы примеров;
+  * meta-<поколение>.jsonl — что лежит в каждой строке матрицы и строки
+    {"drop": [...]} с номерами устаревших строк;
+  * index.json — поколение, число строк, длина meta, эмбеддер, разбиение IVF.
+    Переписывается атомарно и последним: читатель видит только записанный
+    префикс файлов.
+Процессы API открывают матрицу через mmap — страницы общие в page cache,
+у N воркеров uvicorn одна копия в памяти.
+
+Пишет только офлайн-команда (python -m backend.build_vectors):
+  * build — новое поколение целиком; при числе строк от KB_VECTOR_IVF_MIN_ROWS
+    векторы делятся на списки IVF (сферический k-means), поиск просматривает
+    KB_VECTOR_NPROBE ближайших списков;
+  * update — новые и изменённые статьи/примеры дописываются в конец текущего
+    поколения, их прежние строки помечаются в meta. Дописанные после
+    разбиения строки просматриваются полным перебором до следующего build.
+Процессы API раз в KB_VECTOR_RELOAD_SECONDS проверяют index.json и дочитывают
+только новый хвост meta.
+
+Вектор вопроса считает тот же эмбеддер, что строил индекс (KB_EMBEDDER):
+  * hash — детерминированный локальный (хэши основ, пар основ и триграмм),
+    для тестов и разработки без сети;
+  * openai — модель эмбеддингов OpenAI (KB_EMBED_MODEL) через llm_client;
+  * "пакет.модуль:Класс" — свой: атрибут name и async embed(texts) -> ndarray.
+Вопросы, пришедшие одновременно, считаются одним умножением матрицы на пачку
+векторов в потоке (цикл событий не блокируется), top-k — argpartition.
+"""
+import asyncio
+import fcntl
+import hashlib
+import importlib
+import json
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import anyio
+import numpy as np
+from sqlalchemy import select
+
+from .db import AsyncSessionLocal
+from .models import KbArticle, KbExample
+from .retrieval import (KB_PASSAGE_CHARS, KB_RETRIEVAL, Hit, KbSettings, Passage, accepts, grounding_message,
+                        knowledge_base, split_passages)
+from .stemmer import analyze
+
+logger = logging.getLogger(__name__)
+
+KB_VECTOR_DIR = os.getenv("KB_VECTOR_DIR", "data/kb_vectors")
+KB_EMBEDDER = os.getenv("KB_EMBEDDER", "hash")
+KB_EMBED_MODEL = os.getenv("KB_EMBED_MODEL", "text-embedding-3-small")
+KB_EMBED_DIM = int(os.getenv("KB_EMBED_DIM", "384"))
+KB_EMBED_BATCH = int(os.getenv("KB_EMBED_BATCH", "256"))
+KB_VECTOR_RELOAD_SECONDS = float(os.getenv("KB_VECTOR_RELOAD_SECONDS", "10"))
+KB_VECTOR_IVF_MIN_ROWS = int(os.getenv("KB_VECTOR_IVF_MIN_ROWS", "50000"))
+KB_VECTOR_NPROBE = int(os.getenv("KB_VECTOR_NPROBE", "16"))
+# фрагменты с косинусной близостью ниже — не в контекст (порог зависит от эмбеддера; 0 — всегда top_k)
+KB_VECTOR_MIN_SCORE = float(os.getenv("KB_VECTOR_MIN_SCORE", "0"))
+
+KIND_ARTICLE = "article"
+KIND_EXAMPLE = "example"
+_KIND_CODES = {KIND_ARTICLE: 0, KIND_EXAMPLE: 1}
+
+_FORMAT_VERSION = 1
+_HEADER = "index.json"
+_LOCK = ".lock"
+# строк матрицы за одно умножение при полном переборе
+_SCAN_CHUNK = 32768
+# итерации k-means и размер выборки на список при обучении IVF
+_KMEANS_ITERATIONS = 12
+_KMEANS_SAMPLE_PER_LIST = 64
+_MAX_MASKS = 32
+
+
+class VectorStoreError(Exception):
+    """Индекс эмбеддингов нельзя обновить (нет индекса, сменился эмбеддер)."""
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+# ----------------------------
+# Эмбеддеры
+# ----------------------------
+
+@lru_cache(maxsize=500_000)
+def _bucket(feature: str, dim: int) -> Tuple[int, float]:
+    # blake2b, а не hash(): одинаково во всех процессах и между запусками
+    value = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+    return value % dim, (1.0 if value >> 63 else -1.0)
+
+
+class HashEmbedder:
+    """Детерминированный эмбеддер без сети: признаки — основы слов, пары соседних основ
+    и триграммы основ, каждый со знаком в одну из dim координат."""
+
+    def __init__(self, dim: int = KB_EMBED_DIM):
+        self.dim = dim
+        self.name = f"hash-{dim}"
+
+    def _vector(self, text: str, out: np.ndarray) -> None:
+        stems = analyze(text)
+        features = [(s, 1.0) for s in stems]
+        features += [(f"{a} {b}", 0.5) for a, b in zip(stems, stems[1:])]
+        for s in stems:
+            padded = f"<{s}>"
+            features += [("#" + padded[i:i + 3], 0.25) for i in range(len(padded) - 2)]
+        for feature, weight in features:
+            index, sign = _bucket(feature, self.dim)
+            out[index] += sign * weight
+
+    def embed_sync(self, texts: Sequence[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            self._vector(text, out[row])
+        return _normalize(out)
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return self.embed_sync(texts)
+
+
+class OpenAIEmbedder:
+    """Эмбеддинги OpenAI (KB_EMBED_MODEL); размерность — по ответу модели."""
+
+    def __init__(self, model: str = KB_EMBED_MODEL):
+        self.model = model
+        self.name = f"openai:{model}"
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        from .llm_client import llm_client
+
+        response = await llm_client.embed(model=self.model, texts=texts)
+        data = sorted(response.data, key=lambda item: item.index)
+        return _normalize(np.array([item.embedding for item in data], dtype=np.float32))
+
+
+EMBEDDERS = {"hash": HashEmbedder, "openai": OpenAIEmbedder}
+
+
+def load_embedder(spec: str = KB_EMBEDDER):
+    """Эмбеддер по имени из EMBEDDERS или пути "пакет.модуль:Класс"."""
+    if spec in EMBEDDERS:
+        return EMBEDDERS[spec]()
+    module, _, attr = spec.partition(":")
+    if not attr:
+        raise ValueError(f"Неизвестный эмбеддер {spec!r}: ожидается {sorted(EMBEDDERS)} или модуль:Класс")
+    return getattr(importlib.import_module(module), attr)()
+
+
+# ----------------------------
+# Строки индекса
+# ----------------------------
+
+@dataclass(frozen=True)
+class VectorRow:
+    """Строка матрицы. У примера title — вопрос, text — ответ, owner — assistant_id."""
+    kind: str
+    id: int
+    title: str
+    text: str
+    age_group: Optional[str]
+    tags: Tuple[str, ...]
+    owner: Optional[int]
+    digest: str
+    embed_text: str
+
+    @property
+    def key(self) -> Tuple[str, int]:
+        return self.kind, self.id
+
+    def meta_line(self) -> bytes:
+        return (json.dumps({
+            "kind": self.kind, "id": self.id, "title": self.title, "text": self.text,
+            "age_group": self.age_group, "tags": list(self.tags), "owner": self.owner, "digest": self.digest,
+        }, ensure_ascii=False) + "\n").encode()
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def article_rows(article: KbArticle, size: int = KB_PASSAGE_CHARS) -> List[VectorRow]:
+    tags = tuple(str(t) for t in article.tags or ())
+    digest = _digest(article.title, article.body, article.age_group, tags)
+    return [
+        VectorRow(KIND_ARTICLE, article.id, article.title, text, article.age_group, tags, None, digest,
+                  f"{article.title}\n{text}")
+        for text in split_passages(article.body, size)
+    ]
+
+
+def example_rows(example: KbExample) -> List[VectorRow]:
+    tags = tuple(str(t) for t in example.tags or ())
+    digest = _digest(example.question_example, example.answer_example, example.age_group, tags,
+                     example.assistant_id)
+    # близость считается по вопросу: с ним сравнивается вопрос пользователя
+    return [VectorRow(KIND_EXAMPLE, example.id, example.question_example, example.answer_example,
+                      example.age_group, tags, example.assistant_id, digest, example.question_example)]
+
+
+async def load_rows() -> List[VectorRow]:
+    """Все строки для индекса из kb_articles и kb_examples."""
+    async with AsyncSessionLocal() as db:
+        articles = (await db.scalars(select(KbArticle).order_by(KbArticle.id))).all()
+        examples = (await db.scalars(select(KbExample).order_by(KbExample.id))).all()
+    rows = [row for article in articles for row in article_rows(article)]
+    rows += [row for example in examples for row in example_rows(example)]
+    return rows
+
+
+# ----------------------------
+# Запись (офлайн)
+# ----------------------------
+
+def _kmeans(vectors: np.ndarray, lists: int, seed: int = 0) -> np.ndarray:
+    """Сферический k-means по выборке строк: центроиды lists x dim (нормированы)."""
+    rnd = np.random.default_rng(seed)
+    sample_size = min(len(vectors), lists * _KMEANS_SAMPLE_PER_LIST)
+    sample = np.asarray(vectors[np.sort(rnd.choice(len(vectors), sample_size, replace=False))])
+    centroids = sample[rnd.choice(sample_size, lists, replace=False)].copy()
+    for _ in range(_KMEANS_ITERATIONS):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=lists)
+        empty = counts == 0
+        # пустой список получает случайную точку выборки
+        sums[empty] = sample[rnd.choice(sample_size, int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _SCAN_CHUNK):
+        chunk = np.asarray(vectors[start:start + _SCAN_CHUNK])
+        assign[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assign
+
+
+class VectorStore:
+    """Файлы индекса в каталоге; писатель один (flock на .lock)."""
+
+    def __init__(self, path: str = KB_VECTOR_DIR):
+        self.path = Path(path)
+
+    def header(self) -> Optional[dict]:
+        try:
+            return json.loads((self.path / _HEADER).read_text())
+        except FileNotFoundError:
+            return None
+
+    def file(self, kind: str, generation: int) -> Path:
+        suffix = {"vectors": "f32", "meta": "jsonl", "centroids": "f32"}[kind]
+        return self.path / f"{kind}-{generation}.{suffix}"
+
+    @contextmanager
+    def _lock(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / _LOCK, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write_header(self, header: dict) -> None:
+        tmp = self.path / f"{_HEADER}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(header, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path / _HEADER)
+
+    @staticmethod
+    async def _write_vectors(rows: Sequence[VectorRow], embedder, vectors_file, batch: int) -> Optional[int]:
+        dim = None
+        for start in range(0, len(rows), batch):
+            chunk = rows[start:start + batch]
+            vectors = np.ascontiguousarray(await embedder.embed([r.embed_text for r in chunk]), dtype=np.float32)
+            dim = vectors.shape[1]
+            vectors_file.write(vectors.tobytes())
+        vectors_file.flush()
+        os.fsync(vectors_file.fileno())
+        return dim
+
+    @staticmethod
+    def _write_meta(rows: Sequence[VectorRow], meta_file, drop: Sequence[int] = ()) -> None:
+        for start in range(0, len(rows), _SCAN_CHUNK):
+            meta_file.write(b"".join(r.meta_line() for r in rows[start:start + _SCAN_CHUNK]))
+        if drop:
+            meta_file.write((json.dumps({"drop": list(drop)}) + "\n").encode())
+        meta_file.flush()
+        os.fsync(meta_file.fileno())
+
+    async def build(self, rows: Sequence[VectorRow], embedder, ivf_lists: Optional[int] = None,
+                    batch: int = KB_EMBED_BATCH) -> dict:
+        """Новое поколение из rows. ivf_lists: None — по KB_VECTOR_IVF_MIN_ROWS, 0 — без IVF."""
+        with self._lock():
+            old = self.header()
+            generation = old["generation"] + 1 if old else 1
+            started = time.perf_counter()
+            vectors_path = self.file("vectors", generation)
+            raw_path = vectors_path.with_suffix(".raw")
+            with open(raw_path, "wb") as vf:
+                dim = await self._write_vectors(rows, embedder, vf, batch) or getattr(embedder, "dim", 0)
+            if ivf_lists is None:
+                ivf_lists = int(math.sqrt(len(rows))) if len(rows) >= KB_VECTOR_IVF_MIN_ROWS else 0
+            ivf = None
+            if ivf_lists and len(rows) >= ivf_lists:
+                ivf, order = await anyio.to_thread.run_sync(self._build_ivf, generation, len(rows), dim, ivf_lists)
+                rows = [rows[i] for i in order]
+            else:
+                os.replace(raw_path, vectors_path)
+            with open(self.file("meta", generation), "wb") as mf:
+                self._write_meta(rows, mf)
+                meta_bytes = mf.tell()
+            self._write_header({
+                "version": _FORMAT_VERSION,
+                "generation": generation,
+                "embedder": embedder.name,
+                "dim": dim,
+                "rows": len(rows),
+                "meta_bytes": meta_bytes,
+                "dropped": 0,
+                "built_at": datetime.utcnow().isoformat(),
+                "updated_at": datetime.utcnow().isoformat(),
+                "ivf": ivf,
+            })
+            # старые файлы удаляются: у читателей их mmap остаётся рабочим до перечитывания
+            if old:
+                for kind in ("vectors", "meta", "centroids"):
+                    self.file(kind, old["generation"]).unlink(missing_ok=True)
+        logger.info("Индекс эмбеддингов: поколение %d, %d строк (%s) за %.1f с", generation, len(rows),
+                    embedder.name, time.perf_counter() - started)
+        return self.header()
+
+    def _build_ivf(self, generation: int, rows: int, dim: int, lists: int):
+        """Обучает IVF и переписывает матрицу по спискам: каждый список — непрерывный отрезок строк."""
+        raw_path = self.file("vectors", generation).with_suffix(".raw")
+        vectors = np.memmap(raw_path, dtype=np.float32, mode="r", shape=(rows, dim))
+        centroids = _kmeans(vectors, lists)
+        assign = _assign(vectors, centroids)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.searchsorted(assign[order], np.arange(lists + 1)).tolist()
+        with open(self.file("vectors", generation), "wb") as f:
+            for start in range(0, rows, _SCAN_CHUNK):
+                f.write(np.ascontiguousarray(vectors[order[start:start + _SCAN_CHUNK]]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        del vectors
+        raw_path.unlink()
+        centroids.astype(np.float32).tofile(self.file("centroids", generation))
+        return {"lists": lists, "rows": rows, "offsets": offsets}, order
+
+    async def update(self, rows: Sequence[VectorRow], embedder, batch: int = KB_EMBED_BATCH) -> dict:
+        """Дописывает новые и изменённые строки, помечает прежние и удалённые. Матрица не пересобирается."""
+        with self._lock():
+            header = self.header()
+            if header is None:
+                raise VectorStoreError("Индекса эмбеддингов нет — сначала build")
+            if header["embedder"] != embedder.name:
+                raise VectorStoreError(f"Индекс построен эмбеддером {header['embedder']}, "
+                                       f"а задан {embedder.name} — нужен build")
+            generation = header["generation"]
+            metas, drops = _read_meta(self.file("meta", generation), 0, header["meta_bytes"])
+            dropped = set(drops)
+            current: Dict[Tuple[str, int], Tuple[str, List[int]]] = {}
+            for number, meta in enumerate(metas):
+                if number not in dropped:
+                    current.setdefault((meta["kind"], meta["id"]), (meta["digest"], []))[1].append(number)
+
+            incoming: Dict[Tuple[str, int], List[VectorRow]] = {}
+            for row in rows:
+                incoming.setdefault(row.key, []).append(row)
+            changed = [key for key, group in incoming.items()
+                       if key not in current or current[key][0] != group[0].digest]
+            removed = [key for key in current if key not in incoming]
+            drop = sorted(n for key in changed + removed if key in current for n in current[key][1])
+            appended = [row for key in changed for row in incoming[key]]
+            if not appended and not drop:
+                return header
+
+            dim = header["dim"]
+            with open(self.file("vectors", generation), "r+b") as vf, open(self.file("meta", generation), "r+b") as mf:
+                # хвост от прерванной записи (за пределами index.json) отбрасывается
+                vf.truncate(header["rows"] * dim * 4)
+                mf.truncate(header["meta_bytes"])
+                vf.seek(0, os.SEEK_END)
+                mf.seek(0, os.SEEK_END)
+                new_dim = await self._write_vectors(appended, embedder, vf, batch)
+                if new_dim is not None and dim and new_dim != dim:
+                    vf.truncate(header["rows"] * dim * 4)
+                    raise VectorStoreError(f"Размерность эмбеддингов {new_dim} вместо {dim}")
+                self._write_meta(appended, mf, drop)
+                meta_bytes = mf.tell()
+            header = {**header, "dim": dim or new_dim, "rows": header["rows"] + len(appended),
+                      "meta_bytes": meta_bytes, "dropped": header["dropped"] + len(drop),
+                      "updated_at": datetime.utcnow().isoformat()}
+            self._write_header(header)
+        logger.info("Индекс эмбеддингов: дописано %d строк, помечено удалёнными %d", len(appended), len(drop))
+        return header
+
+
+def _read_meta(path: Path, start: int, end: int) -> Tuple[List[dict], List[int]]:
+    """Строки meta от байта start до end: описания строк матрицы по порядку и номера удалённых."""
+    metas, drops = [], []
+    with open(path, "rb") as f:
+        f.seek(start)
+        for line in f.read(end - start).splitlines():
+            meta = json.loads(line)
+            if "drop" in meta:
+                drops.extend(meta["drop"])
+            else:
+                metas.append(meta)
+    return metas, drops
+
+
+# ----------------------------
+# Чтение и поиск (процессы API)
+# ----------------------------
+
+@dataclass(frozen=True)
+class _Query:
+    top_k: int
+    kind: str = KIND_ARTICLE
+    age_group: Optional[str] = None
+    tags: FrozenSet[str] = frozenset()
+    # примеры: только общие и этого ассистента
+    owner: Optional[int] = None
+
+
+@dataclass
+class _Snapshot:
+    """Согласованное состояние индекса; поиск держит ссылку, перечитывание подменяет целиком."""
+    header: dict
+    matrix: np.ndarray
+    passages: List[Passage]
+    kind_codes: List[int]
+    owner_ids: List[int]
+    drops: List[int]
+    kinds: np.ndarray
+    owners: np.ndarray
+    alive: np.ndarray
+    centroids: Optional[np.ndarray] = None
+    offsets: Optional[np.ndarray] = None
+    masks: "OrderedDict" = field(default_factory=OrderedDict)
+
+    @property
+    def rows(self) -> int:
+        return len(self.passages)
+
+    def mask(self, query: _Query) -> np.ndarray:
+        key = (query.kind, query.age_group, query.tags, query.owner)
+        mask = self.masks.get(key)
+        if mask is not None:
+            self.masks.move_to_end(key)
+            return mask
+        mask = self.alive & (self.kinds == _KIND_CODES[query.kind])
+        if query.age_group is not None or query.tags:
+            mask &= np.fromiter((accepts(p, query.age_group, query.tags) for p in self.passages),
+                                dtype=bool, count=self.rows)
+        if query.owner is not None:
+            mask &= (self.owners == query.owner) | (self.owners == -1)
+        self.masks[key] = mask
+        if len(self.masks) > _MAX_MASKS:
+            self.masks.popitem(last=False)
+        return mask
+
+
+def _load_snapshot(store: VectorStore, header: dict, previous: Optional[_Snapshot]) -> _Snapshot:
+    generation = header["generation"]
+    if (previous is not None and previous.header["generation"] == generation
+            and header["meta_bytes"] >= previous.header["meta_bytes"]):
+        # то же поколение: дочитывается только дописанный хвост meta
+        start = previous.header["meta_bytes"]
+        passages, kind_codes = previous.passages.copy(), previous.kind_codes.copy()
+        owner_ids, drops = previous.owner_ids.copy(), previous.drops.copy()
+    else:
+        start, passages, kind_codes, owner_ids, drops = 0, [], [], [], []
+    metas, new_drops = _read_meta(store.file("meta", generation), start, header["meta_bytes"])
+    for meta in metas:
+        passages.append(Passage(meta["id"], meta["title"], meta["text"], meta["age_group"],
+                                frozenset(meta["tags"] or ())))
+        kind_codes.append(_KIND_CODES[meta["kind"]])
+        owner_ids.append(-1 if meta["owner"] is None else meta["owner"])
+    drops += new_drops
+    rows, dim = header["rows"], header["dim"]
+    if len(passages) != rows:
+        raise VectorStoreError(f"meta описывает {len(passages)} строк, index.json — {rows}")
+    matrix = (np.memmap(store.file("vectors", generation), dtype=np.float32, mode="r", shape=(rows, dim))
+              if rows else np.zeros((0, dim), dtype=np.float32))
+    alive = np.ones(rows, dtype=bool)
+    alive[drops] = False
+    snapshot = _Snapshot(header, matrix, passages, kind_codes, owner_ids, drops,
+                         np.array(kind_codes, dtype=np.int8), np.array(owner_ids, dtype=np.int64), alive)
+    ivf = header.get("ivf")
+    if ivf:
+        snapshot.centroids = np.fromfile(store.file("centroids", generation), dtype=np.float32).reshape(-1, dim)
+        snapshot.offsets = np.array(ivf["offsets"], dtype=np.int64)
+    return snapshot
+
+
+def _top(scores: np.ndarray, k: int) -> np.ndarray:
+    """Индексы k наибольших значений по убыванию."""
+    if len(scores) > k:
+        part = np.argpartition(-scores, k)[:k]
+    else:
+        part = np.arange(len(scores))
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+def _scan(snapshot: _Snapshot, vectors: np.ndarray, masks: List[Optional[np.ndarray]], k: int):
+    """Полный перебор: матрица кусками по _SCAN_CHUNK строк на всю пачку вопросов сразу."""
+    found = [([], []) for _ in masks]
+    for start in range(0, snapshot.rows, _SCAN_CHUNK):
+        chunk = snapshot.matrix[start:start + _SCAN_CHUNK]
+        scores = vectors @ chunk.T
+        for j, mask in enumerate(masks):
+            row = scores[j]
+            if mask is not None:
+                row[~mask[start:start + len(chunk)]] = -np.inf
+            top = _top(row, k)
+            found[j][0].append(top + start)
+            found[j][1].append(row[top])
+    return [(np.concatenate(ids), np.concatenate(values)) for ids, values in found]
+
+
+def _probe(snapshot: _Snapshot, vectors: np.ndarray, masks: List[Optional[np.ndarray]], k: int, nprobe: int):
+    """IVF: nprobe ближайших списков (непрерывные отрезки матрицы) плюс строки, дописанные после разбиения."""
+    offsets = snapshot.offsets
+    tail = (snapshot.header["ivf"]["rows"], snapshot.rows)
+    nearest = vectors @ snapshot.centroids.T
+    found = []
+    for j, mask in enumerate(masks):
+        spans = [(offsets[p], offsets[p + 1]) for p in _top(nearest[j], nprobe)] + [tail]
+        spans = [(lo, hi) for lo, hi in spans if hi > lo]
+        ids = np.concatenate([np.arange(lo, hi) for lo, hi in spans])
+        scores = np.concatenate([snapshot.matrix[lo:hi] @ vectors[j] for lo, hi in spans])
+        if mask is not None:
+            scores[~mask[ids]] = -np.inf
+        top = _top(scores, k)
+        found.append((ids[top], scores[top]))
+    return found
+
+
+def search_batch(snapshot: _Snapshot, vectors: np.ndarray, queries: Sequence[_Query],
+                 nprobe: int = KB_VECTOR_NPROBE) -> List[List[Hit]]:
+    """top-k для пачки нормированных векторов вопросов (строки vectors) по одному снимку индекса."""
+    if not snapshot.rows:
+        return [[] for _ in queries]
+    k = max(q.top_k for q in queries)
+    # маска без исключений (нет фильтров и удалённых строк) не применяется
+    masks = [None if mask.all() else mask for mask in (snapshot.mask(q) for q in queries)]
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if snapshot.centroids is not None and nprobe < len(snapshot.centroids):
+        found = _probe(snapshot, vectors, masks, k, nprobe)
+    else:
+        found = _scan(snapshot, vectors, masks, k)
+    results = []
+    for query, (ids, scores) in zip(queries, found):
+        order = _top(scores, query.top_k)
+        results.append([Hit(snapshot.passages[ids[i]], float(scores[i])) for i in order if np.isfinite(scores[i])])
+    return results
+
+
+class VectorIndex:
+    def __init__(self, path: str = KB_VECTOR_DIR):
+        self.enabled = KB_RETRIEVAL
+        self.store = VectorStore(path)
+        self.snapshot: Optional[_Snapshot] = None
+        self.embedder = None
+        self.reloads = 0
+        self.searches = 0
+        self.batches = 0
+        self.search_seconds = 0.0
+        self.fallbacks = 0
+        self._header_mtime: Optional[int] = None
+        self._pending: List[Tuple[np.ndarray, _Query, asyncio.Future]] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self._reloader: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.snapshot is not None and self.snapshot.rows > 0
+
+    # --- загрузка ---
+
+    async def reload(self) -> bool:
+        """Перечитывает индекс, если index.json изменился; True — если подменён."""
+        try:
+            mtime = (self.store.path / _HEADER).stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._header_mtime:
+            return False
+        self._header_mtime = mtime
+        header = self.store.header()
+        if header.get("version") != _FORMAT_VERSION:
+            logger.warning("Индекс эмбеддингов версии %s не поддерживается — нужен build", header.get("version"))
+            return False
+        if self.embedder is None:
+            self.embedder = load_embedder()
+        if self.embedder.name != header["embedder"]:
+            # вектор вопроса другим эмбеддером с матрицей несравним
+            logger.warning("Индекс эмбеддингов построен %s, а KB_EMBEDDER — %s: семантический поиск выключен",
+                           header["embedder"], self.embedder.name)
+            self.snapshot = None
+            return False
+        self.snapshot = await anyio.to_thread.run_sync(_load_snapshot, self.store, header, self.snapshot)
+        self.reloads += 1
+        logger.info("Индекс эмбеддингов: поколение %d, %d строк", header["generation"], header["rows"])
+        return True
+
+    # --- поиск ---
+
+    async def search(self, query: str, top_k: int, kind: str = KIND_ARTICLE, age_group: Optional[str] = None,
+                     tags: FrozenSet[str] = frozenset(), owner: Optional[int] = None) -> List[Hit]:
+        if not self.ready:
+            return []
+        started = time.perf_counter()
+        vector = (await self.embedder.embed([query]))[0]
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((vector, _Query(top_k, kind, age_group, tags, owner), future))
+        if self._flusher is None or self._flusher.done():
+            # вопросы, пришедшие до запуска задачи, уйдут одной пачкой
+            self._flusher = asyncio.create_task(self._flush())
+        hits = await future
+        self.searches += 1
+        self.search_seconds += time.perf_counter() - started
+        return hits
+
+    async def _flush(self) -> None:
+        # пока пачка считается в потоке, следующие вопросы копятся в _pending
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                results = await anyio.to_thread.run_sync(
+                    search_batch, self.snapshot, np.stack([v for v, _, _ in batch]), [q for _, q, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            for (_, _, future), hits in zip(batch, results):
+                if not future.done():
+                    future.set_result(hits)
+
+    async def grounding(self, query: str, settings: KbSettings, model: str) -> Optional[dict]:
+        """Как KnowledgeBase.grounding, но по близости эмбеддингов; при сбое эмбеддера — ключевой поиск."""
+        try:
+            hits = await self.search(query, settings.top_k, KIND_ARTICLE, settings.age_group, settings.tags)
+        except Exception:
+            logger.exception("Семантический поиск не удался, используется ключевой")
+            self.fallbacks += 1
+            return knowledge_base.grounding(query, settings, model)
+        hits = [h for h in hits if h.score >= KB_VECTOR_MIN_SCORE]
+        return grounding_message(hits, settings.max_tokens, model) if hits else None
+
+    # --- фоновое перечитывание ---
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        self._reloader = asyncio.create_task(self._reload_loop())
+
+    async def _reload_loop(self) -> None:
+        while True:
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Не удалось перечитать индекс эмбеддингов")
+            await asyncio.sleep(KB_VECTOR_RELOAD_SECONDS)
+
+    async def stop(self) -> None:
+        for task in (self._reloader, self._flusher):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._reloader = self._flusher = None
+        for _, _, future in self._pending:
+            if not future.done():
+                future.cancel()
+        self._pending = []
+
+    def stats(self) -> dict:
+        snapshot = self.snapshot
+        header = snapshot.header if snapshot is not None else {}
+        return {
+            "enabled": self.enabled,
+            "ready": self.ready,
+            "embedder": header.get("embedder"),
+            "generation": header.get("generation"),
+            "rows": snapshot.rows if snapshot is not None else 0,
+            "live": int(snapshot.alive.sum()) if snapshot is not None else 0,
+            "ivf_lists": len(snapshot.centroids) if snapshot is not None and snapshot.centroids is not None else 0,
+            "reloads": self.reloads,
+            "searches": self.searches,
+            "avg_batch": round(self.searches / self.batches, 2) if self.batches else 0.0,
+            "avg_search_ms": round(self.search_seconds / self.searches * 1000, 3) if self.searches else 0.0,
+            "fallbacks": self.fallbacks,
+        }
+
+
+vector_index = VectorIndex()
@@ -0,0 +1,46 @@
+"""Общее для проверочных скриптов: печать результатов, перцентили, заглушка OpenAI."""
+import math
+import socket
+from typing import List
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по методу ближайшего ранга; 0.0 для пустого списка."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)] if ordered else 0.0
+
+
+def free_port() -> int:
+    """Свободный TCP-порт на localhost для заглушки fake_openai."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def reset_fake(fake, **state) -> None:
+    """Сбрасывает счётчики заглушки fake_openai (fake — её приложение) и задаёт поведение."""
+    defaults = dict(delay=0.02, token_delay=0.001, reply_tokens=0, error_rate=0.0,
+                    error_status=500, slow_rate=0.0, slow_delay=0.0)
+    for key, value in {**defaults, **state}.items():
+        setattr(fake.state, key, value)
+    fake.state.failing_models = set()
+    fake.state.model_delays = {}
+    fake.state.model_calls = {}
+    fake.state.calls = 0
+    fake.state.errors = 0
+    fake.state.max_in_flight = 0
+    fake.state.connections = set()
+
+
+class Checks:
+    """Печатает строки [OK]/[FAIL] и запоминает итог для кода возврата."""
+
+    def __init__(self):
+        self.results: List[bool] = []
+
+    def __call__(self, name: str, ok: bool, details: str) -> None:
+        self.results.append(ok)
+        print(f"[{'OK' if ok else 'FAIL'}] {name}: {details}")
+
+    def exit_code(self) -> int:
+        return 0 if all(self.results) else 1
@@ -0,0 +1,94 @@
+"""Бенчмарк потолка конкурентности /chat/send.
+
+Поднимает заглушку OpenAI с искусственной задержкой, SQLite-базу и гоняет
+N одновременных /chat/send через приложение в процессе. Для сравнения режим
+--mode sync повторяет старую схему: блокирующий клиент OpenAI в threadpool
+Starlette (по умолчанию 40 потоков).
+
+    python -m backend.bench.concurrency --requests 200 --delay 3
+    python -m backend.bench.concurrency --requests 200 --delay 3 --mode sync
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+
+async def run(args) -> None:
+    import httpx
+    from anyio import to_thread
+    from openai import OpenAI
+
+    import backend.main as main
+    from backend.app.db import AsyncSessionLocal, create_tables
+    from backend.app.models import Assistant
+
+    await create_tables()
+    async with AsyncSessionLocal() as db:
+        db.add(Assistant(
+            code="bench", title="Bench", description="", base_model="fake",
+            system_prompt="Ты ассистент.", extra_config={},
+        ))
+        await db.commit()
+
+    if args.mode == "sync":
+        # старое поведение: sync-вызов OpenAI, исполняемый в threadpool
+        sync_client = OpenAI(base_url=os.environ["OPENAI_BASE_URL"], api_key="bench")
+
+        class _SyncCompletions:
+            async def create(self, **kwargs):
+                return await to_thread.run_sync(
+                    lambda: sync_client.chat.completions.create(**kwargs)
+                )
+
+        main.llm_client.openai.chat.completions = _SyncCompletions()
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        session_ids = []
+        for i in range(args.requests):
+            r = await client.post("/chat/session", json={"assistant_slug": "bench", "telegram_id": f"u{i}"})
+            session_ids.append(r.json()["session_id"])
+
+        async def send(sid):
+            r = await client.post("/chat/send", json={"session_id": sid, "assistant_slug": "bench", "message": "Малыш не спит"})
+            r.raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(sid) for sid in session_ids))
+        elapsed = time.perf_counter() - started
+
+    ideal = args.delay
+    print(f"mode={args.mode} requests={args.requests} delay={args.delay}s")
+    print(f"wall time: {elapsed:.2f}s (идеал ~{ideal:.2f}s)")
+    print(f"throughput: {args.requests / elapsed:.1f} req/s")
+    print(f"эффективная конкурентность: ~{args.requests * args.delay / elapsed:.0f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--delay", type=float, default=3.0)
+    parser.add_argument("--mode", choices=["async", "sync"], default="async")
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    from backend.bench.fake_openai import FakeOpenAIServer
+
+    # sqlite в tmpfs, чтобы fsync диска не маскировал ожидание LLM;
+    # для замера на Postgres задайте DATABASE_URL явно
+    tmp_root = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    db_path = os.path.join(tempfile.mkdtemp(dir=tmp_root), "bench.db")
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{db_path}")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    # меряем потолок приложения, а не лимит одновременных вызовов модели
+    os.environ.setdefault("OPENAI_MAX_IN_FLIGHT", str(args.requests))
+
+    with FakeOpenAIServer(port=args.port, delay=args.delay) as fake:
+        os.environ["OPENAI_BASE_URL"] = fake.base_url
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Локальная заглушка OpenAI-совместимого API для бенчмарков.
+
+Параметры: delay — время до первого токена, token_delay — пауза между
+токенами (1 / скорость генерации), reply_tokens — длина ответа (0 — короткое
+эхо вопроса), error_rate/error_status — доля запросов, на которые
+возвращается ошибка (429 — с Retry-After), slow_rate/slow_delay — доля
+запросов с дополнительной задержкой (хвост распределения задержек),
+failing_models — модели, которые всегда отвечают ошибкой error_status,
+model_delays — добавочная задержка по моделям.
+Все параметры лежат в app.state и меняются на ходу.
+
+Запуск отдельно:
+    python -m backend.bench.fake_openai --port 9100 --delay 3
+    python -m backend.bench.fake_openai --delay 0.8 --token-delay 0.01 --reply-tokens 300 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+_FILLER = ("малыш", "сон", "режим", "кормление", "спокойно", "обычно", "стоит", "попробовать")
+
+
+def create_app(delay: float = 3.0, token_delay: float = 0.02, reply_tokens: int = 0,
+               error_rate: float = 0.0, error_status: int = 500, slow_rate: float = 0.0,
+               slow_delay: float = 0.0, seed: int = 0) -> FastAPI:
+    """delay — задержка до первого токена (и всего ответа без stream, если
+    reply_tokens не задан), token_delay — пауза между токенами."""
+    app = FastAPI()
+    app.state.delay = delay
+    app.state.token_delay = token_delay
+    app.state.reply_tokens = reply_tokens
+    app.state.error_rate = error_rate
+    app.state.error_status = error_status
+    app.state.slow_rate = slow_rate
+    app.state.slow_delay = slow_delay
+    app.state.failing_models = set()
+    app.state.model_delays = {}
+    app.state.calls = 0
+    # вызовов по моделям
+    app.state.model_calls = {}
+    app.state.errors = 0
+    # запросы, обрабатываемые сейчас, и максимум за всё время
+    app.state.in_flight = 0
+    app.state.max_in_flight = 0
+    # адреса клиентов: сколько TCP-соединений понадобилось (keep-alive)
+    app.state.connections = set()
+    rng = random.Random(seed)
+
+    def make_reply(last: str) -> str:
+        reply = f"Ответ на: {last[:50]}"
+        if app.state.reply_tokens:
+            # «токен» заглушки — слово: столько же чанков придёт в потоке
+            words = [_FILLER[i % len(_FILLER)] for i in range(app.state.reply_tokens)]
+            reply = " ".join([reply] + words)
+        return reply
+
+    def enter() -> None:
+        app.state.in_flight += 1
+        app.state.max_in_flight = max(app.state.max_in_flight, app.state.in_flight)
+
+    def leave() -> None:
+        app.state.in_flight -= 1
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.calls += 1
+        model = body.get("model", "fake")
+        app.state.model_calls[model] = app.state.model_calls.get(model, 0) + 1
+        app.state.connections.add((request.client.host, request.client.port))
+        enter()
+        streaming = False
+        try:
+            failing = model in app.state.failing_models
+            if failing or (app.state.error_rate and rng.random() < app.state.error_rate):
+                app.state.errors += 1
+                await asyncio.sleep(app.state.delay / 10)
+                headers = {"Retry-After": "1"} if app.state.error_status == 429 else {}
+                return JSONResponse(
+                    {"error": {"message": "injected error", "type": "server_error", "code": None}},
+                    status_code=app.state.error_status, headers=headers,
+                )
+
+            last = body["messages"][-1]["content"] if body.get("messages") else ""
+            reply = make_reply(last)
+            usage = fake_usage(body.get("messages") or [], reply)
+            delay = app.state.delay + app.state.model_delays.get(model, 0.0)
+            if app.state.slow_rate and rng.random() < app.state.slow_rate:
+                delay += app.state.slow_delay
+
+            if body.get("stream"):
+                include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+                streaming = True
+                return StreamingResponse(
+                    stream_chunks(body.get("model", "fake"), reply, delay,
+                                  usage if include_usage else None),
+                    media_type="text/event-stream",
+                )
+
+            generation = len(reply.split(" ")) * app.state.token_delay if app.state.reply_tokens else 0.0
+            await asyncio.sleep(delay + generation)
+        finally:
+            # поток снимает отметку сам, когда допишется или оборвётся
+            if not streaming:
+                leave()
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage,
+        }
+
+    def fake_usage(messages, reply: str) -> dict:
+        # грубая оценка, как в context.count_tokens без tiktoken: ~3 символа на токен
+        prompt = sum(len(m.get("content") or "") // 3 + 4 for m in messages)
+        completion = len(reply) // 3 + 1
+        return {"prompt_tokens": prompt, "completion_tokens": completion,
+                "total_tokens": prompt + completion}
+
+    async def stream_chunks(model: str, reply: str, delay: float, usage=None):
+        try:
+            async for chunk in _stream_chunks(model, reply, delay, usage):
+                yield chunk
+        finally:
+            leave()
+
+    async def _stream_chunks(model: str, reply: str, delay: float, usage=None):
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        await asyncio.sleep(delay)
+        for token in reply.split(" "):
+            chunk = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token + " "}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(app.state.token_delay)
+        if usage is not None:
+            # stream_options.include_usage: последний чанк без choices, с usage
+            chunk = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [], "usage": usage}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return app
+
+
+class FakeOpenAIServer:
+    """Запускает заглушку в фоновом потоке (для использования из бенчмарков)."""
+
+    def __init__(self, port: int = 9100, **app_kwargs):
+        self.port = port
+        self.app = create_app(**app_kwargs)
+        config = uvicorn.Config(self.app, host="127.0.0.1", port=port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--delay", type=float, default=3.0)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--reply-tokens", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-delay", type=float, default=0.0)
+    args = parser.parse_args()
+    app = create_app(delay=args.delay, token_delay=args.token_delay, reply_tokens=args.reply_tokens,
+                     error_rate=args.error_rate, error_status=args.error_status,
+                     slow_rate=args.slow_rate, slow_delay=args.slow_delay)
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
@@ -0,0 +1,107 @@
+"""Проверка подбора примеров few-shot (app/few_shot.py).
+
+БД не нужна: библиотека примеров генерируется из «русского» корпуса
+bench/kb_search.py и ставится в селектор напрямую.
+
+Сценарии:
+  * scale   — время выбора (промах кэша) p50/p99 на библиотеках разного
+    размера: не растёт вместе с числом примеров;
+  * memo    — повтор вопроса той же формы (другой порядок слов, словоформы
+    основ те же, знаки) — попадание в кэш, время p50;
+  * budget  — выбранные примеры укладываются в max_tokens и max_examples;
+  * stable  — одинаковая форма вопроса даёт одинаковые примеры в одинаковом порядке;
+  * isolation — ассистенту достаются только свои и общие примеры.
+
+Код возврата 1 при нарушении.
+
+    python -m backend.bench.few_shot
+    python -m backend.bench.few_shot --sizes 1000,10000,100000
+"""
+import argparse
+import sys
+import time
+from types import SimpleNamespace
+
+from backend.bench._common import Checks, percentile
+
+
+def run(args) -> int:
+    from backend.app.few_shot import Example, FewShotSelector
+    from backend.bench.kb_search import Corpus
+
+    check = Checks()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    corpus = Corpus(args.seed, 6000)
+    assistant = SimpleNamespace(id=1, extra_config={"few_shot": {"max_examples": 3, "max_tokens": args.max_tokens}})
+    other = SimpleNamespace(id=2, extra_config={})
+
+    def library(size):
+        examples = []
+        for i in range(size):
+            question = " ".join(corpus.form(s) for s in corpus.words(corpus.rnd.randint(5, 12))) + "?"
+            answer = " ".join(corpus.form(s) for s in corpus.words(corpus.rnd.randint(20, 80))) + "."
+            owner = (1, 2, None)[i % 3]
+            examples.append(Example(i + 1, owner, question, answer, (len(question) + len(answer)) // 3 + 8))
+        return examples
+
+    questions = [" ".join(corpus.form(s) for s in corpus.words(8)) for _ in range(args.queries)]
+    timings = {}
+    selector = FewShotSelector()
+    for size in sizes:
+        examples = library(size)
+        selector.install(examples)
+        latencies = []
+        for question in questions:
+            t0 = time.perf_counter()
+            selector.select(assistant, question)
+            latencies.append(time.perf_counter() - t0)
+        timings[size] = latencies
+    check("scale", all(percentile(t, 50) < 0.005 for t in timings.values()),
+          "; ".join(f"{size} примеров: p50 {percentile(t, 50) * 1e6:.0f} мкс, p99 {percentile(t, 99) * 1e6:.0f} мкс"
+                    for size, t in timings.items()))
+
+    # тот же набор основ в другом порядке и с другими знаками
+    latencies, same = [], 0
+    for question in questions:
+        first = selector.select(assistant, question)
+        words = question.split()
+        variant = ", ".join(reversed(words)).upper() + "?!"
+        t0 = time.perf_counter()
+        again = selector.select(assistant, variant)
+        latencies.append(time.perf_counter() - t0)
+        same += again == first
+    stats = selector.stats()
+    check("memo", same == len(questions) and stats["hits"] >= len(questions),
+          f"повтор формы вопроса: p50 {percentile(latencies, 50) * 1e6:.1f} мкс, совпало {same} из {len(questions)}; "
+          f"попаданий {stats['hits']}, промахов {stats['misses']}")
+
+    over = [chosen for chosen in (selector.select(assistant, q) for q in questions)
+            if sum(e.tokens for e in chosen) > args.max_tokens or len(chosen) > 3]
+    filled = sum(len(selector.select(assistant, q)) for q in questions) / len(questions)
+    check("budget", not over, f"в среднем {filled:.1f} примера на вопрос, превышений max_tokens {args.max_tokens}: {len(over)}")
+
+    cold = FewShotSelector()
+    cold.install(examples)
+    stable = sum(cold.select(assistant, q) == selector.select(assistant, q) for q in questions)
+    check("stable", stable == len(questions), f"выбор после пересборки совпал для {stable} из {len(questions)}")
+
+    foreign = sum(1 for q in questions for e in selector.select(assistant, q) if e.assistant_id not in (1, None))
+    unset = sum(1 for q in questions for e in selector.select(other, q) if e.assistant_id not in (2, None))
+    check("isolation", foreign == 0 and unset == 0, f"чужих примеров в выдаче: {foreign + unset}")
+
+    return check.exit_code()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100,1000,10000,50000")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--max-tokens", type=int, default=600)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Проверка очереди фоновой генерации (app/jobs.py).
+
+Обработчик заданий — пауза вместо вызова модели, БД не нужна.
+
+Сценарии:
+  * throughput — N заданий на W воркерах: все завершены, время ожидания в очереди;
+  * errors     — ошибка модели (LLMError) завершает задание статусом failed
+    с кодом и текстом ошибки;
+  * drain      — stop() дописывает идущие генерации, остальные задания
+    остаются в очереди и достаются следующему процессу;
+  * recovery   — (Redis) воркер забрал задание и «упал»: после истечения
+    аренды задание возвращается в очередь и его выполняет другой процесс;
+    брошенное JOB_MAX_ATTEMPTS раз — завершается ошибкой.
+
+Код возврата 1 при нарушении. Ключи Redis — с префиксом bench:, рабочую
+очередь проверка не трогает.
+
+    python -m backend.bench.jobs
+    REDIS_URL=redis://localhost:6379/0 python -m backend.bench.jobs --backend redis
+"""
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+
+from backend.bench._common import Checks, percentile
+
+
+def _job(**fields):
+    from backend.app.jobs import Job
+
+    defaults = dict(session_id=uuid.uuid4().hex, assistant_id=1, assistant_code="bench", model="fake",
+                    candidates=["fake"], reason="default", messages=[{"role": "user", "content": "?"}])
+    return Job.new(**{**defaults, **fields})
+
+
+async def run(args) -> int:
+    from backend.app.jobs import DONE, FAILED, QUEUED, JobQueue, MemoryJobs, RedisJobs
+    from backend.app.llm_client import LLMUnavailable
+    from backend.app.redis_client import ping_redis
+
+    client = None
+    if args.backend == "redis":
+        client = await ping_redis()
+        if client is None:
+            print("Redis недоступен (REDIS_URL)")
+            return 1
+    prefix = f"bench:{uuid.uuid4().hex[:8]}:"
+
+    def backend(lease: float = 60.0):
+        return RedisJobs(client, lease, prefix=prefix) if client is not None else MemoryJobs()
+
+    check = Checks()
+
+    async def handler(job):
+        await asyncio.sleep(args.delay)
+        if job.messages[0]["content"] == "fail":
+            raise LLMUnavailable("Модель временно недоступна", retry_after=5)
+        return {"reply": "ok", "message_id": 1, "created_at": "", "model": job.model}
+
+    # пропускная способность
+    queue = JobQueue(workers=args.workers)
+    await queue.start(handler, backend=backend())
+    started = time.perf_counter()
+    jobs = [await queue.submit(_job()) for _ in range(args.jobs)]
+    done = [await queue.wait(job.id, 30) for job in jobs]
+    elapsed = time.perf_counter() - started
+    waits = [j.finished_at - j.created_at for j in done if j is not None and j.finished_at]
+    ideal = args.jobs * args.delay / args.workers
+    check("throughput", all(j is not None and j.status == DONE for j in done),
+          f"{args.jobs} заданий по {args.delay * 1000:.0f} мс на {args.workers} воркерах за {elapsed:.2f} с "
+          f"(идеал {ideal:.2f} с); до результата p50 {percentile(waits, 50) * 1000:.0f} мс, p99 {percentile(waits, 99) * 1000:.0f} мс")
+
+    # ошибка модели
+    job = await queue.submit(_job(messages=[{"role": "user", "content": "fail"}]))
+    failed = await queue.wait(job.id, 10)
+    active = await queue.active(job.session_id)
+    check("errors", failed is not None and failed.status == FAILED and failed.error["status"] == 503
+          and failed.error["retry_after"] == 5 and active is None,
+          f"статус {failed.status if failed else None}, ошибка {failed.error if failed else None}, "
+          f"сессия свободна: {active is None}")
+
+    # остановка с недоделанными заданиями
+    slow = [await queue.submit(_job()) for _ in range(args.workers + 5)]
+    await asyncio.sleep(args.delay / 2)
+    await queue.stop()
+    states = [(await queue.get(j.id)).status for j in slow]
+    remaining = states.count(QUEUED)
+    check("drain", states.count(DONE) == args.workers and remaining == 5,
+          f"при остановке шло {args.workers} генераций: завершено {states.count(DONE)}, "
+          f"в очереди осталось {remaining}")
+    # оставшиеся забирает следующий процесс (для памяти — тот же объект очереди)
+    successor = JobQueue(workers=args.workers)
+    await successor.start(handler, backend=queue.backend if client is None else backend())
+    finished = [await successor.wait(j.id, 10) for j in slow]
+    check("drain_resume", all(j.status == DONE for j in finished),
+          f"после перезапуска завершено {sum(j.status == DONE for j in finished)} из {len(slow)}")
+    await successor.stop()
+
+    if client is not None:
+        # воркер забрал задание и упал, не продлевая аренду
+        lease = 1.0
+        crashed = backend(lease)
+        job = _job()
+        await crashed.put(job)
+        claimed = await crashed.claim(1.0)
+        started = time.perf_counter()
+        rescuer = JobQueue(workers=2, lease_seconds=lease)
+        await rescuer.start(handler, backend=backend(lease))
+        recovered = await rescuer.wait(job.id, lease * 5)
+        took = time.perf_counter() - started
+        check("recovery", claimed is not None and recovered is not None and recovered.status == DONE
+              and recovered.attempts == 2 and rescuer.recovered == 1,
+              f"аренда {lease:.0f} с: задание возвращено и выполнено через {took:.2f} с, попыток {recovered.attempts if recovered else None}")
+        await rescuer.stop()
+
+        # задание, брошенное max_attempts раз
+        job = _job()
+        await crashed.put(job)
+        for _ in range(3):
+            await crashed.claim(1.0)
+            await crashed.client.delete(crashed._lease_key(job.id))
+            await crashed.recover()
+            await crashed.recover()
+        rescuer = JobQueue(workers=1, max_attempts=3, lease_seconds=lease)
+        await rescuer.start(handler, backend=backend(lease))
+        exhausted = await rescuer.wait(job.id, lease * 5)
+        check("attempts", exhausted is not None and exhausted.status == FAILED,
+              f"после 3 брошенных попыток статус {exhausted.status if exhausted else None}")
+        await rescuer.stop()
+
+        keys = [key async for key in client.scan_iter(f"{prefix}*")]
+        if keys:
+            await client.delete(*keys)
+
+    return check.exit_code()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["memory", "redis"], default="memory")
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=20)
+    parser.add_argument("--delay", type=float, default=0.05)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Проверка поиска по базе знаний (app/retrieval.py) на синтетическом корпусе.
+
+Статьи генерируются из «русских» основ с падежными окончаниями
+и окончаниями прилагательных (распределение слов — Ципфа), с age_group
+и tags. Словарь растёт с корпусом (закон Хипса): основ вдвое меньше,
+чем статей, но не меньше 6000. БД не нужна.
+
+Сценарии:
+  * build    — сборка индекса по N статьям: время, фрагменты, термины, память;
+  * search   — задержка поиска top-k p50/p99 без фильтров и с age_group/tags;
+  * recall   — совпадение top-k с полным перебором списков (первые 200 вопросов);
+  * stemming — вопрос из словоформ статьи, отличных от её текста, находит статью;
+  * filters  — все найденные фрагменты проходят фильтры;
+  * incremental — добавление, правка и удаление статьи видны сразу, время операции;
+  * budget   — сообщение с фрагментами укладывается в max_tokens.
+
+Код возврата 1 при нарушении.
+
+    python -m backend.bench.kb_search
+    python -m backend.bench.kb_search --articles 100000 --queries 2000
+"""
+import argparse
+import random
+import resource
+import sys
+import time
+
+from backend.bench._common import Checks, percentile
+
+SYLLABLES = ["ка", "ро", "ми", "ла", "ну", "те", "со", "пи", "ва", "ды", "гре", "бро", "сто", "кли", "мо", "ру",
+             "же", "ха", "лю", "зо", "пра", "ско", "тви", "дра"]
+NOUN_ENDINGS = ["", "а", "у", "ом", "е", "ы", "ов", "ам", "ами", "ах"]
+ADJ_ENDINGS = ["ый", "ая", "ое", "ого", "ому", "ым", "ые", "ых"]
+AGE_GROUPS = ["0-1", "1-3", "3-7", None]
+TAGS = [f"тема{i}" for i in range(30)]
+
+
+class Corpus:
+    def __init__(self, seed: int, stems: int):
+        self.rnd = random.Random(seed)
+        consonants = "бвгдзклмнпрстфхцчшщ"
+        self.stems = sorted({"".join(self.rnd.choice(SYLLABLES) for _ in range(self.rnd.randint(2, 3)))
+                             + self.rnd.choice(consonants) for _ in range(stems)})
+        self.kinds = [self.rnd.random() < 0.7 for _ in self.stems]   # существительное / прилагательное
+        self.weights = [1 / (i + 1) ** 0.9 for i in range(len(self.stems))]
+
+    def form(self, stem_no: int) -> str:
+        endings = NOUN_ENDINGS if self.kinds[stem_no] else ADJ_ENDINGS
+        return self.stems[stem_no] + self.rnd.choice(endings)
+
+    def words(self, count: int):
+        return self.rnd.choices(range(len(self.stems)), self.weights, k=count)
+
+    def article(self, article_id: int):
+        topic = self.rnd.sample(range(200, len(self.stems)), 4)   # редкие слова темы статьи
+        title = " ".join(self.form(s) for s in topic[:3])
+        paragraphs = []
+        for _ in range(self.rnd.randint(2, 4)):
+            ids = self.words(self.rnd.randint(30, 70)) + self.rnd.choices(topic, k=6)
+            self.rnd.shuffle(ids)
+            paragraphs.append(" ".join(self.form(s) for s in ids).capitalize() + ".")
+        tags = self.rnd.sample(TAGS, self.rnd.randint(1, 3))
+        return (article_id, title, "\n\n".join(paragraphs), self.rnd.choice(AGE_GROUPS), tags), topic
+
+
+def run(args) -> int:
+    from backend.app.retrieval import KbSettings, SearchIndex, grounding_message
+    from backend.app.context import count_tokens
+    from backend.app.stemmer import analyze
+
+    check = Checks()
+
+    corpus = Corpus(args.seed, max(6000, args.articles // 2))
+    generated = [corpus.article(i + 1) for i in range(args.articles)]
+    rows = [row for row, _ in generated]
+    topics = {row[0]: topic for row, topic in generated}
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    index = SearchIndex.build(rows)
+    took = time.perf_counter() - started
+    rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+    stats = index.stats()
+    check("build", stats["articles"] == args.articles,
+          f"{args.articles} статей -> {stats['passages']} фрагментов, {stats['terms']} терминов, "
+          f"{stats['postings']} записей за {took:.1f} с (+{rss:.0f} МБ RSS)")
+
+    # вопросы: слова темы статьи в других словоформах + пара частых слов
+    queries = []
+    for _ in range(args.queries):
+        article_id = corpus.rnd.randint(1, args.articles)
+        words = [corpus.form(s) for s in topics[article_id][:3]] + [corpus.form(s) for s in corpus.words(2)]
+        queries.append((article_id, " ".join(words)))
+    analyzed = [(article_id, analyze(text)) for article_id, text in queries]
+
+    def timed(age_group=None, tags=frozenset(), depth=1000):
+        latencies, found = [], []
+        for article_id, terms in analyzed:
+            t0 = time.perf_counter()
+            hits = index.search(terms, args.top_k, age_group, tags, depth)
+            latencies.append(time.perf_counter() - t0)
+            found.append((article_id, hits))
+        return latencies, found
+
+    plain, found = timed()
+    filtered, found_filtered = timed("0-1", frozenset({"тема1", "тема2"}))
+    check("search", percentile(plain, 50) < 0.001 and percentile(filtered, 50) < 0.001,
+          f"top-{args.top_k}: p50 {percentile(plain, 50) * 1e6:.0f} мкс, p99 {percentile(plain, 99) * 1e6:.0f} мкс; "
+          f"с age_group и tags p50 {percentile(filtered, 50) * 1e6:.0f} мкс, p99 {percentile(filtered, 99) * 1e6:.0f} мкс")
+
+    overlap = []
+    for (article_id, terms), (_, hits) in zip(analyzed[:200], found):
+        exact = index.search(terms, args.top_k, depth=None)
+        exact_ids = {(h.passage.article_id, h.passage.text) for h in exact}
+        got = {(h.passage.article_id, h.passage.text) for h in hits}
+        overlap.append(len(exact_ids & got) / max(len(exact_ids), 1))
+    recall = sum(overlap) / len(overlap)
+    check("recall", recall >= 0.95, f"совпадение с полным перебором {recall:.3f}")
+
+    hit_rate = sum(any(h.passage.article_id == a for h in hits) for a, hits in found) / len(found)
+    check("stemming", hit_rate >= 0.9, f"статья вопроса в top-{args.top_k}: {hit_rate:.1%}")
+
+    violations = sum(1 for _, hits in found_filtered for h in hits
+                     if h.passage.age_group not in (None, "0-1") or not (h.passage.tags & {"тема1", "тема2"}))
+    returned = sum(len(hits) for _, hits in found_filtered)
+    check("filters", violations == 0 and returned > 0,
+          f"{returned} фрагментов с фильтрами, нарушений {violations}")
+
+    # добавление, правка, удаление
+    new_id = args.articles + 1
+    row, topic = corpus.article(new_id)
+    t0 = time.perf_counter()
+    index.upsert(row)
+    add_ms = (time.perf_counter() - t0) * 1000
+    terms = analyze(" ".join(corpus.form(s) for s in topic[:3]))
+    added = any(h.passage.article_id == new_id for h in index.search(terms, args.top_k))
+    edited_row = (new_id, row[1], row[2] + "\n\nНовый абзац про прорезывание зубов.", row[3], row[4])
+    t0 = time.perf_counter()
+    index.upsert(edited_row)
+    edit_ms = (time.perf_counter() - t0) * 1000
+    edited = any(h.passage.article_id == new_id for h in index.search(analyze("прорезывание зубов"), args.top_k))
+    t0 = time.perf_counter()
+    index.remove(new_id)
+    remove_ms = (time.perf_counter() - t0) * 1000
+    removed = not any(h.passage.article_id == new_id for h in index.search(terms, args.top_k))
+    check("incremental", added and edited and removed and index.stats()["articles"] == args.articles,
+          f"добавление {add_ms:.1f} мс, правка {edit_ms:.1f} мс, удаление {remove_ms:.1f} мс; "
+          f"найдена после добавления: {added}, правки: {edited}, не найдена после удаления: {removed}")
+
+    settings = KbSettings(top_k=5, max_tokens=args.max_tokens)
+    hits = index.search(analyzed[0][1], settings.top_k)
+    message = grounding_message(hits, settings.max_tokens, "gpt-4o-mini")
+    tokens = count_tokens(message["content"], "gpt-4o-mini") if message else 0
+    included = message["content"].count("\n\n[") if message else 0
+    check("budget", message is not None and tokens <= settings.max_tokens,
+          f"{included} из {len(hits)} фрагментов, {tokens} токенов при лимите {settings.max_tokens}")
+
+    return check.exit_code()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--articles", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--max-tokens", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
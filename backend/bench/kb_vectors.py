@@ -0,0 +1,211 @@
+"""Проверка индекса эмбеддингов базы знаний (app/vectors.py).
+
+БД не нужна: строки индекса генерируются, файлы пишутся во временный каталог.
+Для масштаба — синтетический эмбеддер: вектор строки — центр её темы плюс
+шум, вопрос — другой шум вокруг того же центра. Для перефразировок —
+настоящий HashEmbedder на «русском» корпусе из bench/kb_search.py.
+
+Сценарии:
+  * build    — запись матрицы N x dim и разбиение IVF: время, размер файла;
+  * mmap     — два читателя (как два воркера uvicorn) открывают один файл через mmap;
+  * search   — задержка одного вопроса p50/p99 полным перебором и через IVF,
+    пачка вопросов одним умножением — время на вопрос;
+  * recall   — совпадение top-k IVF с полным перебором;
+  * append   — update дописывает 1% изменённых и новых строк без пересборки:
+    время против build, читатель дочитывает только хвост, старые строки не находятся;
+  * batching — одновременные вопросы к VectorIndex.search считаются пачками;
+  * paraphrase — HashEmbedder: вопрос из других словоформ статьи находит её.
+
+Код возврата 1 при нарушении.
+
+    python -m backend.bench.kb_vectors
+    python -m backend.bench.kb_vectors --rows 500000 --dim 768
+"""
+import argparse
+import asyncio
+import math
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from backend.bench._common import Checks, percentile
+
+
+class TopicEmbedder:
+    """Текст "тема:номер" -> центр темы + шум (детерминированно по тексту)."""
+
+    def __init__(self, dim: int, topics: int, noise: float = 0.6, seed: int = 7):
+        self.dim = dim
+        self.name = f"topics-{dim}-{topics}"
+        self.noise = noise
+        rnd = np.random.default_rng(seed)
+        self.centers = rnd.standard_normal((topics, dim)).astype(np.float32)
+        self.centers /= np.linalg.norm(self.centers, axis=1, keepdims=True)
+
+    async def embed(self, texts):
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            topic, number = (int(x) for x in text.split(":"))
+            rnd = np.random.default_rng(number)
+            noise = rnd.standard_normal(self.dim).astype(np.float32) / math.sqrt(self.dim)
+            vector = self.centers[topic] + self.noise * noise
+            out[i] = vector / np.linalg.norm(vector)
+        return out
+
+
+def _rows(count: int, topics: int, start: int = 0, salt: int = 0):
+    from backend.app.vectors import KIND_ARTICLE, VectorRow
+
+    rows = []
+    for i in range(start, start + count):
+        topic = i % topics
+        rows.append(VectorRow(KIND_ARTICLE, i, f"Статья {i}", f"Фрагмент {i}", None, (), None, f"{i}:{salt}",
+                              f"{topic}:{i * 7 + salt + 1_000_000}"))
+    return rows
+
+
+async def run(args) -> int:
+    from backend.app.retrieval import split_passages
+    from backend.app.vectors import (KIND_ARTICLE, HashEmbedder, VectorIndex, VectorRow, VectorStore, _Query,
+                                     search_batch)
+
+    check = Checks()
+
+    workdir = tempfile.mkdtemp(prefix="kb_vectors_")
+    store = VectorStore(workdir)
+    embedder = TopicEmbedder(args.dim, args.topics)
+    rows = _rows(args.rows, args.topics)
+
+    started = time.perf_counter()
+    header = await store.build(rows, embedder, batch=4096)
+    build_took = time.perf_counter() - started
+    size = os.path.getsize(store.file("vectors", header["generation"])) / 2 ** 20
+    ivf = header["ivf"]
+    check("build", header["rows"] == args.rows and size == args.rows * args.dim * 4 / 2 ** 20,
+          f"{args.rows} x {args.dim} float32 = {size:.0f} МБ за {build_took:.1f} с, "
+          f"IVF: {ivf['lists'] if ivf else 'нет'} списков")
+
+    readers = [VectorIndex(workdir), VectorIndex(workdir)]
+    for reader in readers:
+        reader.embedder = embedder
+        await reader.reload()
+    files = {reader.snapshot.matrix.filename for reader in readers}
+    check("mmap", all(isinstance(r.snapshot.matrix, np.memmap) for r in readers) and len(files) == 1,
+          f"оба читателя отображают {os.path.basename(files.pop())}, страницы файла общие")
+
+    snapshot = readers[0].snapshot
+    lists = len(snapshot.centroids) if snapshot.centroids is not None else 0
+    queries = np.stack([(await embedder.embed([f"{i % args.topics}:{i}"]))[0] for i in range(args.queries)])
+    query = _Query(args.top_k)
+
+    def timed(nprobe):
+        latencies, found = [], []
+        for vector in queries:
+            t0 = time.perf_counter()
+            found.append(search_batch(snapshot, vector[None, :], [query], nprobe=nprobe)[0])
+            latencies.append(time.perf_counter() - t0)
+        return latencies, found
+
+    exact_times, exact = timed(nprobe=lists + 1)
+    ivf_times, approx = timed(nprobe=args.nprobe)
+    t0 = time.perf_counter()
+    for start in range(0, len(queries), args.batch):
+        chunk = queries[start:start + args.batch]
+        search_batch(snapshot, chunk, [query] * len(chunk), nprobe=lists + 1)
+    batched = (time.perf_counter() - t0) / len(queries)
+    check("search", percentile(ivf_times if lists else exact_times, 50) < 0.05,
+          f"top-{args.top_k}: перебор p50 {percentile(exact_times, 50) * 1000:.1f} мс, p99 {percentile(exact_times, 99) * 1000:.1f} мс; "
+          f"IVF ({args.nprobe} из {lists}) p50 {percentile(ivf_times, 50) * 1000:.2f} мс, p99 {percentile(ivf_times, 99) * 1000:.2f} мс; "
+          f"перебор пачкой по {args.batch}: {batched * 1000:.2f} мс на вопрос")
+
+    overlap = [len({h.passage.article_id for h in a} & {h.passage.article_id for h in e}) / max(len(e), 1)
+               for a, e in zip(approx, exact)]
+    recall = sum(overlap) / len(overlap)
+    check("recall", not lists or recall >= 0.9, f"IVF против полного перебора: {recall:.3f}")
+
+    # 1% строк изменён, столько же новых
+    changed = max(1, args.rows // 100)
+    updated = rows[changed:] + _rows(changed, args.topics, salt=1) + _rows(changed, args.topics, start=args.rows)
+    reader = readers[0]
+    t0 = time.perf_counter()
+    header = await store.update(updated, embedder, batch=4096)
+    update_took = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    await reader.reload()
+    reload_took = time.perf_counter() - t0
+    snapshot = reader.snapshot
+    probe = (await embedder.embed([f"0:{1_000_000 + 1}"]))[0]
+    hits = search_batch(snapshot, probe[None, :], [_Query(snapshot.rows)], nprobe=lists + 1)[0]
+    ids = [h.passage.article_id for h in hits]
+    stale = len(ids) - len(set(ids))
+    check("append", header["rows"] == args.rows + 2 * changed and header["dropped"] == changed
+          and snapshot.rows == header["rows"] and stale == 0 and update_took < build_took,
+          f"дописано {2 * changed} строк за {update_took:.2f} с (build {build_took:.1f} с), "
+          f"помечено {header['dropped']}, читатель дочитал за {reload_took * 1000:.0f} мс; "
+          f"повторов статей в выдаче: {stale}")
+
+    # одновременные вопросы
+    async def ask(i):
+        return await reader.search(f"{i % args.topics}:{i}", args.top_k)
+
+    t0 = time.perf_counter()
+    answers = await asyncio.gather(*(ask(i) for i in range(args.concurrent)))
+    took = time.perf_counter() - t0
+    stats = reader.stats()
+    check("batching", all(answers) and stats["avg_batch"] > 1,
+          f"{args.concurrent} одновременных вопросов за {took * 1000:.0f} мс, в среднем {stats['avg_batch']} в пачке")
+    for r in readers:
+        await r.stop()
+
+    # перефразировки: HashEmbedder на корпусе из kb_search
+    from backend.bench.kb_search import Corpus
+
+    corpus = Corpus(args.seed, 6000)
+    generated = [corpus.article(i + 1) for i in range(args.articles)]
+    hash_rows = [VectorRow(KIND_ARTICLE, row[0], row[1], text, None, (), None, str(row[0]), f"{row[1]}\n{text}")
+                 for row, _ in generated for text in split_passages(row[2])]
+    hash_store = VectorStore(tempfile.mkdtemp(prefix="kb_vectors_hash_"))
+    hashing = HashEmbedder()
+    t0 = time.perf_counter()
+    await hash_store.build(hash_rows, hashing, ivf_lists=0)
+    embed_took = time.perf_counter() - t0
+    index = VectorIndex(str(hash_store.path))
+    index.embedder = hashing
+    await index.reload()
+    found = 0
+    for _ in range(args.paraphrases):
+        article_id = corpus.rnd.randint(1, args.articles)
+        topic = generated[article_id - 1][1]
+        question = " ".join(corpus.form(s) for s in topic[:3]) + " " + " ".join(corpus.form(s) for s in corpus.words(2))
+        hits = await index.search(question, args.top_k)
+        found += any(h.passage.article_id == article_id for h in hits)
+    await index.stop()
+    check("paraphrase", found / args.paraphrases >= 0.8,
+          f"{len(hash_rows)} фрагментов ({hashing.name}, {embed_took:.1f} с); статья вопроса в top-{args.top_k}: "
+          f"{found / args.paraphrases:.1%}")
+
+    return check.exit_code()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--topics", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--concurrent", type=int, default=200)
+    parser.add_argument("--articles", type=int, default=2000)
+    parser.add_argument("--paraphrases", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
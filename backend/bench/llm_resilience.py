@@ -0,0 +1,170 @@
+"""Проверка клиента OpenAI (app/llm_client.py) на заглушке fake_openai.
+
+Сценарии:
+  * keepalive  — последовательные вызовы идут по одному соединению;
+  * retry      — при 20% ответов 500 все вызовы проходят за счёт повторов;
+  * retry_after — на 429 с Retry-After: 1 повторы ждут не меньше секунды,
+    а итоговая ошибка — 503 с Retry-After;
+  * semaphore  — одновременных вызовов модели не больше max_in_flight,
+    без свободного слота дольше queue_timeout — LLMOverloaded;
+  * stream     — поток отдаёт весь ответ и освобождает слот;
+  * breaker    — после N ошибок подряд вызовы отклоняются без обращения к
+    upstream, после паузы пробный вызов закрывает breaker;
+  * hedge      — при 3% медленных ответов хеджирование срезает p99.
+
+Код возврата 1 при нарушении.
+
+    python -m backend.bench.llm_resilience
+"""
+import asyncio
+import os
+import sys
+import time
+
+from backend.bench._common import Checks, free_port, percentile, reset_fake
+
+
+async def run(fake) -> int:
+    from backend.app.llm_client import CircuitBreaker, LLMClient, LLMError, LLMOverloaded, LLMUnavailable
+
+    messages = [{"role": "user", "content": "Малыш не спит"}]
+    check = Checks()
+
+    async def gather_calls(client, n, concurrency=None, **kwargs):
+        """(задержки успешных вызовов, ошибки)."""
+        latencies, errors = [], []
+        semaphore = asyncio.Semaphore(concurrency or n)
+
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    await client.complete(model="fake", messages=messages, **kwargs)
+                    latencies.append(time.perf_counter() - started)
+                except LLMError as e:
+                    errors.append(e)
+
+        await asyncio.gather(*(one() for _ in range(n)))
+        return latencies, errors
+
+    # keep-alive: пул переиспользует соединение
+    reset_fake(fake)
+    client = LLMClient()
+    for _ in range(50):
+        await client.complete(model="fake", messages=messages)
+    check("keepalive", len(fake.state.connections) == 1,
+          f"50 последовательных вызовов, соединений {len(fake.state.connections)}")
+    await client.stop()
+
+    # повторы при 5xx
+    reset_fake(fake, error_rate=0.2)
+    client = LLMClient()
+    client.max_retries = 4
+    latencies, errors = await gather_calls(client, 100, concurrency=10)
+    check("retry", not errors and client.retries > 0,
+          f"100 вызовов при 20% ошибок 500: успешно {len(latencies)}, повторов {client.retries}, "
+          f"ошибок upstream {fake.state.errors}")
+    await client.stop()
+
+    # Retry-After
+    reset_fake(fake, error_rate=1.0, error_status=429)
+    client = LLMClient()
+    client.max_retries = 2
+    started = time.perf_counter()
+    _, errors = await gather_calls(client, 1)
+    elapsed = time.perf_counter() - started
+    error = errors[0] if errors else None
+    check("retry_after", error is not None and error.status_code == 503 and elapsed >= 2.0
+          and fake.state.calls == 3 and error.headers().get("Retry-After") == "1",
+          f"3 попытки за {elapsed:.2f} с (Retry-After: 1 дважды), итог "
+          f"{type(error).__name__ if error else 'успех'} {error.headers() if error else ''}")
+    await client.stop()
+
+    # семафор
+    reset_fake(fake, delay=0.1)
+    client = LLMClient()
+    client.max_in_flight = 5
+    latencies, errors = await gather_calls(client, 30)
+    check("semaphore", not errors and fake.state.max_in_flight <= 5,
+          f"30 одновременных при max_in_flight=5: успешно {len(latencies)}, "
+          f"максимум у upstream {fake.state.max_in_flight}, общее время {max(latencies):.2f} с")
+    client.queue_timeout = 0.05
+    latencies, errors = await gather_calls(client, 30)
+    overloaded = sum(isinstance(e, LLMOverloaded) for e in errors)
+    check("semaphore_timeout", overloaded > 0 and overloaded + len(latencies) == 30,
+          f"queue_timeout=0.05 с: успешно {len(latencies)}, LLMOverloaded {overloaded}")
+    await client.stop()
+
+    # поток
+    reset_fake(fake, reply_tokens=30)
+    client = LLMClient()
+    client.max_in_flight = 2
+    texts = []
+
+    async def read_stream():
+        parts = []
+        async with client.stream(model="fake", messages=messages) as chunks:
+            async for chunk in chunks:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+        texts.append("".join(parts))
+
+    await asyncio.gather(*(read_stream() for _ in range(6)))
+    check("stream", len(texts) == 6 and all(len(t.split()) > 30 for t in texts)
+          and not any(client._in_flight.values()) and fake.state.max_in_flight <= 2,
+          f"6 потоков при max_in_flight=2: слов в ответе {len(texts[0].split()) if texts else 0}, "
+          f"максимум у upstream {fake.state.max_in_flight}, занято слотов после {sum(client._in_flight.values())}")
+    await client.stop()
+
+    # circuit breaker
+    reset_fake(fake, error_rate=1.0)
+    client = LLMClient()
+    client.max_retries = 0
+    client.breakers["fake"] = CircuitBreaker(failures=3, reset_seconds=0.5, model="fake")
+    _, errors = await gather_calls(client, 3, concurrency=1)
+    calls = fake.state.calls
+    started = time.perf_counter()
+    _, rejected = await gather_calls(client, 10, concurrency=1)
+    fast = time.perf_counter() - started
+    opened = client.breaker("fake").state == "open" and fake.state.calls == calls \
+        and all(isinstance(e, LLMUnavailable) for e in rejected) and len(rejected) == 10
+    reset_fake(fake)
+    await asyncio.sleep(0.6)
+    latencies, _ = await gather_calls(client, 1)
+    check("breaker", opened and latencies and client.breaker("fake").state == "closed",
+          f"3 ошибки 500 → open, 10 вызовов отклонены за {fast * 1000:.1f} мс без запросов к upstream; "
+          f"после паузы пробный вызов {'прошёл' if latencies else 'не прошёл'}, состояние {client.breaker('fake').state}")
+    await client.stop()
+
+    # хеджирование
+    summary = {}
+    for hedge_percentile in (0, 90):
+        reset_fake(fake, delay=0.03, slow_rate=0.03, slow_delay=1.0)
+        client = LLMClient()
+        client.hedge_percentile = hedge_percentile
+        latencies, errors = await gather_calls(client, 600, concurrency=10)
+        summary[hedge_percentile] = (percentile(latencies, 50), percentile(latencies, 99), fake.state.calls, client.hedges, client.hedge_wins)
+        await client.stop()
+    (p50, p99, calls, _, _), (hp50, hp99, hcalls, hedges, wins) = summary[0], summary[90]
+    check("hedge", hp99 < p99 / 2,
+          f"3% ответов +1 с: без хеджа p50 {p50 * 1000:.0f} мс p99 {p99 * 1000:.0f} мс ({calls} вызовов); "
+          f"p90-хедж p50 {hp50 * 1000:.0f} мс p99 {hp99 * 1000:.0f} мс ({hcalls} вызовов, "
+          f"хеджей {hedges}, выиграли {wins})")
+
+    return check.exit_code()
+
+
+def main() -> None:
+    # короткие паузы повторов, чтобы проверка шла секунды
+    os.environ.setdefault("OPENAI_RETRY_BASE_DELAY", "0.02")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    from backend.bench.fake_openai import FakeOpenAIServer
+
+    with FakeOpenAIServer(port=free_port(), delay=0.02) as fake:
+        os.environ["OPENAI_BASE_URL"] = fake.base_url
+        sys.exit(asyncio.run(run(fake.app)))
+
+
+if __name__ == "__main__":
+    main()
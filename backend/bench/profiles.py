@@ -0,0 +1,94 @@
+"""Проверка кэша анкет пользователей (app/profiles.py).
+
+БД не нужна: анкеты кладутся в кэш напрямую, а вместо сессии БД передаётся
+None — любая попытка запроса на попадании упадёт.
+
+Сценарии:
+  * render — возраст детей по дате рождения, длина фрагмента в пределах PROFILE_MAX_CHARS;
+  * hit    — фрагмент для /chat/send из кэша без БД, время p50/p99;
+  * update — после сохранения новой анкеты следующий запрос видит новый фрагмент;
+  * day    — со сменой дня возраст пересчитывается из той же записи, без БД;
+  * lru    — кэш не растёт больше maxsize.
+
+Код возврата 1 при нарушении.
+
+    python -m backend.bench.profiles
+"""
+import argparse
+import asyncio
+import sys
+import time
+from datetime import date, timedelta
+
+from backend.bench._common import Checks, percentile
+
+
+def _profile(i: int) -> dict:
+    return {
+        "name": f"Мама {i}",
+        "children": [{"name": f"Ребёнок {i}-{j}", "sex": "mf"[j % 2],
+                      "birth_date": (date(2020, 1, 1) + timedelta(days=(i * 37 + j * 400) % 2400)).isoformat()}
+                     for j in range(1 + i % 3)],
+        "feeding": "грудное",
+        "notes": "просыпается ночью " * (i % 5),
+    }
+
+
+async def run(args) -> int:
+    from backend.app.profiles import PROFILE_MAX_CHARS, ProfileCache, child_age, render_profile
+
+    check = Checks()
+
+    today = date(2026, 10, 18)
+    ages = [child_age(date(2026, 10, 6), today), child_age(date(2026, 3, 1), today),
+            child_age(date(2023, 8, 18), today), child_age(date(2014, 1, 1), today),
+            child_age(date(2027, 1, 5), today)]
+    expected = ["12 дней", "7 мес.", "3 года 2 мес.", "12 лет", "ожидается 05.01.2027"]
+    texts = [render_profile(_profile(i), today) for i in range(args.users)]
+    longest = max(len(t) for t in texts)
+    check("render", ages == expected and longest <= PROFILE_MAX_CHARS and render_profile({"x": 1}, today) is None,
+          f"возраст: {', '.join(ages)}; самый длинный фрагмент {longest} символов (предел {PROFILE_MAX_CHARS})")
+
+    cache = ProfileCache(maxsize=args.users)
+    cache.enabled = True
+    for user_id in range(args.users):
+        cache.put(user_id, _profile(user_id))
+    latencies = []
+    for i in range(args.lookups):
+        t0 = time.perf_counter()
+        message = await cache.message(None, i % args.users)
+        latencies.append(time.perf_counter() - t0)
+        assert message is not None
+    check("hit", cache.loads == 0 and cache.hits == args.lookups,
+          f"{args.lookups} запросов без БД: p50 {percentile(latencies, 50) * 1e6:.1f} мкс, p99 {percentile(latencies, 99) * 1e6:.1f} мкс")
+
+    cache.put(7, dict(_profile(7), feeding="смешанное"))
+    updated = await cache.message(None, 7)
+    check("update", "смешанное" in updated["content"], "новый фрагмент виден сразу после сохранения")
+
+    entry = cache.get(3)
+    entry.day = entry.day - timedelta(days=1)
+    renders = cache.renders
+    again = await cache.message(None, 3)
+    check("day", cache.renders == renders + 1 and cache.get(3).day == date.today() and cache.loads == 0,
+          f"смена дня: фрагмент перерисован из кэша ({len(again['content'])} символов), запросов к БД: {cache.loads}")
+
+    for user_id in range(args.users, args.users * 2):
+        cache.put(user_id, {})
+    stats = cache.stats()
+    check("lru", stats["size"] == args.users and stats["evictions"] == args.users,
+          f"размер {stats['size']} из {stats['maxsize']}, вытеснено {stats['evictions']}")
+
+    return check.exit_code()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
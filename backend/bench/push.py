@@ -0,0 +1,217 @@
+"""Проверка WebSocket-рассылки событий чата (app/push.py).
+
+Соединения — заглушки с методом send_text, сервер и БД не нужны.
+
+Сценарии:
+  * fanout  — S сессий по C устройств, по E событий в каждую: все клиенты
+    получили все события своей сессии в порядке публикации, чужих — нет;
+    время publish() и задержка доставки p50/p99;
+  * slow    — клиент, который не читает, отключается с кодом 1013,
+    остальные клиенты сессии получают всё, publish() не ждёт;
+  * merge   — токены одного хода склеиваются перед публикацией в канал,
+    события других сессий между ними не мешают;
+  * window  — поток токенов уходит в канал между процессами одной публикацией
+    на окно WS_TOKEN_WINDOW_MS; в канал без токенов (Postgres) — только сообщения;
+  * cross   — (Redis) два «процесса» с общим Redis: событие доходит до клиентов
+    другого процесса, своё эхо из канала не дублируется, после отключения
+    последнего клиента процесс отписывается от канала сессии.
+
+Код возврата 1 при нарушении.
+
+    python -m backend.bench.push
+    REDIS_URL=redis://localhost:6379/0 python -m backend.bench.push --backend redis
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+from types import SimpleNamespace
+
+from backend.bench._common import Checks, percentile
+
+
+class FakeSocket:
+    def __init__(self, delay: float = 0.0, stuck: bool = False):
+        self.delay = delay
+        self.stuck = stuck
+        self.events = []
+        self.received_at = []
+        self.closed_code = None
+
+    async def send_text(self, text: str) -> None:
+        if self.stuck:
+            await asyncio.Event().wait()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.events.append(json.loads(text))
+        self.received_at.append(time.perf_counter())
+
+    async def close(self, code: int = 1000) -> None:
+        self.closed_code = code
+
+
+class RecordingBus:
+    """Канал между процессами, который только запоминает опубликованное."""
+
+    name = "recording"
+
+    def __init__(self, tokens: bool):
+        self.tokens = tokens
+        self.events = []
+
+    async def publish(self, session_id: str, payload: str) -> None:
+        self.events.append(json.loads(payload.split("|", 2)[2]))
+
+    async def stop(self) -> None:
+        pass
+
+
+async def _settle(predicate, timeout: float = 5.0) -> bool:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+async def run(args) -> int:
+    from backend.app import push
+    from backend.app.push import (CLOSE_TOO_SLOW, ChatPush, RedisBus, _merge_tokens, message_event,
+                                  token_event)
+    from backend.app.redis_client import ping_redis
+
+    check = Checks()
+
+    # рассылка внутри процесса
+    hub = ChatPush()
+    sessions = [uuid.uuid4().hex for _ in range(args.sessions)]
+    sockets = {sid: [FakeSocket() for _ in range(args.clients)] for sid in sessions}
+    for sid, group in sockets.items():
+        for ws in group:
+            await hub.connect(sid, ws)
+    published_at = {}
+    publish_times = []
+    for i in range(args.events):
+        for sid in sessions:
+            started = time.perf_counter()
+            hub.publish(sid, {"type": "token", "delta": str(i), "key": sid})
+            publish_times.append(time.perf_counter() - started)
+            published_at[(sid, i)] = started
+        await asyncio.sleep(0)
+    total = args.sessions * args.clients * args.events
+    await _settle(lambda: sum(len(ws.events) for g in sockets.values() for ws in g) >= total)
+    lags = [ws.received_at[i] - published_at[(sid, i)]
+            for sid, group in sockets.items() for ws in group for i in range(len(ws.events))]
+    ordered = all([e["delta"] for e in ws.events] == [str(i) for i in range(args.events)]
+                  and all(e["key"] == sid for e in ws.events)
+                  for sid, group in sockets.items() for ws in group)
+    check("fanout", ordered and len(lags) == total,
+          f"{args.sessions} сессий x {args.clients} устройств x {args.events} событий: доставлено {len(lags)} из {total}; "
+          f"publish p99 {percentile(publish_times, 99) * 1e6:.0f} мкс, доставка p50 {percentile(lags, 50) * 1000:.1f} мс, "
+          f"p99 {percentile(lags, 99) * 1000:.1f} мс")
+    await hub.stop()
+
+    # медленный клиент
+    hub = ChatPush()
+    sid = uuid.uuid4().hex
+    stuck, fast = FakeSocket(stuck=True), FakeSocket()
+    await hub.connect(sid, stuck)
+    await hub.connect(sid, fast)
+    events = push.WS_SEND_QUEUE * 3
+    started = time.perf_counter()
+    for i in range(events):
+        hub.publish(sid, token_event(str(i), "k"))
+        if i % 10 == 9:
+            # темп потоковой генерации: пачка токенов за итерацию цикла событий
+            await asyncio.sleep(0.001)
+    took = time.perf_counter() - started
+    await _settle(lambda: len(fast.events) == events and stuck.closed_code is not None)
+    stats = hub.stats()
+    check("slow", stuck.closed_code == CLOSE_TOO_SLOW and len(fast.events) == events
+          and stats["connections"] == 1 and hub.dropped_clients == 1,
+          f"клиент не читает: закрыт с кодом {stuck.closed_code}; второй получил {len(fast.events)} из {events}; "
+          f"{events} publish() за {took * 1000:.1f} мс")
+    await hub.stop()
+
+    # склейка токенов
+    batch = [("a", token_event("При", "k1")), ("a", token_event("вет", "k1")), ("b", token_event("!", "k2")),
+             ("a", token_event(" мир", "k1")), ("a", {"type": "message", "message": {}, "key": "k1"})]
+    merged = _merge_tokens(batch)
+    check("merge", [e.get("delta") for _, e in merged] == ["Привет мир", "!", None],
+          f"{len(batch)} событий -> {len(merged)} публикаций")
+
+    # окно токенов и канал без токенов
+    published = {}
+    for tokens in (True, False):
+        hub = ChatPush()
+        hub.bus = RecordingBus(tokens)
+        hub._outbox = asyncio.Queue(push._PUBLISH_QUEUE)
+        hub._publisher = asyncio.create_task(hub._publish_loop())
+        sid = uuid.uuid4().hex
+        reply = SimpleNamespace(id=1, role="assistant", content="", created_at=None)
+        started = time.perf_counter()
+        while time.perf_counter() - started < 0.5:
+            hub.publish(sid, token_event("т", "k"))
+            await asyncio.sleep(0.005)
+        hub.publish(sid, message_event(reply, "k"))
+        await _settle(lambda: any(e["type"] == "message" for e in hub.bus.events))
+        published[tokens] = [e["type"] for e in hub.bus.events]
+        await hub.stop()
+    windows = 0.5 / (push.WS_TOKEN_WINDOW_MS / 1000)
+    check("window", published[True].count("token") <= windows + 1 and published[True][-1] == "message"
+          and published[False] == ["message"],
+          f"токены 0.5 с по одному раз в 5 мс: в канал ушло {published[True].count('token')} публикаций токенов "
+          f"(окно {push.WS_TOKEN_WINDOW_MS:.0f} мс); в канал без токенов: {published[False]}")
+
+    if args.backend == "redis":
+        client = await ping_redis()
+        if client is None:
+            print("Redis недоступен (REDIS_URL)")
+            return 1
+        first, second = ChatPush(), ChatPush()
+        for hub in (first, second):
+            hub.bus = RedisBus(client, hub._on_remote)
+            await hub.bus.start(hub.origin)
+            hub._outbox = asyncio.Queue(push._PUBLISH_QUEUE)
+            hub._publisher = asyncio.create_task(hub._publish_loop())
+        sid = uuid.uuid4().hex
+        phone, laptop = FakeSocket(), FakeSocket()
+        await first.connect(sid, phone)
+        await second.connect(sid, laptop)
+        await asyncio.sleep(0.2)  # подписка на канал
+        started = time.perf_counter()
+        for i in range(args.events):
+            first.publish(sid, {"type": "message", "message": {"id": i}, "key": None})
+        await _settle(lambda: len(laptop.events) >= args.events)
+        took = time.perf_counter() - started
+        await asyncio.sleep(0.2)
+        ids = [e["message"]["id"] for e in laptop.events]
+        check("cross", ids == list(range(args.events)) and len(phone.events) == args.events,
+              f"{args.events} событий из процесса A: в процессе B {len(ids)} (по порядку: {ids == sorted(ids)}) "
+              f"за {took * 1000:.0f} мс, у клиента A {len(phone.events)} (без эха)")
+        await second.disconnect(second._subscribers[sid].copy().pop())
+        await asyncio.sleep(0.2)
+        channels = await client.pubsub_channels(push._channel(sid))
+        check("unsubscribe", len(channels) == 1,
+              f"после отключения клиента B канал сессии слушает процессов: {len(channels)}")
+        await first.stop()
+        await second.stop()
+
+    return check.exit_code()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["memory", "redis"], default="memory")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=3)
+    parser.add_argument("--events", type=int, default=50)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
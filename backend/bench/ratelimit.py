@@ -0,0 +1,89 @@
+"""Бенчмарк накладных расходов RateLimitMiddleware.
+
+Гоняет ASGI-запросы через пустое приложение без middleware и с ним
+(ключи IP + X-Telegram-Id, а также вариант с telegram_id в JSON-теле)
+и печатает добавку на запрос в микросекундах. Лимиты выставлены так,
+чтобы все запросы проходили — измеряется путь пропуска, а не отказа.
+
+    python -m backend.bench.ratelimit --requests 200000
+    REDIS_URL=redis://localhost:6379/0 python -m backend.bench.ratelimit --backend redis
+"""
+import argparse
+import asyncio
+import time
+
+
+async def _noop_app(scope, receive, send):
+    await receive()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _send(message):
+    pass
+
+
+def _scope(i: int, users: int, header: bool) -> dict:
+    headers = [(b"content-type", b"application/json"), (b"content-length", b"64")]
+    if header:
+        headers.append((b"x-telegram-id", str(i % users).encode()))
+    return {
+        "type": "http",
+        "method": "POST",
+        "path": "/chat/send",
+        "headers": headers,
+        "client": (f"10.0.{i % users // 256}.{i % 256}", 40000),
+    }
+
+
+async def _measure(app, requests: int, users: int, header: bool) -> float:
+    scopes = [_scope(i, users, header) for i in range(users)]
+    bodies = [
+        {"type": "http.request", "body": f'{{"telegram_id": "{i}", "message": "x"}}'.encode()}
+        for i in range(users)
+    ]
+    start = time.perf_counter()
+    for i in range(requests):
+        body = bodies[i % users]
+
+        async def receive(body=body):
+            return body
+
+        await app(scopes[i % users], receive, _send)
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+async def run(args) -> None:
+    from backend.app.ratelimit import Rate, RateLimiter, RateLimitMiddleware
+
+    # лимит заведомо выше нагрузки: каждый запрос проходит полный путь проверки
+    rate = Rate(10 ** 9)
+    limiter = RateLimiter(rate, rate)
+    if args.backend == "redis":
+        await limiter.start()
+        if limiter.backend_name != "redis":
+            raise SystemExit("Redis недоступен (проверьте REDIS_URL)")
+
+    wrapped = RateLimitMiddleware(_noop_app, limiter)
+    await _measure(wrapped, min(args.requests, 10000), args.users, True)  # прогрев
+
+    base = await _measure(_noop_app, args.requests, args.users, True)
+    with_header = await _measure(wrapped, args.requests, args.users, True)
+    with_body = await _measure(wrapped, args.requests, args.users, False)
+
+    print(f"backend: {limiter.backend_name}, запросов: {args.requests}, ключей: {args.users}")
+    print(f"без middleware:            {base:8.2f} мкс/запрос")
+    print(f"IP + X-Telegram-Id:        {with_header:8.2f} мкс/запрос (+{with_header - base:.2f})")
+    print(f"IP + telegram_id из тела:  {with_body:8.2f} мкс/запрос (+{with_body - base:.2f})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--backend", choices=["memory", "redis"], default="memory")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Проверка выбора модели (app/routing.py) на заглушке fake_openai.
+
+Сценарии:
+  * rules     — правила extra_config.routing: тариф, длина сообщения, глубина сессии;
+  * failover  — модель отвечает ошибками: ответ (и поток) отдаёт запасная;
+  * slo_errors — после ROUTING_MIN_SAMPLES ошибок модель уходит в конец
+    списка кандидатов, запросы сразу идут в запасную;
+  * slo_latency — то же при p95 выше SLO; когда окно пустеет, модель
+    снова выбирается первой.
+
+Код возврата 1 при нарушении.
+
+    python -m backend.bench.routing
+"""
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+from backend.bench._common import Checks, free_port, reset_fake
+
+MESSAGES = [{"role": "user", "content": "Малыш не спит"}]
+ROUTING = {
+    "rules": [
+        {"model": "big", "tiers": ["premium"]},
+        {"model": "big", "min_chars": 600},
+        {"model": "mid", "min_turns": 30},
+    ],
+    "fallback": ["backup"],
+    "slo": {"p95_ms": 150, "ttft_p95_ms": 150, "error_rate": 0.25},
+}
+
+
+async def run(fake) -> int:
+    from backend.app.llm_client import llm_client
+    from backend.app.routing import ModelRouter
+
+    assistant = SimpleNamespace(id=1, code="bench", base_model="small", extra_config={"routing": ROUTING})
+    check = Checks()
+
+    def fresh_router() -> ModelRouter:
+        llm_client.breakers.clear()
+        router = ModelRouter()
+        router.min_samples = 5
+        return router
+
+    async def served(router, count=1):
+        models = []
+        for _ in range(count):
+            route = router.route(assistant, "Малыш не спит", 0, None)
+            model, _ = await router.complete(route, assistant.code, messages=MESSAGES)
+            models.append(model)
+        return models
+
+    # правила
+    router = fresh_router()
+    cases = [
+        (("коротко", 0, "premium"), "big", "rule"),
+        (("x" * 700, 0, None), "big", "rule"),
+        (("коротко", 31, None), "mid", "rule"),
+        (("коротко", 3, None), "small", "default"),
+    ]
+    picked = [router.route(assistant, *args) for args, _, _ in cases]
+    check("rules", all(r.model == m and r.reason == why for r, (_, m, why) in zip(picked, cases)),
+          ", ".join(f"{r.model}/{r.reason}" for r in picked)
+          + f"; кандидаты по умолчанию {picked[-1].candidates}")
+
+    # переключение на запасную
+    reset_fake(fake)
+    fake.state.failing_models = {"small"}
+    router = fresh_router()
+    chat_model = (await served(router))[0]
+    route = router.route(assistant, "Малыш не спит", 0, None)
+    async with router.stream(route, assistant.code, messages=MESSAGES) as (stream_model, chunks):
+        text = "".join([c.choices[0].delta.content async for c in chunks
+                        if c.choices and c.choices[0].delta.content])
+    check("failover", chat_model == "backup" and stream_model == "backup" and text
+          and router.failovers == 2,
+          f"small отвечает 500: ответ от {chat_model}, поток от {stream_model} ({len(text)} символов), "
+          f"переключений {router.failovers}")
+
+    # SLO по ошибкам
+    reset_fake(fake, delay=0.01)
+    fake.state.failing_models = {"small"}
+    router = fresh_router()
+    llm_client.max_retries = 0
+    await served(router, router.min_samples)
+    # окно пересчитывается не чаще раза в секунду
+    await asyncio.sleep(1.1)
+    calls = fake.state.model_calls.get("small", 0)
+    route = router.route(assistant, "Малыш не спит", 0, None)
+    models = await served(router, 20)
+    check("slo_errors", route.candidates[0] == "backup" and route.reason == "slo"
+          and fake.state.model_calls.get("small", 0) == calls and set(models) == {"backup"},
+          f"после {router.min_samples} ошибок кандидаты {route.candidates} ({route.reason}); "
+          f"20 запросов: в small {fake.state.model_calls.get('small', 0) - calls}, все от {set(models)}")
+
+    # SLO по задержке и возврат модели, когда окно пустеет
+    reset_fake(fake, delay=0.01)
+    fake.state.failing_models = set()
+    fake.state.model_delays = {"small": 0.3}
+    router = fresh_router()
+    router.window("small", "chat").window_seconds = 3.0
+    await served(router, router.min_samples)
+    await asyncio.sleep(1.1)
+    slow_route = router.route(assistant, "Малыш не спит", 0, None)
+    fake.state.model_delays = {}
+    await asyncio.sleep(3.1)
+    recovered = router.route(assistant, "Малыш не спит", 0, None)
+    check("slo_latency", slow_route.candidates[0] == "backup" and recovered.candidates[0] == "small"
+          and recovered.reason == "default",
+          f"p95 small 300 мс > SLO 150 мс: кандидаты {slow_route.candidates}; "
+          f"через окно — {recovered.candidates} ({recovered.reason})")
+
+    await llm_client.stop()
+    return check.exit_code()
+
+
+def main() -> None:
+    os.environ.setdefault("OPENAI_RETRY_BASE_DELAY", "0.02")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    from backend.bench.fake_openai import FakeOpenAIServer
+
+    with FakeOpenAIServer(port=free_port(), delay=0.02) as fake:
+        os.environ["OPENAI_BASE_URL"] = fake.base_url
+        sys.exit(asyncio.run(run(fake.app)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Офлайн-сборка индекса эмбеддингов базы знаний (app/vectors.py).
+
+Читает kb_articles и kb_examples, считает эмбеддинги эмбеддером KB_EMBEDDER
+и пишет матрицу в KB_VECTOR_DIR. Процессы API подхватывают результат сами
+(раз в KB_VECTOR_RELOAD_SECONDS):
+
+    python -m backend.build_vectors build               # новое поколение целиком
+    python -m backend.build_vectors build --ivf-lists 0 # без разбиения IVF
+    python -m backend.build_vectors update              # дописать изменения (по cron)
+
+update считает эмбеддинги только новых и изменённых статей/примеров и
+дописывает их в конец файла; build нужен после смены эмбеддера и когда
+удалённых строк становится много (см. "dropped" в index.json).
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+from backend.app.db import async_engine
+from backend.app.llm_client import llm_client
+from backend.app.vectors import KB_EMBEDDER, KB_VECTOR_DIR, VectorStore, VectorStoreError, load_embedder, load_rows
+
+logger = logging.getLogger(__name__)
+
+
+async def run(args) -> int:
+    store = VectorStore(args.dir)
+    embedder = load_embedder(args.embedder)
+    rows = await load_rows()
+    try:
+        if args.command == "build":
+            header = await store.build(rows, embedder, ivf_lists=args.ivf_lists)
+        else:
+            header = await store.update(rows, embedder)
+    except VectorStoreError as e:
+        logger.error("%s", e)
+        return 1
+    finally:
+        await llm_client.stop()
+        await async_engine.dispose()
+    ivf = header["ivf"]
+    print(f"{store.path}: поколение {header['generation']}, {header['rows']} строк x {header['dim']} "
+          f"({header['embedder']}), удалённых {header['dropped']}, "
+          f"IVF: {ivf['lists'] if ivf else 'нет'}")
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build", "update"])
+    parser.add_argument("--dir", default=KB_VECTOR_DIR)
+    parser.add_argument("--embedder", default=KB_EMBEDDER)
+    parser.add_argument("--ivf-lists", type=int, default=None,
+                        help="число списков IVF (по умолчанию sqrt(строк) от KB_VECTOR_IVF_MIN_ROWS строк, 0 — без IVF)")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,68 +1,101 @@
-from fastapi import FastAPI, Depends, HTTPException
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import json
+import logging
+
+import anyio
+from fastapi import (
+    BackgroundTasks,
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List
-from datetime import datetime
-import uuid
-
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session, declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, JSON
-
-# ----------------------------
-# Database setup
-# ----------------------------
-
-DATABASE_URL = "postgresql+psycopg2://motherschat:motherschat_password@db:5432/motherschat"
-
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
-Base = declarative_base()
-
-# ----------------------------
-# Models
-# ----------------------------
-
-class User(Base):
-    __tablename__ = "users"
-
-    id = Column(Integer, primary_key=True)
-    telegram_id = Column(String, unique=True, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
-
-
-class Assistant(Base):
-    __tablename__ = "assistants"
-
-    id = Column(Integer, primary_key=True, index=True)
-    code = Column(String, unique=True, index=True, nullable=False)
-    title = Column(String, nullable=False)
-    description = Column(Text, nullable=False)
-    base_model = Column(String, nullable=False)
-    system_prompt = Column(Text, nullable=False)
-    extra_config = Column(JSON, nullable=False)
-
-
-class ChatSession(Base):
-    __tablename__ = "chat_sessions"
-
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    assistant_id = Column(Integer, ForeignKey("assistants.id"), nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
-
-
-class ChatMessage(Base):
-    __tablename__ = "chat_messages"
-
-    id = Column(Integer, primary_key=True)
-    session_id = Column(String, ForeignKey("chat_sessions.id"))
-    role = Column(String)        # user | assistant | system
-    content = Column(Text)
-    created_at = Column(DateTime, default=datetime.utcnow)
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+from datetime import date, datetime
+
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.app import queries
+from backend.app.assistants import AssistantConfig, assistant_registry
+from backend.app.chat_sessions import open_session
+from backend.app.context import build_context, context_budget, count_tokens, get_encoding
+from backend.app.db import (
+    DB_MAX_OVERFLOW,
+    DB_POOL_SIZE,
+    AsyncSessionLocal,
+    async_engine,
+    create_tables,
+    get_db,
+)
+from backend.app.few_shot import few_shot_messages, few_shot_selector
+from backend.app.history import (
+    HISTORY_MAX_LIMIT,
+    cached_last_message_id,
+    last_message_id,
+    load_page,
+    make_etag,
+    page_from_cache,
+)
+from backend.app.idempotency import (
+    SessionBusy,
+    idempotency_key,
+    idempotency_store,
+    session_locks,
+)
+from backend.app.jobs import (
+    CHAT_SEND_BACKGROUND,
+    JOB_KEEPALIVE_SECONDS,
+    JOB_MAX_WAIT,
+    Job,
+    job_queue,
+)
+from backend.app.llm_client import LLMError, llm_client
+from backend.app.message_writer import message_writer
+from backend.app.metrics import (
+    MetricsMiddleware,
+    count_error,
+    count_usage,
+    instrument_engine,
+    render_metrics,
+    stage,
+    track_errors,
+)
+from backend.app.models import ChatMessage, ChatSession
+from backend.app.profiles import (
+    PROFILE_FIELD_CHARS,
+    PROFILE_MAX_CHILDREN,
+    PROFILE_NOTES_CHARS,
+    ProfileEntry,
+    profile_cache,
+)
+from backend.app.push import WS_REPLAY_LIMIT, chat_push, message_event, token_event
+from backend.app.quota import QUOTA_HEADERS, QuotaStatus, quota_engine
+from backend.app.ratelimit import RateLimitMiddleware, rate_limiter
+from backend.app.redis_client import close_redis
+from backend.app.response_cache import cache_key, cache_ttl, response_cache
+from backend.app.retrieval import KbSettings, knowledge_base
+from backend.app.routing import DEFAULT_MODEL, Route, model_router, user_turns
+from backend.app.session_cache import (
+    SESSION_CACHE_MAX_MESSAGES,
+    CachedSession,
+    make_entry,
+    session_cache,
+)
+from backend.app.summary import should_summarize, summary_message, update_summary
+from backend.app.telegram_auth import caller_telegram_id
+from backend.app.vectors import vector_index
 
-# создаём недостающие таблицы (users, chat_sessions, chat_messages)
-Base.metadata.create_all(bind=engine)
+logger = logging.getLogger(__name__)
 
 # ----------------------------
 # Pydantic Schemas
@@ -81,9 +114,14 @@ class ChatSendRequest(BaseModel):
     session_id: str
     assistant_slug: str
     message: str
+    # повтор с тем же ключом возвращает уже полученный ответ (альтернатива заголовку Idempotency-Key)
+    idempotency_key: Optional[str] = None
+    # True — ответ генерируется в фоне, сразу возвращается 202 с job_id (альтернатива Prefer: respond-async)
+    background: Optional[bool] = None
 
 
 class ChatMessageDTO(BaseModel):
+    id: Optional[int] = None
     role: str
     content: str
     created_at: str
@@ -94,38 +132,132 @@ class ChatSendResponse(BaseModel):
     messages: List[ChatMessageDTO]
 
 
+class ChatJobError(BaseModel):
+    detail: str
+    status: int
+    retry_after: Optional[int] = None
+
+
+class ChatJobResponse(BaseModel):
+    job_id: str
+    status: str                            # queued | running | done | failed
+    message_id: Optional[int] = None       # сообщение пользователя
+    reply: Optional[str] = None
+    reply_message_id: Optional[int] = None
+    created_at: Optional[str] = None       # время ответа ассистента
+    model: Optional[str] = None
+    error: Optional[ChatJobError] = None
+
+
 class ChatHistoryRequest(BaseModel):
     session_id: str
+    # keyset-пагинация по id сообщений; без курсоров и limit — вся история
+    before_id: Optional[int] = None
+    after_id: Optional[int] = None
+    limit: Optional[int] = Field(None, ge=1, le=HISTORY_MAX_LIMIT)
 
 
 class ChatHistoryResponse(BaseModel):
     messages: List[ChatMessageDTO]
+    has_more: bool = False
+    last_id: Optional[int] = None
 
-# ----------------------------
-# DB dependency
-# ----------------------------
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+class ChildProfile(BaseModel):
+    name: Optional[str] = Field(None, max_length=PROFILE_FIELD_CHARS)
+    sex: Optional[Literal["m", "f"]] = None
+    birth_date: Optional[date] = None  # возраст в промте считается от неё; в будущем — ожидаемые роды
+    # если дата рождения неизвестна — возраст как его написал пользователь («8 мес.»)
+    age: Optional[str] = Field(None, max_length=PROFILE_FIELD_CHARS)
+
+
+class ProfileData(BaseModel):
+    name: Optional[str] = Field(None, max_length=PROFILE_FIELD_CHARS)
+    children: Optional[List[ChildProfile]] = Field(None, max_length=PROFILE_MAX_CHILDREN)
+    feeding: Optional[str] = Field(None, max_length=PROFILE_FIELD_CHARS)
+    allergies: Optional[str] = Field(None, max_length=PROFILE_FIELD_CHARS)
+    notes: Optional[str] = Field(None, max_length=PROFILE_NOTES_CHARS)
+
+
+class ProfileResponse(BaseModel):
+    telegram_id: str
+    data: dict
+    context: Optional[str] = None  # фрагмент анкеты, который видит модель
 
 # ----------------------------
 # OpenAI client
 # ----------------------------
 
-from openai import OpenAI
+# Асинхронный клиент (llm_client.py): ожидание ответа модели не держит поток threadpool,
+# пул соединений, лимит параллельных вызовов, повторы и circuit breaker — в нём.
+# Модель для запроса выбирает routing.py (правила ассистента, SLO, переключение на запасную)
 
-OPENAI_MODEL = "gpt-4o-mini"
-openai_client = OpenAI()
+
+def llm_http_error(e: LLMError) -> HTTPException:
+    return HTTPException(e.status_code, e.detail, headers=e.headers() or None)
 
 # ----------------------------
 # FastAPI init
 # ----------------------------
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # создаём недостающие таблицы (users, chat_sessions, chat_messages)
+    await create_tables()
+    # загрузка кодировки tiktoken блокирующая — делаем её заранее, не на первом запросе
+    await anyio.to_thread.run_sync(get_encoding, DEFAULT_MODEL)
+    # конфигурация ассистентов держится в памяти и обновляется по NOTIFY/проверке версии
+    await assistant_registry.start()
+    # индекс поиска по базе знаний (kb_articles) собирается в фоне
+    await knowledge_base.start()
+    # семантический поиск: матрица эмбеддингов из KB_VECTOR_DIR (python -m backend.build_vectors)
+    await vector_index.start()
+    # примеры few-shot из kb_examples: индексы по ассистентам в памяти
+    await few_shot_selector.start()
+    # фрагменты анкет пользователей в памяти, обновление по NOTIFY user_profiles_changed
+    await profile_cache.start()
+    # счётчики квот: Redis, если задан REDIS_URL, иначе память процесса
+    await quota_engine.start()
+    await rate_limiter.start()
+    await response_cache.start()
+    await session_locks.start()
+    await idempotency_store.start()
+    # отложенная пачечная запись сообщений (MESSAGE_WRITE_BEHIND=1)
+    await message_writer.start()
+    if message_writer.enabled:
+        # блокировка сессии переходит к другому процессу только после записи сообщений хода
+        session_locks.before_release = message_writer.barrier
+        if not session_locks.distributed:
+            logger.warning("MESSAGE_WRITE_BEHIND без Redis: при нескольких процессах клиент, "
+                           "читающий историю по after_id, может пропустить ещё не записанное сообщение")
+    # фоновая генерация: очередь в Redis или в памяти, JOB_WORKERS воркеров в процессе
+    await job_queue.start(generate_job_reply)
+    # события чата по WebSocket: канал Redis/Postgres между процессами
+    await chat_push.start()
+    yield
+    # идущие генерации дописываются, остальные задания остаются в очереди
+    await job_queue.stop()
+    await chat_push.stop()
+    # к этому моменту сервер уже не принимает запросы — дописываем очередь сообщений
+    await message_writer.stop()
+    await quota_engine.stop()
+    await assistant_registry.stop()
+    await knowledge_base.stop()
+    await vector_index.stop()
+    await few_shot_selector.stop()
+    await profile_cache.stop()
+    await llm_client.stop()
+    await close_redis()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# время SQL-запросов и занятость пула — в /metrics
+instrument_engine(async_engine.sync_engine, DB_POOL_SIZE + DB_MAX_OVERFLOW)
+
+# лимит частоты по IP и telegram_id — до маршрутизации и сессии БД;
+# добавляется раньше CORS, чтобы ответ 429 тоже получал CORS-заголовки
+app.add_middleware(RateLimitMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -133,172 +265,845 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # остаток квоты читает фронтенд с другого origin
+    expose_headers=QUOTA_HEADERS + ["Retry-After"],
 )
 
+# снаружи всех остальных: полное время запроса, включая 429 и CORS preflight
+app.add_middleware(MetricsMiddleware)
+
 # ----------------------------
 # Routes
 # ----------------------------
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "time": datetime.utcnow().isoformat()}
+    return {
+        "status": "ok",
+        "time": datetime.utcnow().isoformat(),
+        "session_cache": session_cache.stats(),
+        "message_writer": message_writer.stats(),
+        "quota": quota_engine.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "response_cache": response_cache.stats(),
+        "llm": llm_client.stats(),
+        "routing": model_router.stats(),
+        "jobs": job_queue.stats(),
+        "kb": knowledge_base.stats(),
+        "kb_vectors": vector_index.stats(),
+        "few_shot": few_shot_selector.stats(),
+        "profiles": profile_cache.stats(),
+        "push": chat_push.stats(),
+    }
+
+
+@app.get("/metrics")
+def metrics():
+    """Метрики Prometheus (этапы чата, SQL, OpenAI, токены, ошибки, пул)."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 
 @app.post("/chat/session", response_model=ChatSessionResponse)
-def create_chat_session(payload: ChatSessionCreate, db: Session = Depends(get_db)):
-    """Создание (или получение существующей) чат-сессии по assistant_slug (= assistants.code)."""
+@track_errors("create_chat_session")
+async def create_chat_session(payload: ChatSessionCreate, db: AsyncSession = Depends(get_db)):
+    """Создание (или получение существующей) чат-сессии по assistant_slug (= assistants.code).
 
-    assistant = (
-        db.query(Assistant)
-        .filter(Assistant.code == payload.assistant_slug)
-        .first()
-    )
+    Пользователь и его сессия с ассистентом (со ссылкой на текущую версию промта)
+    создаются одной транзакцией; параллельные запросы сходятся на одной сессии.
+    """
+
+    assistant = await assistant_registry.by_code(payload.assistant_slug)
     if not assistant:
         raise HTTPException(status_code=404, detail="Ассистент не найден")
 
-    user = db.query(User).filter(User.telegram_id == payload.telegram_id).first()
-    if not user:
-        user = User(telegram_id=payload.telegram_id)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-
     # ВАЖНО: если сессия уже существует — возвращаем её (чтобы история сохранялась)
-    existing = (
-        db.query(ChatSession)
-        .filter(ChatSession.user_id == user.id, ChatSession.assistant_id == assistant.id)
-        .order_by(ChatSession.created_at.desc())
-        .first()
-    )
-    if existing:
-        return ChatSessionResponse(session_id=existing.id)
+    with stage("create_chat_session", "open_session"):
+        opened = await open_session(db, payload.telegram_id, assistant.id, assistant.prompt_version_id)
 
-    session = ChatSession(
-        user_id=user.id,
-        assistant_id=assistant.id,
-    )
-    db.add(session)
-    db.commit()
-    db.refresh(session)
-
-    # Добавляем системное сообщение с промтом только для новой сессии
-    sys_msg = ChatMessage(
-        session_id=session.id,
-        role="system",
-        content=assistant.system_prompt,
-    )
-    db.add(sys_msg)
-    db.commit()
+    if opened.created:
+        # новая сессия сразу попадает в кэш — первый /chat/send не читает БД
+        session = ChatSession(id=opened.session_id, user_id=opened.user_id, assistant_id=assistant.id,
+                              prompt_version_id=assistant.prompt_version_id)
+        session_cache.put(make_entry(session, messages=[], complete=True))
 
-    return ChatSessionResponse(session_id=session.id)
+    # анкета пользователя — в кэш заранее, чтобы /chat/send не читал её из БД
+    with stage("create_chat_session", "profile"):
+        await profile_cache.warm(db, opened.user_id)
 
+    return ChatSessionResponse(session_id=opened.session_id)
 
-@app.post("/chat/history", response_model=ChatHistoryResponse)
-def chat_history(payload: ChatHistoryRequest, db: Session = Depends(get_db)):
-    """Получение истории сообщений по session_id (без system)."""
 
-    session = (
-        db.query(ChatSession)
-        .filter(ChatSession.id == payload.session_id)
-        .first()
-    )
+async def get_cached_session(db: AsyncSession, session_id: str):
+    """Сессия из кэша; при промахе — строка сессии и хвост реплик из БД."""
+    entry = session_cache.get(session_id)
+    if entry is not None:
+        return entry
+
+    # отложенные сообщения сессии должны быть в БД до чтения хвоста
+    await message_writer.barrier(session_id)
+    session = await db.get(ChatSession, session_id)
     if not session:
         raise HTTPException(404, "Сессия не найдена")
 
-    history = (
-        db.query(ChatMessage)
-        .filter(ChatMessage.session_id == session.id)
-        .order_by(ChatMessage.created_at)
-        .all()
-    )
+    # берём на одну реплику больше лимита, чтобы понять, вся ли история в хвосте
+    tail = list(await db.scalars(
+        queries.session_tail(session.id, SESSION_CACHE_MAX_MESSAGES + 1)
+    ))
+    complete = len(tail) <= SESSION_CACHE_MAX_MESSAGES
+    tail = tail[:SESSION_CACHE_MAX_MESSAGES]
+    tail.reverse()
+
+    return session_cache.put(make_entry(session, messages=tail, complete=complete))
 
-    return ChatHistoryResponse(
-        messages=[
-            ChatMessageDTO(
-                role=m.role,
-                content=m.content,
-                created_at=m.created_at.isoformat(),
+
+def to_dto_list(messages: List[ChatMessage]) -> List[ChatMessageDTO]:
+    return [
+        ChatMessageDTO(
+            id=m.id,
+            role=m.role,
+            content=m.content,
+            created_at=m.created_at.isoformat(),
+        )
+        for m in messages
+        if m.role != "system"
+    ]
+
+
+async def history_response(db: AsyncSession, request: Request, response: Response,
+                           params: ChatHistoryRequest):
+    with stage("chat_history", "etag"):
+        entry = session_cache.get(params.session_id)
+        if entry is None or not entry.complete:
+            await message_writer.barrier(params.session_id)
+        if entry is not None:
+            last_id = cached_last_message_id(entry)
+        else:
+            # при промахе кэша не грузим хвост: для 304 достаточно строки сессии и max(id)
+            session = await db.get(ChatSession, params.session_id)
+            if not session:
+                raise HTTPException(404, "Сессия не найдена")
+            last_id = await last_message_id(db, session.id)
+
+    etag = make_etag(params.session_id, last_id, params.before_id, params.after_id, params.limit)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    with stage("chat_history", "page"):
+        if entry is not None and entry.complete:
+            messages, has_more = page_from_cache(
+                entry.messages, params.before_id, params.after_id, params.limit
+            )
+        else:
+            messages, has_more = await load_page(
+                db, params.session_id, params.before_id, params.after_id, params.limit
             )
-            for m in history
-            if m.role != "system"
-        ]
-    )
 
+    with stage("chat_history", "response"):
+        response.headers.update(headers)
+        return ChatHistoryResponse(
+            messages=to_dto_list(messages),
+            has_more=has_more,
+            last_id=last_id,
+        )
 
-@app.post("/chat/send", response_model=ChatSendResponse)
-def chat_send(payload: ChatSendRequest, db: Session = Depends(get_db)):
-    """Отправка сообщения в чат и получение ответа от OpenAI."""
 
-    session = (
-        db.query(ChatSession)
-        .filter(ChatSession.id == payload.session_id)
-        .first()
+@app.post("/chat/history", response_model=ChatHistoryResponse)
+@track_errors("chat_history")
+async def chat_history(
+    payload: ChatHistoryRequest,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+):
+    """Получение истории сообщений по session_id (без system).
+
+    Поддерживает before_id/after_id/limit и If-None-Match (ETag).
+    """
+    return await history_response(db, request, response, payload)
+
+
+@app.get("/chat/history/{session_id}", response_model=ChatHistoryResponse)
+@track_errors("chat_history")
+async def chat_history_get(
+    session_id: str,
+    request: Request,
+    response: Response,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_MAX_LIMIT),
+    db: AsyncSession = Depends(get_db),
+):
+    """GET-вариант /chat/history: браузер сам перепроверяет кэш по ETag (304)."""
+    params = ChatHistoryRequest(
+        session_id=session_id, before_id=before_id, after_id=after_id, limit=limit
     )
-    if not session:
-        raise HTTPException(404, "Сессия не найдена")
+    return await history_response(db, request, response, params)
 
-    assistant = db.query(Assistant).filter(Assistant.id == session.assistant_id).first()
-    if not assistant:
-        raise HTTPException(400, "Ассистент отсутствует")
 
-    # Сохраняем сообщение пользователя
-    user_msg = ChatMessage(
-        session_id=session.id,
-        role="user",
-        content=payload.message,
+def profile_response(telegram_id: str, entry: Optional[ProfileEntry]) -> ProfileResponse:
+    if entry is None:
+        return ProfileResponse(telegram_id=telegram_id, data={})
+    return ProfileResponse(
+        telegram_id=telegram_id,
+        data=entry.data,
+        context=entry.message["content"] if entry.message else None,
     )
-    db.add(user_msg)
-    db.commit()
-
-    # История сообщений
-    history = (
-        db.query(ChatMessage)
-        .filter(ChatMessage.session_id == session.id)
-        .order_by(ChatMessage.created_at)
-        .all()
+
+
+@app.get("/profile", response_model=ProfileResponse)
+@track_errors("get_profile")
+async def get_profile(telegram_id: str = Depends(caller_telegram_id), db: AsyncSession = Depends(get_db)):
+    """Анкета вызывающего пользователя и её фрагмент для промта (пустая, если анкеты ещё нет)."""
+    return profile_response(telegram_id, await profile_cache.fetch(db, telegram_id))
+
+
+@app.put("/profile", response_model=ProfileResponse)
+@track_errors("update_profile")
+async def put_profile(
+    payload: ProfileData,
+    telegram_id: str = Depends(caller_telegram_id),
+    db: AsyncSession = Depends(get_db),
+):
+    """Замена анкеты целиком; следующий /chat/send уже видит новый фрагмент."""
+    entry = await profile_cache.save(db, telegram_id, payload.model_dump(mode="json", exclude_none=True))
+    return profile_response(telegram_id, entry)
+
+
+@app.patch("/profile", response_model=ProfileResponse)
+@track_errors("update_profile")
+async def patch_profile(
+    payload: ProfileData,
+    telegram_id: str = Depends(caller_telegram_id),
+    db: AsyncSession = Depends(get_db),
+):
+    """Изменение отдельных полей анкеты: переданные заменяются, null удаляет поле."""
+    entry = await profile_cache.save(
+        db, telegram_id, payload.model_dump(mode="json", exclude_unset=True), merge=True
     )
+    return profile_response(telegram_id, entry)
+
+
+@dataclass
+class ChatTurn:
+    session: CachedSession        # запись кэша горячих сессий
+    assistant: AssistantConfig
+    model_name: str               # модель, выбранная правилами (токены, ключ кэша ответов)
+    route: Route                  # кандидаты с учётом SLO — по ним идёт вызов модели
+    messages: List[dict]          # контекст для модели
+    quota: Optional[QuotaStatus]  # остаток квоты (None — квоты не проверялись)
+    cache_key: Optional[str] = None      # ключ кэша ответов для первого вопроса сессии
+    cached_reply: Optional[str] = None   # готовый ответ из кэша — модель не вызывается
+    user_message_id: Optional[int] = None
+
+    def response_headers(self) -> dict:
+        return self.quota.headers() if self.quota is not None else {}
+
+
+async def start_chat_turn(db: AsyncSession, payload: ChatSendRequest,
+                          background_tasks: BackgroundTasks, endpoint: str,
+                          request_key: Optional[str] = None,
+                          retry_of: Optional[int] = None) -> ChatTurn:
+    """Сохраняет сообщение пользователя и собирает контекст для модели.
+
+    Если из окна контекста вытеснилось достаточно реплик, после ответа
+    в фоне обновляется summary сессии.
+
+    До сохранения списывается запрос из квоты пользователя; если квота
+    исчерпана — 429 с Retry-After. Для первого вопроса сессии проверяется
+    кэш ответов ассистента. Если у ассистента включена база знаний,
+    подходящие к вопросу фрагменты статей идут в контекст, а из его
+    примеров (kb_examples) — ближайшие к вопросу пары вопрос/ответ.
+    Анкета пользователя добавляется готовым фрагментом из кэша.
+
+    Транзакция закрывается до обращения к модели, чтобы соединение с БД
+    не удерживалось на время ответа. endpoint — метка этапов в /metrics.
+    Сохранённое сообщение сразу уходит другим устройствам сессии (WebSocket)
+    с ключом идемпотентности запроса request_key; под этим же ключом
+    запоминается его id. retry_of — id уже сохранённого сообщения при повторе
+    с тем же ключом после сбоя модели: новое не пишется, квота не списывается,
+    генерируется только ответ.
+    """
+
+    with stage(endpoint, "session"):
+        session = await get_cached_session(db, payload.session_id)
+
+        assistant = await assistant_registry.by_id(session.assistant_id)
+        if not assistant:
+            raise HTTPException(400, "Ассистент отсутствует")
+        prompt = await assistant_registry.prompt(assistant.prompt_version_id)
+        if prompt is None:
+            raise HTTPException(500, "Системный промт ассистента недоступен")
+
+    # реплики до вопроса этого хода (при повторе сам вопрос уже в хвосте сессии)
+    earlier = session.messages
+    if retry_of is not None:
+        last = session.messages[-1] if session.messages else None
+        if last is None or last.id != retry_of or last.role != "user":
+            raise HTTPException(409, "Сообщение с этим ключом уже не последнее в сессии")
+        earlier = session.messages[:-1]
+
+    quota = None
+    if retry_of is None:
+        with stage(endpoint, "quota"):
+            quota = await quota_engine.consume(db, session.user_id)
+        if quota is not None and not quota.allowed:
+            raise HTTPException(429, "Лимит запросов исчерпан", headers=quota.headers())
+
+    # модель по правилам ассистента (длина сообщения, глубина сессии, тариф) и SLO моделей
+    tier = quota.limits.tier if quota is not None else (await quota_engine.limits_for(db, session.user_id)).tier
+    route = model_router.route(assistant, payload.message, user_turns(earlier), tier)
+    model_name = route.model
+
+    # фрагменты базы знаний по вопросу (extra_config["kb"] ассистента): ключевой поиск по индексу
+    # в памяти или (mode "dense") по эмбеддингам из mmap-файла, пока тот не загружен — ключевой
+    kb = KbSettings.from_config(assistant.extra_config)
+    grounding = None
+    if kb is not None:
+        with stage(endpoint, "retrieval"):
+            if kb.mode == "dense" and vector_index.ready:
+                grounding = await vector_index.grounding(payload.message, kb, model_name)
+            else:
+                grounding = knowledge_base.grounding(payload.message, kb, model_name)
+
+    # примеры вопросов и ответов ассистента (kb_examples), подобранные под вопрос; выбор мемоизирован
+    with stage(endpoint, "few_shot"):
+        examples = few_shot_messages(few_shot_selector.select(assistant, payload.message))
+
+    # анкета пользователя: фрагмент отрендерен заранее и прогрет на /chat/session — БД не читается
+    with stage(endpoint, "profile"):
+        profile = await profile_cache.message(db, session.user_id)
+
+    # первый вопрос сессии не зависит от истории — его ответ можно переиспользовать;
+    # ответ с учётом анкеты личный и в общий кэш не идёт
+    first_turn = session.complete and not any(m.role == "user" for m in earlier)
+    reusable = first_turn and profile is None
+    key = cache_key(assistant, model_name, payload.message, grounding, examples) if reusable else None
+
+    with stage(endpoint, "save_user"):
+        if session.prompt_version_id != prompt.id:
+            # промт ассистента изменился: сессия переходит на текущую версию (тем же commit'ом)
+            await db.execute(
+                update(ChatSession).where(ChatSession.id == session.id).values(prompt_version_id=prompt.id)
+            )
+            session.prompt_version_id = prompt.id
+        if retry_of is None:
+            # Сохраняем сообщение пользователя
+            user_msg = ChatMessage(
+                session_id=session.id,
+                role="user",
+                content=payload.message,
+                tokens_used=count_tokens(payload.message, model_name),
+            )
+            # commit (или постановка в очередь write-behind) возвращает соединение в пул:
+            # на время ответа модели запрос не держит соединение с БД
+            await message_writer.save(db, user_msg)
+            session_cache.add_message(session.id, user_msg, entry=session)
+            chat_push.publish(session.id, message_event(user_msg, request_key))
+            user_message_id = user_msg.id
+            if request_key is not None:
+                # если модель не ответит, повтор с этим ключом не создаст второе сообщение
+                await idempotency_store.put(session.id, request_key, {"user_message_id": user_message_id})
+        else:
+            await db.commit()
+            user_message_id = retry_of
+
+    turn = ChatTurn(session, assistant, model_name, route, [], quota, cache_key=key,
+                    user_message_id=user_message_id)
+    if key is not None:
+        with stage(endpoint, "response_cache"):
+            turn.cached_reply = await response_cache.get(assistant.id, key)
+        if turn.cached_reply is not None:
+            return turn
+
+    with stage(endpoint, "context"):
+        # системный промт из реестра и реплики (без уже свёрнутых в summary) — из кэша, без чтения БД
+        history = [prompt] + session.prompt_history()
+
+        # системный промт + анкета + summary + фрагменты базы знаний + примеры + самые свежие реплики
+        # в пределах бюджета
+        summary = summary_message(session.summary)
+        turn.messages, evicted = build_context(
+            history,
+            model_name,
+            context_budget(assistant.extra_config),
+            extra_system=[m for m in (profile, summary, grounding) if m],
+            few_shot=examples,
+        )
+    if should_summarize(evicted):
+        # хвост в кэше неполный и начинается после summary: старше него есть не свёрнутые реплики
+        gap = not session.complete and bool(session.messages) and (
+            session.summary_until_id is None or session.summary_until_id < session.messages[0].id
+        )
+        background_tasks.add_task(
+            update_summary,
+            llm_client,
+            session.id,
+            session.summary,
+            session.summary_until_id,
+            evicted,
+            assistant.code,
+            session.messages[0].id if gap else None,
+        )
+    return turn
+
+
+async def remember_reply(turn: ChatTurn, reply: str, model: str) -> None:
+    # ответ запасной модели не кэшируется под ключом выбранной
+    if turn.cache_key is not None and turn.cached_reply is None and model == turn.model_name:
+        await response_cache.set(turn.cache_key, reply, cache_ttl(turn.assistant.extra_config))
 
-    messages_for_openai = [{"role": m.role, "content": m.content} for m in history]
 
-    # Запрос к модели
+async def lock_session(session_id: str, endpoint: str):
+    """Блокировка сессии на время хода: сообщения одной сессии идут по очереди."""
     try:
-        model_name = assistant.base_model or OPENAI_MODEL
+        with stage(endpoint, "lock"):
+            return await session_locks.acquire(session_id)
+    except SessionBusy:
+        raise HTTPException(409, "Предыдущее сообщение в этой сессии ещё обрабатывается")
 
-        completion = openai_client.chat.completions.create(
+
+async def ensure_no_active_job(session_id: str) -> None:
+    """409, пока ответ на предыдущее сообщение сессии генерируется в фоне."""
+    if await job_queue.active(session_id):
+        raise HTTPException(
+            409, "Предыдущее сообщение в этой сессии ещё обрабатывается", headers={"Retry-After": "1"}
+        )
+
+
+def wants_background(payload: ChatSendRequest, prefer: Optional[str]) -> bool:
+    if payload.background is not None:
+        return payload.background
+    if prefer and "respond-async" in prefer.lower():
+        return True
+    return CHAT_SEND_BACKGROUND
+
+
+async def session_history(db: AsyncSession, session: CachedSession):
+    if session.complete:
+        return session.messages
+    await message_writer.barrier(session.id)
+    updated, _ = await load_page(db, session.id)
+    return updated
+
+
+def reply_result(message) -> dict:
+    """Результат хода, который запоминается по ключу идемпотентности."""
+    return {
+        "reply": message.content,
+        "message_id": message.id,
+        "created_at": message.created_at.isoformat(),
+    }
+
+
+@app.post("/chat/send", response_model=ChatSendResponse,
+          responses={202: {"model": ChatJobResponse}})
+@track_errors("chat_send")
+async def chat_send(
+    payload: ChatSendRequest,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+    idempotency_header: Optional[str] = Header(None, alias="Idempotency-Key"),
+    prefer: Optional[str] = Header(None),
+):
+    """Отправка сообщения в чат и получение ответа от OpenAI.
+
+    Повтор с тем же Idempotency-Key (или idempotency_key) не создаёт новых
+    сообщений: одновременный дубликат дожидается текущего ответа, поздний
+    получает сохранённый. Если модель в прошлый раз не ответила (502/503,
+    упавшее фоновое задание), повтор генерирует ответ на уже сохранённое
+    сообщение.
+
+    В фоновом режиме (background, Prefer: respond-async или
+    CHAT_SEND_BACKGROUND=1) сообщение сохраняется, генерация ставится в
+    очередь и сразу возвращается 202 ({"job_id", "status", "message_id"});
+    результат — GET /chat/jobs/{job_id}. Ответ из кэша ответов приходит
+    сразу (200), как в обычном режиме.
+    """
+    key = idempotency_key(idempotency_header, payload.idempotency_key)
+    lock = await lock_session(payload.session_id, "chat_send")
+    try:
+        stored = await idempotency_store.get(payload.session_id, key) if key is not None else None
+        if stored is not None and "reply" in stored:
+            session = await get_cached_session(db, payload.session_id)
+            return ChatSendResponse(
+                reply=stored["reply"],
+                messages=to_dto_list(await session_history(db, session)),
+            )
+        if stored is not None and "job_id" in stored:
+            # ход поставлен в очередь: пока задание не упало, повтор получает его состояние
+            job = await job_queue.get(stored["job_id"])
+            if job is not None and job.status != "failed":
+                return JSONResponse(job_payload(job), status_code=202)
+        await ensure_no_active_job(payload.session_id)
+        return await send_chat_turn(db, payload, background_tasks, response, key,
+                                    background=wants_background(payload, prefer),
+                                    retry_of=stored.get("user_message_id") if stored else None)
+    finally:
+        await lock.release()
+
+
+async def send_chat_turn(db: AsyncSession, payload: ChatSendRequest,
+                         background_tasks: BackgroundTasks, response: Response,
+                         key: Optional[str], background: bool = False,
+                         retry_of: Optional[int] = None):
+    turn = await start_chat_turn(db, payload, background_tasks, "chat_send", key, retry_of)
+    session, model_name = turn.session, turn.model_name
+    response.headers.update(turn.response_headers())
+
+    if background and turn.cached_reply is None:
+        accepted = await enqueue_chat_turn(turn, key)
+        if accepted is not None:
+            return accepted
+
+    if turn.cached_reply is not None:
+        reply = turn.cached_reply
+        reply_tokens = count_tokens(reply, model_name)
+    else:
+        # Запрос к модели (при сбое — к запасной из маршрута)
+        try:
+            with stage("chat_send", "llm"):
+                model_name, completion = await model_router.complete(
+                    turn.route,
+                    turn.assistant.code,
+                    messages=turn.messages
+                )
+        except LLMError as e:
+            raise llm_http_error(e)
+
+        reply = completion.choices[0].message.content or ""
+
+        count_usage(turn.assistant.code, completion.usage)
+        if completion.usage and completion.usage.completion_tokens:
+            reply_tokens = completion.usage.completion_tokens
+        else:
+            reply_tokens = count_tokens(reply, model_name)
+        await remember_reply(turn, reply, model_name)
+
+    with stage("chat_send", "save_reply"):
+        # Сохраняем ответ ассистента
+        as_msg = ChatMessage(
+            session_id=session.id,
+            role="assistant",
+            content=reply,
+            tokens_used=reply_tokens,
             model=model_name,
-            messages=messages_for_openai
+        )
+        await message_writer.save(db, as_msg)
+        session_cache.add_message(session.id, as_msg, entry=session)
+        chat_push.publish(session.id, message_event(as_msg, key))
+        if key is not None:
+            await idempotency_store.put(session.id, key, reply_result(as_msg))
+
+    with stage("chat_send", "response"):
+        # Возвращаем обновлённую историю
+        return ChatSendResponse(
+            reply=reply,
+            messages=to_dto_list(await session_history(db, session)),
         )
 
-        reply = completion.choices[0].message.content
-    except Exception as e:
-        raise HTTPException(500, f"OpenAI error: {str(e)}")
 
-    # Сохраняем ответ ассистента
-    as_msg = ChatMessage(
-        session_id=session.id,
-        role="assistant",
-        content=reply,
-    )
-    db.add(as_msg)
-    db.commit()
-
-    # Возвращаем обновлённую историю
-    updated = (
-        db.query(ChatMessage)
-        .filter(ChatMessage.session_id == session.id)
-        .order_by(ChatMessage.created_at)
-        .all()
+async def enqueue_chat_turn(turn: ChatTurn, key: Optional[str]) -> Optional[JSONResponse]:
+    """Ставит генерацию ответа в очередь; None — очередь недоступна (ответ — синхронно)."""
+    route = turn.route
+    job = Job.new(
+        session_id=turn.session.id,
+        assistant_id=turn.assistant.id,
+        assistant_code=turn.assistant.code,
+        model=route.model,
+        candidates=list(route.candidates),
+        reason=route.reason,
+        messages=turn.messages,
+        user_message_id=turn.user_message_id,
+        cache_key=turn.cache_key,
+        idempotency_key=key,
     )
+    try:
+        with stage("chat_send", "enqueue"):
+            await job_queue.submit(job)
+    except Exception:
+        logger.exception("Очередь генерации недоступна, ответ сессии %s — синхронно", turn.session.id)
+        return None
+    if key is not None:
+        # повтор с тем же ключом получит состояние задания, а после его завершения — ответ
+        await idempotency_store.put(turn.session.id, key,
+                                    {"job_id": job.id, "user_message_id": turn.user_message_id})
+    if job_queue.backend_name == "redis":
+        # ответ может сохранить воркер другого процесса — следующий ход перечитает сессию из БД
+        session_cache.invalidate(turn.session.id)
+    return JSONResponse(job_payload(job), status_code=202, headers=turn.response_headers())
+
+
+def job_payload(job: Job) -> dict:
+    result = job.result or {}
+    return ChatJobResponse(
+        job_id=job.id,
+        status=job.status,
+        message_id=job.user_message_id,
+        reply=result.get("reply"),
+        reply_message_id=result.get("message_id"),
+        created_at=result.get("created_at"),
+        model=result.get("model"),
+        error=job.error,
+    ).model_dump(exclude_none=True)
+
+
+async def generate_job_reply(job: Job) -> dict:
+    """Генерация ответа по заданию очереди (вызывается воркером job_queue).
+
+    Ответ сохраняется через message_writer, как и ответы обычных ходов, а
+    задание завершается только после записи ответа в БД (barrier): клиент,
+    получивший результат, найдёт сообщение и в другом процессе.
+    """
+    if job.attempts > 1 and job.user_message_id is not None:
+        # прошлая попытка могла успеть сохранить ответ до падения воркера
+        async with AsyncSessionLocal() as db:
+            saved = (await db.execute(queries.reply_after(job.session_id, job.user_message_id))).scalar()
+        if saved is not None:
+            return {**reply_result(saved), "model": saved.model}
+
+    route = Route(job.model, tuple(job.candidates), job.reason)
+    with stage("chat_job", "llm"):
+        model_name, completion = await model_router.complete(
+            route, job.assistant_code, messages=job.messages
+        )
+    reply = completion.choices[0].message.content or ""
+    count_usage(job.assistant_code, completion.usage)
+    if completion.usage and completion.usage.completion_tokens:
+        reply_tokens = completion.usage.completion_tokens
+    else:
+        reply_tokens = count_tokens(reply, model_name)
+
+    with stage("chat_job", "save_reply"):
+        async with AsyncSessionLocal() as db:
+            as_msg = ChatMessage(
+                session_id=job.session_id,
+                role="assistant",
+                content=reply,
+                tokens_used=reply_tokens,
+                model=model_name,
+            )
+            await message_writer.save(db, as_msg)
+        session_cache.add_message(job.session_id, as_msg)
+        chat_push.publish(job.session_id, message_event(as_msg, job.idempotency_key))
+        await message_writer.barrier(job.session_id)
+
+    result = {**reply_result(as_msg), "model": model_name}
+    if job.cache_key is not None and model_name == job.model:
+        assistant = await assistant_registry.by_id(job.assistant_id)
+        if assistant is not None:
+            await response_cache.set(job.cache_key, reply, cache_ttl(assistant.extra_config))
+    if job.idempotency_key is not None:
+        await idempotency_store.put(job.session_id, job.idempotency_key, result)
+    return result
+
+
+@app.get("/chat/jobs/{job_id}", response_model=ChatJobResponse, response_model_exclude_none=True)
+async def chat_job(job_id: str, wait: float = Query(0, ge=0, le=JOB_MAX_WAIT)):
+    """Состояние задания фоновой генерации; wait — ждать завершения до стольких секунд."""
+    job = await job_queue.wait(job_id, wait) if wait else await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Задание не найдено")
+    return job_payload(job)
+
+
+@app.get("/chat/jobs/{job_id}/events")
+async def chat_job_events(job_id: str):
+    """Подписка на результат задания (SSE): `done` ({"reply", "message_id",
+    "created_at", "model"}) или `error` ({"detail", "status", "retry_after"}),
+    пока ждём — комментарии keep-alive."""
+    if await job_queue.get(job_id) is None:
+        raise HTTPException(404, "Задание не найдено")
+
+    async def events():
+        while True:
+            job = await job_queue.wait(job_id, JOB_KEEPALIVE_SECONDS)
+            if job is None:
+                yield sse_event("error", {"detail": "Задание не найдено", "status": 404})
+                return
+            if job.status == "done":
+                yield sse_event("done", job.result)
+                return
+            if job.status == "failed":
+                yield sse_event("error", job.error)
+                return
+            yield ": keep-alive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=sse_headers())
+
+
+async def save_assistant_reply(session_id: str, reply: str, model_name: str,
+                               key: Optional[str] = None) -> ChatMessage:
+    # сессия БД из зависимости к этому моменту уже закрыта — открываем свою
+    async with AsyncSessionLocal() as db:
+        as_msg = ChatMessage(
+            session_id=session_id,
+            role="assistant",
+            content=reply,
+            tokens_used=count_tokens(reply, model_name),
+            model=model_name,
+        )
+        await message_writer.save(db, as_msg)
+        session_cache.add_message(session_id, as_msg)
+        chat_push.publish(session_id, message_event(as_msg, key))
+        return as_msg
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_headers(extra: Optional[dict] = None) -> dict:
+    return {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **(extra or {})}
+
 
-    return ChatSendResponse(
-        reply=reply,
-        messages=[
-            ChatMessageDTO(
-                role=m.role,
-                content=m.content,
-                created_at=m.created_at.isoformat(),
+async def replay_stream(result: dict):
+    yield sse_event("token", {"delta": result["reply"]})
+    yield sse_event("done", result)
+
+
+@app.post("/chat/send/stream")
+@track_errors("chat_send_stream")
+async def chat_send_stream(
+    payload: ChatSendRequest,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db),
+    idempotency_header: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    """Отправка сообщения с потоковым ответом (SSE).
+
+    События: `token` ({"delta"}) по мере генерации, затем `done`
+    ({"reply", "message_id", "created_at"}) или `error` ({"detail"}; при сбое
+    модели ещё "status" и "retry_after" — как код и Retry-After у /chat/send).
+    Ответ ассистента сохраняется после завершения потока; при обрыве
+    соединения клиентом сохраняется уже полученная часть.
+
+    Idempotency-Key — как в /chat/send; сохранённый ответ отдаётся одним
+    событием `token` и `done`, после сбоя модели повтор генерирует ответ
+    на уже сохранённое сообщение.
+    """
+    key = idempotency_key(idempotency_header, payload.idempotency_key)
+    lock = await lock_session(payload.session_id, "chat_send_stream")
+    try:
+        stored = await idempotency_store.get(payload.session_id, key) if key is not None else None
+        if stored is not None and "reply" in stored:
+            await lock.release()
+            return StreamingResponse(
+                replay_stream(stored), media_type="text/event-stream", headers=sse_headers()
             )
-            for m in updated
-            if m.role != "system"
-        ]
-    )
\ No newline at end of file
+        await ensure_no_active_job(payload.session_id)
+        turn = await start_chat_turn(db, payload, background_tasks, "chat_send_stream", key,
+                                     retry_of=stored.get("user_message_id") if stored else None)
+    except BaseException:
+        await lock.release()
+        raise
+    # блокировка снимается в конце потока; фоновая задача — страховка на случай,
+    # если клиент отключился до первого чтения и генератор так и не запустился
+    background_tasks.add_task(lock.release)
+    session, model_name = turn.session, turn.model_name
+
+    async def event_stream():
+        nonlocal model_name
+        parts: List[str] = []
+        saved = None
+        try:
+            if turn.cached_reply is not None:
+                parts.append(turn.cached_reply)
+                chat_push.publish(session.id, token_event(turn.cached_reply, key))
+                yield sse_event("token", {"delta": turn.cached_reply})
+            else:
+                with stage("chat_send_stream", "llm"):
+                    async with model_router.stream(
+                        turn.route,
+                        turn.assistant.code,
+                        messages=turn.messages,
+                        # usage приходит последним чанком (без choices) — для счётчиков токенов
+                        stream_options={"include_usage": True},
+                    ) as (model_name, chunks):
+                        async for chunk in chunks:
+                            if chunk.usage is not None:
+                                count_usage(turn.assistant.code, chunk.usage)
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content
+                            if delta:
+                                parts.append(delta)
+                                chat_push.publish(session.id, token_event(delta, key))
+                                yield sse_event("token", {"delta": delta})
+
+            with stage("chat_send_stream", "save_reply"):
+                saved = await save_assistant_reply(session.id, "".join(parts), model_name, key)
+            await remember_reply(turn, saved.content, model_name)
+            result = reply_result(saved)
+            if key is not None:
+                await idempotency_store.put(session.id, key, result)
+            await lock.release()
+            yield sse_event("done", result)
+        except LLMError as e:
+            count_error("chat_send_stream", e)
+            yield sse_event("error", {
+                "detail": e.detail, "status": e.status_code, "retry_after": e.retry_after_seconds,
+            })
+        except Exception as e:
+            count_error("chat_send_stream", e)
+            logger.exception("Ошибка потокового ответа сессии %s", session.id)
+            yield sse_event("error", {"detail": "Не удалось получить ответ"})
+        finally:
+            with anyio.CancelScope(shield=True):
+                # клиент отключился или генерация прервана — сохраняем то, что успели получить
+                if saved is None and parts:
+                    partial = await save_assistant_reply(session.id, "".join(parts), model_name, key)
+                    if key is not None:
+                        await idempotency_store.put(session.id, key, reply_result(partial))
+                await lock.release()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers=sse_headers(turn.response_headers()),
+    )
+
+
+@app.websocket("/chat/ws/{session_id}")
+async def chat_ws(websocket: WebSocket, session_id: str, after_id: Optional[int] = None):
+    """События сессии для всех открытых устройств (см. app/push.py).
+
+    after_id — id последнего сообщения, которое уже есть у клиента: сразу после
+    подключения приходят пропущенные сообщения (не больше WS_REPLAY_LIMIT,
+    иначе {"type": "resync"} — историю нужно перечитать через /chat/history).
+    Клиент может слать "ping" — в ответ приходит {"type": "pong"}.
+    """
+    try:
+        async with AsyncSessionLocal() as db:
+            entry = await get_cached_session(db, session_id)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    # подписываемся до чтения пропущенного: сообщение между чтением и подпиской не теряется,
+    # а повтор клиент отбрасывает по id
+    sub = await chat_push.connect(session_id, websocket)
+    try:
+        if after_id is not None:
+            if entry.complete:
+                missed, has_more = page_from_cache(entry.messages, after_id=after_id, limit=WS_REPLAY_LIMIT)
+            else:
+                await message_writer.barrier(session_id)
+                async with AsyncSessionLocal() as db:
+                    missed, has_more = await load_page(db, session_id, after_id=after_id, limit=WS_REPLAY_LIMIT)
+            if has_more:
+                chat_push.send(sub, {"type": "resync"})
+            else:
+                for message in missed:
+                    if message.role != "system":
+                        chat_push.send(sub, message_event(message))
+        while True:
+            if await websocket.receive_text() == "ping":
+                chat_push.send(sub, {"type": "pong"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await chat_push.disconnect(sub)
@@ -0,0 +1,40 @@
+"""Отдельный процесс воркеров фоновой генерации (app/jobs.py).
+
+Поднимает то же окружение, что и API (БД, реестр ассистентов, клиент
+OpenAI, кэши), но HTTP не слушает — только забирает задания из очереди
+в Redis. Масштабируется независимо от API:
+
+    REDIS_URL=redis://redis:6379/0 JOB_WORKERS=16 python -m backend.worker
+
+По SIGTERM/SIGINT новые задания не берутся, идущие генерации дописываются
+(до JOB_DRAIN_TIMEOUT секунд), остальные остаются в очереди.
+"""
+import asyncio
+import logging
+import os
+import signal
+
+from backend.app.jobs import job_queue
+from backend.main import app
+
+logger = logging.getLogger(__name__)
+
+
+async def run() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    async with app.router.lifespan_context(app):
+        if job_queue.backend_name != "redis":
+            logger.warning("REDIS_URL не задан: воркер видит только собственную очередь в памяти")
+        await stop.wait()
+
+
+def main() -> None:
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -234,10 +234,20 @@
     return `mamino_session_${assistantSlug}`;
   }
 
+  // telegram_id в заголовке — бэкенд ограничивает частоту запросов на пользователя;
+  // подписанная initData подтверждает пользователя (анкета /profile)
+  function apiHeaders(extra) {
+    const headers = Object.assign({}, extra || {});
+    const telegramId = getTelegramUserId();
+    if (telegramId) headers["X-Telegram-Id"] = telegramId;
+    if (tg?.initData) headers["X-Telegram-Init-Data"] = tg.initData;
+    return headers;
+  }
+
   async function apiPost(path, payload) {
     const r = await fetch(`${API_BASE}${path}`, {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
+      headers: apiHeaders({ "Content-Type": "application/json" }),
       body: JSON.stringify(payload)
     });
     const text = await r.text();
@@ -250,6 +260,71 @@
     return data;
   }
 
+  async function apiGet(path) {
+    const r = await fetch(`${API_BASE}${path}`, { method: "GET", cache: "no-cache", headers: apiHeaders() });
+    const text = await r.text();
+    let data = null;
+    try { data = JSON.parse(text); } catch { data = { raw: text }; }
+    if (!r.ok) {
+      const msg = (data && (data.detail || data.error)) ? (data.detail || data.error) : `HTTP ${r.status}`;
+      throw new Error(msg);
+    }
+    return data;
+  }
+
+  function parseSseBlock(raw, onEvent) {
+    let event = "message";
+    let dataStr = "";
+    raw.split("\n").forEach((line) => {
+      if (line.startsWith("event:")) event = line.slice(6).trim();
+      else if (line.startsWith("data:")) dataStr += line.slice(5).trim();
+    });
+    if (!dataStr) return;
+    let data = null;
+    try { data = JSON.parse(dataStr); } catch { data = { raw: dataStr }; }
+    onEvent(event, data);
+  }
+
+  // POST с ответом в формате SSE (text/event-stream); onEvent(event, data) вызывается на каждое событие
+  async function apiPostStream(path, payload, onEvent) {
+    const r = await fetch(`${API_BASE}${path}`, {
+      method: "POST",
+      headers: apiHeaders({ "Content-Type": "application/json", "Accept": "text/event-stream" }),
+      body: JSON.stringify(payload)
+    });
+    if (!r.ok) {
+      const text = await r.text();
+      let data = null;
+      try { data = JSON.parse(text); } catch { data = { raw: text }; }
+      const msg = (data && (data.detail || data.error)) ? (data.detail || data.error) : `HTTP ${r.status}`;
+      throw new Error(msg);
+    }
+
+    // без ReadableStream (старые WebView) — разбираем ответ целиком
+    if (!r.body || typeof r.body.getReader !== "function") {
+      const text = await r.text();
+      text.split("\n\n").forEach((raw) => parseSseBlock(raw, onEvent));
+      return;
+    }
+
+    const reader = r.body.getReader();
+    const decoder = new TextDecoder();
+    let buf = "";
+
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buf += decoder.decode(value, { stream: true });
+
+      let idx;
+      while ((idx = buf.indexOf("\n\n")) !== -1) {
+        parseSseBlock(buf.slice(0, idx), onEvent);
+        buf = buf.slice(idx + 2);
+      }
+    }
+    if (buf.trim()) parseSseBlock(buf, onEvent);
+  }
+
   function setChatStatus(msg) {
     if (!chatStatusEl) return;
     chatStatusEl.textContent = msg || "";
@@ -271,7 +346,8 @@
   }
 
   async function loadChatHistory(sessionId) {
-    const data = await apiPost("/chat/history", { session_id: sessionId });
+    // GET + ETag: если история не менялась, браузер получит 304 и возьмёт ответ из своего кэша
+    const data = await apiGet(`/chat/history/${encodeURIComponent(sessionId)}`);
     const msgs = data?.messages;
     return Array.isArray(msgs) ? msgs : [];
   }
@@ -288,12 +364,113 @@
     row.appendChild(bubble);
     chatMessagesEl.appendChild(row);
     chatMessagesEl.scrollTop = chatMessagesEl.scrollHeight;
+    return bubble;
+  }
+
+  function appendToBubble(bubble, text) {
+    if (!bubble || !chatMessagesEl) return;
+    bubble.textContent += text;
+    chatMessagesEl.scrollTop = chatMessagesEl.scrollHeight;
   }
 
   let activeAssistantSlug = null;
   let activeAssistantTitle = null;
   let activeSessionId = null;
 
+  // =========================
+  // Синхронизация устройств (WebSocket /chat/ws)
+  // =========================
+  // Сообщения и токены ответа, отправленные с других устройств (или вкладок)
+  // той же сессии. Свои события вкладка узнаёт по ключам идемпотентности.
+  const ownKeys = new Set();
+  let seenIds = new Set();
+  let lastMessageId = null;
+  let chatSocket = null;
+  let chatSocketRetry = null;
+  let chatSocketDelay = 1000;
+  const liveBubbles = new Map();
+
+  function rememberMessageId(id) {
+    if (typeof id !== "number") return;
+    seenIds.add(id);
+    if (lastMessageId === null || id > lastMessageId) lastMessageId = id;
+  }
+
+  function resetChatSync(messages) {
+    seenIds = new Set();
+    lastMessageId = null;
+    liveBubbles.clear();
+    (messages || []).forEach((m) => rememberMessageId(m?.id));
+  }
+
+  function handleChatEvent(data) {
+    if (!data) return;
+    if (data.key && ownKeys.has(data.key)) {
+      // своё сообщение уже на экране; id запоминаем, чтобы не повторить его при переподключении
+      if (data.type === "message") rememberMessageId(data.message?.id);
+      return;
+    }
+    if (data.type === "token") {
+      let bubble = liveBubbles.get(data.key || "");
+      if (!bubble) {
+        bubble = appendChatBubble("assistant", "");
+        liveBubbles.set(data.key || "", bubble);
+      }
+      appendToBubble(bubble, String(data.delta || ""));
+    } else if (data.type === "message") {
+      const m = data.message || {};
+      if (seenIds.has(m.id) || (m.role !== "user" && m.role !== "assistant")) return;
+      rememberMessageId(m.id);
+      const bubble = m.role === "assistant" ? liveBubbles.get(data.key || "") : null;
+      if (bubble) {
+        liveBubbles.delete(data.key || "");
+        bubble.textContent = String(m.content || "");
+      } else {
+        appendChatBubble(m.role, String(m.content || ""));
+      }
+    } else if (data.type === "resync" && activeSessionId) {
+      // пропущено слишком много — перечитываем историю целиком
+      loadChatHistory(activeSessionId)
+        .then((history) => {
+          renderChatHistory(history);
+          resetChatSync(history);
+        })
+        .catch(() => {});
+    }
+  }
+
+  function openChatSocket(sessionId) {
+    closeChatSocket();
+    const proto = location.protocol === "https:" ? "wss" : "ws";
+    const after = lastMessageId !== null ? `?after_id=${lastMessageId}` : "";
+    const ws = new WebSocket(`${proto}://${location.host}${API_BASE}/chat/ws/${encodeURIComponent(sessionId)}${after}`);
+    chatSocket = ws;
+    ws.onopen = () => { chatSocketDelay = 1000; };
+    ws.onmessage = (e) => {
+      try {
+        handleChatEvent(JSON.parse(e.data));
+      } catch (err) {
+        // повреждённое событие пропускаем
+      }
+    };
+    ws.onclose = (e) => {
+      if (chatSocket !== ws) return;
+      chatSocket = null;
+      if (e.code === 1008 || activeSessionId !== sessionId) return;
+      // переподключение с растущей паузой; пропущенное догоняется по after_id
+      chatSocketRetry = setTimeout(() => openChatSocket(sessionId), chatSocketDelay);
+      chatSocketDelay = Math.min(chatSocketDelay * 2, 30000);
+    };
+  }
+
+  function closeChatSocket() {
+    if (chatSocketRetry) clearTimeout(chatSocketRetry);
+    chatSocketRetry = null;
+    const ws = chatSocket;
+    chatSocket = null;
+    if (ws) ws.close();
+  }
+
   async function ensureChatSession(assistantSlug) {
     const cached = localStorage.getItem(sessionStorageKey(assistantSlug));
     if (cached && cached.length > 0) return cached;
@@ -315,6 +492,7 @@
     activeAssistantSlug = assistantSlug;
     activeAssistantTitle = assistantTitle;
     activeSessionId = null;
+    closeChatSocket();
 
     clearChatUi();
     if (chatTitleEl) chatTitleEl.textContent = assistantTitle;
@@ -332,37 +510,69 @@
         } else {
           appendChatBubble("assistant", "Привет! Я на связи. Чем помочь?");
         }
+        resetChatSync(history);
+        if (activeSessionId === sid) openChatSocket(sid);
         chatInputEl?.focus();
       })
       .catch((e) => setChatStatus(`Ошибка: ${e.message}`));
   }
 
+  // Ключ идемпотентности: повторная отправка того же текста, пока предыдущая
+  // не завершилась (двойное нажатие, повтор после обрыва сети), идёт с тем же ключом
+  let pendingSend = null;
+
+  function newIdempotencyKey() {
+    if (window.crypto && typeof window.crypto.randomUUID === "function") return window.crypto.randomUUID();
+    return `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+  }
+
+  function idempotencyKeyFor(sessionId, text) {
+    if (!pendingSend || pendingSend.sessionId !== sessionId || pendingSend.text !== text) {
+      pendingSend = { sessionId, text, key: newIdempotencyKey() };
+    }
+    return pendingSend.key;
+  }
+
   async function sendChatMessage(text) {
     if (!activeAssistantSlug) throw new Error("assistant_slug не выбран");
     if (!activeSessionId) activeSessionId = await ensureChatSession(activeAssistantSlug);
+    const idempotencyKey = idempotencyKeyFor(activeSessionId, text);
+    ownKeys.add(idempotencyKey);
 
     appendChatBubble("user", text);
     setChatStatus("Ассистент думает…");
 
-    const data = await apiPost("/chat/send", {
+    // Потоковый ответ: токены появляются в пузыре по мере генерации
+    let bubble = null;
+    let streamError = null;
+    await apiPostStream("/chat/send/stream", {
       session_id: activeSessionId,
       assistant_slug: activeAssistantSlug,
-      message: text
+      message: text,
+      idempotency_key: idempotencyKey
+    }, (event, data) => {
+      if (event === "token") {
+        if (!bubble) {
+          setChatStatus("");
+          bubble = appendChatBubble("assistant", "");
+        }
+        appendToBubble(bubble, String(data?.delta || ""));
+      } else if (event === "done") {
+        if (pendingSend && pendingSend.key === idempotencyKey) pendingSend = null;
+        if (!bubble) bubble = appendChatBubble("assistant", "");
+        if (bubble && typeof data?.reply === "string") bubble.textContent = data.reply;
+        rememberMessageId(data?.message_id);
+      } else if (event === "error") {
+        streamError = data?.detail || "ошибка генерации";
+      }
     });
 
-    setChatStatus("");
-
-    // Источник истины — история с backend
-    if (Array.isArray(data?.messages)) {
-      renderChatHistory(data.messages);
-      return;
-    }
-
-    const reply = data?.reply;
-    if (typeof reply === "string" && reply.length > 0) {
-      appendChatBubble("assistant", reply);
-    } else {
+    if (streamError) {
+      setChatStatus(`Ошибка: ${streamError}`);
+    } else if (!bubble) {
       setChatStatus("Ошибка: пустой ответ модели");
+    } else {
+      setChatStatus("");
     }
   }
 
@@ -759,6 +969,8 @@
     });
 
     chatBackEl?.addEventListener("click", () => {
+      activeSessionId = null;
+      closeChatSocket();
       setActiveScreen("package");
     });
 